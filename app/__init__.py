@@ -1,18 +1,65 @@
+import click
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from apscheduler.schedulers.background import BackgroundScheduler
+import logging
 import os
+import sys
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+
+log = logging.getLogger(__name__)
 
 db = SQLAlchemy()
 login_manager = LoginManager()
 
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("PODVAULT_DB_BUSY_TIMEOUT_MS", "5000"))
+LOG_LEVEL = os.environ.get("PODVAULT_LOG_LEVEL", "INFO").upper()
+DATABASE_URI = os.environ.get("PODVAULT_DATABASE_URI", "sqlite:///vault.db")
+
+def _configure_logging():
+    # Every module logs to a child of this logger; messages keep their emoji
+    # prefixes and the level decides which are printed
+    logger = logging.getLogger(__name__)
+    logger.setLevel(LOG_LEVEL)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+
+# Databases whose INSERT supports on_conflict_do_update, which the lease,
+# rotation planner and stats upserts are written with
+_UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+def upsert(model):
+    """INSERT for model that can take on_conflict_do_update, in the app database's dialect"""
+    dialect = db.engine.dialect.name
+    if dialect not in _UPSERT_INSERTS:
+        raise Exception(f"Unsupported database {dialect}: PodVault needs SQLite or PostgreSQL")
+    return _UPSERT_INSERTS[dialect](model)
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the audit writer's batches; NORMAL
+    # syncs at checkpoints rather than on every commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
 def create_app():
+    _configure_logging()
     app = Flask(__name__)
     app.config['SECRET_KEY'] = 'supersecretkey'
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///vault.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 
     db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite":
+            event.listen(db.engine, "connect", _configure_sqlite)
     login_manager.init_app(app)
     login_manager.login_view = 'main.login'
 
@@ -22,21 +69,141 @@ def create_app():
     with app.app_context():
         db.create_all()
 
-    # Start background key rotation scheduler
-    from app.key_rotation import rotate_all_vaults
-    
+    from app import audit_log, file_index, job_leases, key_cache, rotation_planner, stats
+    job_leases.init_app(app)
+    key_cache.init_app(app)
+    file_index.init_app(app)
+    audit_log.init_app(app)
+    stats.init_app(app)
+    rotation_planner.init_app(app)
+
+    @app.cli.command("migrate-to-shards")
+    def migrate_to_shards():
+        """Move per-user vault containers into shard containers"""
+        from app.shard_migration import migrate_all_users
+        migrated, failed = migrate_all_users()
+        print(f"🧳 Migrated {migrated} vaults to shards, {failed} failed")
+
+    @app.cli.command("rotate-vault")
+    @click.argument("vault_name")
+    @click.option("--deep", is_flag=True, help="Re-encrypt every file instead of rewrapping data keys")
+    def rotate_vault(vault_name, deep):
+        """Have the rotation planner rotate a vault's key on its next tick"""
+        rotation_planner.request_rotation(vault_name, deep=deep)
+        print(f"🗓️ {'Deep key' if deep else 'Key'} rotation requested for {vault_name}")
+
+    @app.cli.command("rotation-policy")
+    @click.argument("vault_name")
+    @click.option("--max-age-hours", type=float, help="Rotate once the key is this old (0: never by age)")
+    @click.option("--max-bytes", type=int, help="Rotate once this much was encrypted under the key (0: no limit)")
+    def rotation_policy(vault_name, max_age_hours, max_bytes):
+        """Set a vault's rotation policy; options left out go back to the defaults"""
+        rotation_planner.set_policy(vault_name, max_age_hours=max_age_hours, max_bytes=max_bytes)
+        print(f"🗓️ Rotation policy for {vault_name}: max age "
+              f"{max_age_hours if max_age_hours is not None else rotation_planner.ROTATION_MAX_AGE_HOURS}h, max bytes "
+              f"{max_bytes if max_bytes is not None else rotation_planner.ROTATION_MAX_BYTES}")
+
+    # Start background key rotation scheduler: each tick rotates the vaults
+    # whose policy is due, within the rotation budget. Every app process runs
+    # it and claims vaults through job_leases; jobs wrapped in singleton() run
+    # in one process at a time. Stats, and letting go of vaults this process
+    # no longer uses, work on per-process state, so every process runs those.
     scheduler = BackgroundScheduler()
     scheduler.add_job(
-        func=rotate_all_vaults,
+        func=rotation_planner.plan_rotations,
         trigger="interval",
-        minutes=5,  # Rotate every 5 minutes
+        seconds=rotation_planner.ROTATION_PLAN_SECONDS,
         id='key_rotation_job',
-        name='Rotate all vault keys',
-        replace_existing=True
+        name='Rotate vault keys that are due',
+        replace_existing=True,
+        max_instances=1,  # A slow tick delays the next one instead of overlapping it
+        coalesce=True
+    )
+    # Repair file index drift; the first run also indexes existing vaults
+    scheduler.add_job(
+        func=job_leases.singleton('file_index_reconcile_job', file_index.reconcile_all_vaults),
+        trigger="interval",
+        minutes=file_index.RECONCILE_MINUTES,
+        next_run_time=datetime.now(),
+        id='file_index_reconcile_job',
+        name='Reconcile vault file index',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+    # Stop the containers of vaults whose owners have gone idle in every process
+    from app.vault_lifecycle import HIBERNATE_CHECK_SECONDS, hibernate_idle_vaults, release_idle_vaults
+    scheduler.add_job(
+        func=release_idle_vaults,
+        trigger="interval",
+        seconds=HIBERNATE_CHECK_SECONDS,
+        id='vault_idle_release_job',
+        name='Release vaults idle in this process',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+    scheduler.add_job(
+        func=job_leases.singleton('vault_hibernate_job', hibernate_idle_vaults),
+        trigger="interval",
+        seconds=HIBERNATE_CHECK_SECONDS,
+        id='vault_hibernate_job',
+        name='Hibernate idle vaults',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+    # Keep pre-warmed vault containers ready for registrations
+    from app.vault_pool import POOL_REFILL_SECONDS, refill_pool
+    scheduler.add_job(
+        func=job_leases.singleton('vault_pool_refill_job', refill_pool),
+        trigger="interval",
+        seconds=POOL_REFILL_SECONDS,
+        next_run_time=datetime.now(),
+        id='vault_pool_refill_job',
+        name='Refill vault container pool',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+    # Fold dashboard counters into their tables; age out old audit rows
+    scheduler.add_job(
+        func=stats.flush_stats,
+        trigger="interval",
+        seconds=stats.STATS_FLUSH_SECONDS,
+        id='stats_flush_job',
+        name='Write dashboard statistics',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
+    )
+    scheduler.add_job(
+        func=job_leases.singleton('audit_compact_job', stats.compact_audit_log),
+        trigger="interval",
+        hours=1,
+        next_run_time=datetime.now(),
+        id='audit_compact_job',
+        name='Compact old audit entries',
+        replace_existing=True,
+        max_instances=1,
+        coalesce=True
     )
+    # Remove chunks no deduplicated file references any more
+    from app.chunk_store import CHUNK_GC_MINUTES, DEDUP_ENABLED, collect_all_garbage
+    if DEDUP_ENABLED:
+        scheduler.add_job(
+            func=job_leases.singleton('chunk_gc_job', collect_all_garbage),
+            trigger="interval",
+            minutes=CHUNK_GC_MINUTES,
+            id='chunk_gc_job',
+            name='Collect unreferenced chunks',
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
     scheduler.start()
     
-    print("🔄 Key rotation scheduler started (every 5 minutes)")
+    log.info(f"🔄 Key rotation scheduler started (checks every {rotation_planner.ROTATION_PLAN_SECONDS}s)")
 
     return app
 
@@ -0,0 +1,185 @@
+"""Buffered AuditLog writer and keyset-paginated audit queries.
+
+Requests don't write audit entries themselves: ``record()`` stamps the
+entry and queues it, and a background thread inserts queued entries in
+batches of up to AUDIT_BATCH_SIZE, at most AUDIT_FLUSH_SECONDS after the
+oldest was queued - one SQLite transaction (and fsync) per batch instead of
+per action. Entries not yet committed still show up in the owner's
+activity log (``pending_entries``), and whatever is queued at shutdown is
+written before the process exits.
+
+Listings page by (timestamp, id) keyset cursors over the composite
+indexes on AuditLog, so a page costs the same however long the history.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from app import db, metrics, stats
+from app.models import AuditLog
+
+log = logging.getLogger(__name__)
+
+AUDIT_BATCH_SIZE = int(os.environ.get("PODVAULT_AUDIT_BATCH_SIZE", "200"))
+AUDIT_FLUSH_SECONDS = float(os.environ.get("PODVAULT_AUDIT_FLUSH_SECONDS", "0.5"))
+AUDIT_QUEUE_SIZE = int(os.environ.get("PODVAULT_AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_PER_PAGE = int(os.environ.get("PODVAULT_AUDIT_PER_PAGE", "50"))
+# Attempts at inserting a batch before its entries are given up on
+_MAX_ATTEMPTS = 5
+
+_app = None
+_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+_pending = {}  # id(entry) -> entry, queued or in a batch not committed yet
+_pending_lock = threading.Lock()
+_thread = None
+_thread_lock = threading.Lock()
+
+metrics.gauge("audit_queue_entries", "Audit entries waiting for the background writer", _queue.qsize)
+
+
+def init_app(app):
+    """Use app's database for audit batches; adds AuditLog's indexes to older databases"""
+    global _app
+    _app = app
+    with app.app_context():
+        for index in AuditLog.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+    atexit.register(flush)
+
+def record(action, filename=None, user=None, vault_name=None, ip_address=None, status="success"):
+    """Queue an audit entry; it is committed by the background writer"""
+    entry = {
+        "action": action,
+        "filename": filename,
+        "user": user,
+        "vault_name": vault_name,
+        "ip_address": ip_address,
+        "timestamp": datetime.utcnow(),
+        "status": status,
+    }
+    with _pending_lock:
+        _pending[id(entry)] = entry
+    stats.incr("audit_entries")
+    metrics.count("actions", action=action, status=status)
+    stats.add("actions", vault_name, when=entry["timestamp"])
+    if status == "failed":
+        stats.add("failures", vault_name, when=entry["timestamp"])
+    _ensure_writer()
+    # Blocks when the writer falls this far behind, rather than dropping entries
+    _queue.put(entry)
+
+def pending_entries(user):
+    """A user's entries not committed yet, newest first, as unsaved AuditLog rows"""
+    with _pending_lock:
+        entries = [entry for entry in _pending.values() if entry["user"] == user]
+    entries.sort(key=lambda entry: entry["timestamp"], reverse=True)
+    return [AuditLog(**entry) for entry in entries]
+
+def _ensure_writer():
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    with _thread_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="audit-writer", daemon=True)
+            _thread.start()
+
+def _next_batch(block=True):
+    """Entries to insert together: up to AUDIT_BATCH_SIZE, or what came within AUDIT_FLUSH_SECONDS"""
+    try:
+        batch = [_queue.get(block=block)]
+    except queue.Empty:
+        return []
+    deadline = time.monotonic() + AUDIT_FLUSH_SECONDS
+    while len(batch) < AUDIT_BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        try:
+            batch.append(_queue.get(timeout=remaining) if block and remaining > 0 else _queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def _write_batch(batch):
+    """Insert a batch in one transaction; False if it failed"""
+    if _app is None:
+        return False
+    with _app.app_context():
+        try:
+            with metrics.span("audit_write"):
+                db.session.bulk_insert_mappings(AuditLog, batch)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Failed to write {len(batch)} audit entries: {e}")
+            return False
+        finally:
+            db.session.remove()
+    return True
+
+def _commit(batch):
+    for attempt in range(_MAX_ATTEMPTS):
+        if _write_batch(batch):
+            break
+        time.sleep(min(2 ** attempt, 30))
+    else:
+        log.error(f"❌ Dropped {len(batch)} audit entries after {_MAX_ATTEMPTS} attempts")
+    with _pending_lock:
+        for entry in batch:
+            _pending.pop(id(entry), None)
+    for _ in batch:
+        _queue.task_done()
+
+def _run():
+    while True:
+        _commit(_next_batch())
+
+def flush():
+    """Wait until everything queued so far is committed (or given up on)"""
+    if _thread is not None and _thread.is_alive():
+        _queue.join()
+        return
+    # No writer (e.g. at interpreter exit): drain here
+    while True:
+        batch = _next_batch(block=False)
+        if not batch:
+            return
+        _commit(batch)
+
+
+def _cursor(row):
+    return f"{row.timestamp.isoformat()}_{row.id}"
+
+def _parse_cursor(cursor):
+    try:
+        timestamp, row_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+def audit_page(user=None, vault_name=None, before=None, per_page=AUDIT_PER_PAGE):
+    """One page of audit entries, newest first, optionally for one user or vault
+
+    ``before`` is the cursor of the previous page. Returns (rows, cursor of
+    the next page or None on the last page).
+    """
+    query = AuditLog.query
+    if user is not None:
+        query = query.filter(AuditLog.user == user)
+    if vault_name is not None:
+        query = query.filter(AuditLog.vault_name == vault_name)
+    position = _parse_cursor(before) if before else None
+    if position:
+        timestamp, row_id = position
+        query = query.filter(or_(AuditLog.timestamp < timestamp,
+                                 and_(AuditLog.timestamp == timestamp, AuditLog.id < row_id)))
+    rows = (query.order_by(AuditLog.timestamp.desc(), AuditLog.id.desc())
+            .limit(per_page + 1).all())
+    if len(rows) > per_page:
+        return rows[:per_page], _cursor(rows[per_page - 1])
+    return rows, None
@@ -0,0 +1,310 @@
+"""Per-vault chunk store: content-defined dedup and compression
+
+With PODVAULT_DEDUP=1, uploads are cut into content-defined chunks (about
+48 KiB on average, 16 KiB to 1 MiB). Each chunk is compressed, encrypted as
+a blob of its own and stored once per vault as ``data/.chunks/<id>.enc``.
+The file itself (``data/<name>.enc``) becomes a small manifest blob listing
+its chunks, flagged FLAG_MANIFEST in its header. Identical data uploaded
+twice is stored, transferred and rotated once.
+
+Chunk ids are HMAC-SHA256 of the plaintext under a per-vault salt kept in
+``keys/dedup.salt``, so they reveal nothing about the content to someone
+who can only see the data volume. Boundaries are where a run of
+_ANCHOR_RUN bytes all map to 1 under a salted byte-to-bit table - found with
+bytes.translate and bytes.find, so chunking runs at C speed.
+
+Chunks no manifest references any more (after deletes or overwrites) are
+removed by collect_garbage, a scheduler job. Uploads hold the vault's
+``chunks:<vault>`` lease shared (chunk_writes) from their first chunk until
+their manifest is stored, and garbage collection needs it exclusively, so
+it never runs while any app process could be adding references.
+"""
+import hashlib
+import hmac
+import io
+import json
+import logging
+import lzma
+import os
+import secrets
+import zlib
+from contextlib import contextmanager
+
+from app.key_cache import get_key_cache, key_epoch
+from app.storage import get_storage, sha256_chunks
+from app.vault_format import (
+    CODEC_SHIFT, FLAG_MANIFEST, MAX_HEADER_SIZE, ChunkReader, is_legacy, iter_decrypt, iter_encrypt, key_id,
+    parse_header
+)
+from app.vault_locks import ROTATION_LOCK_TIMEOUT, VaultBusy, file_lock, rotation_slot, vault_lock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+DEDUP_ENABLED = os.environ.get("PODVAULT_DEDUP", "0") == "1"
+DEDUP_COMPRESSION = os.environ.get("PODVAULT_DEDUP_COMPRESSION", "zlib")
+CHUNK_GC_MINUTES = int(os.environ.get("PODVAULT_CHUNK_GC_MINUTES", "60"))
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_MAX_SIZE = 1024 * 1024
+_ANCHOR_RUN = 15  # ~2**15 bytes between anchors past CHUNK_MIN_SIZE
+CHUNK_DIR = ".chunks"
+SALT_PATH = "keys/dedup.salt"
+
+# codec name: (id stored in the blob flags, compress, decompress)
+CODECS = {
+    "none": (0, None, None),
+    "zlib": (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (2, lzma.compress, lzma.decompress),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (3, zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress)
+_DECOMPRESSORS = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+
+
+def is_manifest(head):
+    """True if a blob's first bytes are a chunk store manifest header"""
+    return not is_legacy(head) and bool(parse_header(head).flags & FLAG_MANIFEST)
+
+def _anchor_table(salt):
+    # Exactly half the byte values map to 1, chosen by the salt
+    order = sorted(range(256), key=lambda b: hmac.new(salt, bytes([b]), hashlib.sha256).digest())
+    ones = set(order[:128])
+    return bytes(int(b in ones) for b in range(256))
+
+def iter_chunks(src, table, min_size=CHUNK_MIN_SIZE, max_size=CHUNK_MAX_SIZE):
+    """Split a file-like stream at content-defined boundaries"""
+    anchor = b"\x01" * _ANCHOR_RUN
+    buffer = bits = b""
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = src.read(max_size - len(buffer))
+            if not data:
+                eof = True
+            buffer += data
+            bits += data.translate(table)
+        if not buffer:
+            return
+        found = bits.find(anchor, max(min_size - _ANCHOR_RUN, 0), max_size)
+        cut = found + _ANCHOR_RUN if found >= 0 else min(len(buffer), max_size)
+        yield buffer[:cut]
+        buffer, bits = buffer[cut:], bits[cut:]
+
+def _compress(data):
+    codec_id, compress, _ = CODECS.get(DEDUP_COMPRESSION, CODECS["zlib"])
+    if compress:
+        packed = compress(data)
+        if len(packed) < len(data):
+            return codec_id, packed
+    return 0, data
+
+def has_chunk_store(vault_name):
+    """Whether a vault has ever stored chunks (raises if the vault can't be listed)"""
+    return os.path.basename(SALT_PATH) in get_storage().list(vault_name, "keys")
+
+def _vault_salt(vault_name):
+    storage = get_storage()
+    if has_chunk_store(vault_name):
+        return storage.read(vault_name, SALT_PATH).strip()
+    salt = secrets.token_hex(32).encode()
+    # Keep the chunk directory listable even before its first chunk
+    storage.write(vault_name, f"data/{CHUNK_DIR}/.keep", [])
+    storage.write(vault_name, SALT_PATH, [salt + b"\n"])
+    return salt
+
+def list_chunk_blobs(vault_name):
+    """Chunk blob names relative to data/ (".chunks/<id>.enc")"""
+    if not has_chunk_store(vault_name):
+        return []
+    return sorted(f"{CHUNK_DIR}/{name}" for name in get_storage().list(vault_name, f"data/{CHUNK_DIR}")
+                  if name.endswith(".enc"))
+
+def _chunks_lease(vault_name):
+    return f"chunks:{vault_name}"
+
+@contextmanager
+def chunk_writes(vault_name):
+    """Keep garbage collection in every app process off the vault's chunks
+
+    Held around storing files, from their first chunk until their manifest
+    is written. Waits for a collection in progress to finish (VaultBusy
+    after ROTATION_LOCK_TIMEOUT). Nothing to do without dedup.
+    """
+    if not DEDUP_ENABLED:
+        yield
+        return
+    from app import job_leases
+
+    holder = secrets.token_hex(4)
+    if not job_leases.acquire_shared(_chunks_lease(vault_name), holder, ROTATION_LOCK_TIMEOUT):
+        raise VaultBusy("Unreferenced chunks are being cleaned up, please try again")
+    try:
+        yield
+    finally:
+        job_leases.release_shared(_chunks_lease(vault_name), holder)
+
+def _stored_under(vault_name, name, vault_key):
+    """Whether the vault has the chunk, encrypted under vault_key"""
+    try:
+        head = b"".join(get_storage().iter_read(vault_name, f"data/{name}", 0, MAX_HEADER_SIZE))
+    except Exception:
+        return False
+    return bool(head) and parse_header(head).key_id == key_id(vault_key)
+
+def write_chunks(src, vault_name, vault_key, write):
+    """Store a stream's chunks that the vault doesn't have yet
+
+    Returns the manifest and the chunks written. A chunk stored under
+    another key (left behind by an upload a rotation in another process
+    turned away) is written again rather than trusted to be rotated.
+    Callers hold the vault lock shared and chunk_writes (so garbage
+    collection can't run) and pass the storage ``write`` function to use.
+    """
+    storage = get_storage()
+    salt = _vault_salt(vault_name)
+    entries = []
+    written = []
+    size = 0
+    for data in iter_chunks(src, _anchor_table(salt)):
+        chunk_id = hmac.new(salt, data, hashlib.sha256).hexdigest()
+        name = f"{CHUNK_DIR}/{chunk_id}.enc"
+        with file_lock(vault_name, name).exclusive():
+            if not _stored_under(vault_name, name, vault_key):
+                codec_id, payload = _compress(data)
+                digest = hashlib.sha256()
+                blob = iter_encrypt(vault_key, io.BytesIO(payload), flags=codec_id << CODEC_SHIFT)
+                _, stored_digest = write(f"data/{name}", sha256_chunks(blob, digest))
+                if stored_digest != digest.hexdigest():
+                    storage.remove(vault_name, f"data/{name}")
+                    raise Exception(f"Integrity check failed for chunk {chunk_id[:12]}")
+                written.append(name)
+        entries.append([chunk_id, len(data)])
+        size += len(data)
+    log.debug(f"   🧩 {len(entries)} chunks, {len(written)} new")
+    return json.dumps({"size": size, "chunks": entries}, separators=(",", ":")).encode(), written
+
+def discard_chunks(vault_name, names, vault_key):
+    """Remove chunks an upload wrote that are still under vault_key
+
+    For an upload refused after a rotation elsewhere: its chunks wouldn't
+    be readable once the old key is gone. A chunk another upload has since
+    rewritten under the new key, or the rotation has reached, is kept.
+    """
+    for name in names:
+        with file_lock(vault_name, name).exclusive():
+            if _stored_under(vault_name, name, vault_key):
+                get_storage().remove(vault_name, f"data/{name}")
+
+def read_manifest(vault_keys, blob):
+    return json.loads(b"".join(iter_decrypt(vault_keys, ChunkReader([blob]))))
+
+def read_chunk(vault_name, vault_keys, chunk_id, size):
+    name = f"{CHUNK_DIR}/{chunk_id}.enc"
+    with file_lock(vault_name, name).shared():
+        blob = get_storage().read(vault_name, f"data/{name}")
+    try:
+        payload = b"".join(iter_decrypt(vault_keys, ChunkReader([blob])))
+    except Exception:
+        # Rotated since the caller loaded its keys; the cache has the current ones
+        current = get_key_cache().get(vault_name, key_epoch(vault_name))
+        if not current:
+            raise
+        payload = b"".join(iter_decrypt(current, ChunkReader([blob])))
+    codec_id = parse_header(blob).flags >> CODEC_SHIFT
+    data = _DECOMPRESSORS[codec_id](payload) if codec_id else payload
+    if len(data) != size:
+        raise Exception(f"Chunk {chunk_id[:12]} is {len(data)} bytes, expected {size}")
+    return data
+
+def iter_manifest_range(vault_name, vault_keys, manifest, start=0, end=None):
+    """Yield plaintext [start, end) of a chunked file, reading only the chunks needed"""
+    end = manifest["size"] if end is None else end
+    offset = 0
+    for chunk_id, size in manifest["chunks"]:
+        if offset >= end:
+            return
+        if offset + size > start:
+            data = read_chunk(vault_name, vault_keys, chunk_id, size)
+            yield data[max(start - offset, 0):end - offset]
+        offset += size
+
+def collect_garbage(vault_name):
+    """Remove chunks that no manifest references; returns how many went
+
+    Runs with the vault's key lock exclusive (no uploads in this process
+    can be adding references meanwhile), its chunks lease exclusive (nor in
+    any other) and not during a rotation. VaultBusy if uploads are on.
+    """
+    from app import job_leases
+    from app.key_rotation import load_vault_keys
+
+    chunks = list_chunk_blobs(vault_name)
+    if not chunks:
+        return 0
+    with rotation_slot(vault_name), vault_lock(vault_name).exclusive(ROTATION_LOCK_TIMEOUT):
+        if not job_leases.acquire_exclusive(_chunks_lease(vault_name)):
+            raise VaultBusy("Another app process is storing files")
+        try:
+            return _sweep(vault_name, load_vault_keys(vault_name))
+        finally:
+            job_leases.release(_chunks_lease(vault_name))
+
+def _sweep(vault_name, keys):
+    storage = get_storage()
+    referenced = set()
+    for name in storage.list(vault_name, "data"):
+        if not name.endswith(".enc"):
+            continue
+        with file_lock(vault_name, name).shared():
+            try:
+                head = b"".join(storage.iter_read(vault_name, f"data/{name}", 0, MAX_HEADER_SIZE))
+                if not head or not is_manifest(head):
+                    continue
+                blob = storage.read(vault_name, f"data/{name}")
+            except FileNotFoundError:
+                continue
+        # An unreadable manifest raises: better to keep every chunk than guess
+        referenced.update(chunk_id for chunk_id, _ in read_manifest(keys, blob)["chunks"])
+
+    removed = 0
+    for chunk in list_chunk_blobs(vault_name):
+        if chunk[len(CHUNK_DIR) + 1:-len(".enc")] in referenced:
+            continue
+        with file_lock(vault_name, chunk).exclusive():
+            storage.remove(vault_name, f"data/{chunk}")
+        removed += 1
+    return removed
+
+def collect_all_garbage():
+    """Drop unreferenced chunks in every vault (scheduler job)
+
+    Skips vaults another app process is working on (job_leases).
+    """
+    from app import job_leases
+    from app.podman_manager import list_vaults
+
+    try:
+        vault_names = list_vaults()
+    except Exception as e:
+        log.error(f"❌ Failed to list vaults for chunk cleanup: {e}")
+        return
+    for vault_name in vault_names:
+        if not job_leases.acquire(f"vault:{vault_name}"):
+            log.info(f"⏭️ Skipping chunk cleanup of {vault_name}: claimed by another worker")
+            continue
+        try:
+            removed = collect_garbage(vault_name)
+        except VaultBusy as e:
+            log.info(f"⏭️ Skipping chunk cleanup of {vault_name}: {e}")
+            continue
+        except Exception as e:
+            log.warning(f"⚠️ Chunk cleanup failed for {vault_name}: {e}")
+            continue
+        finally:
+            job_leases.release(f"vault:{vault_name}")
+        if removed:
+            log.info(f"🧹 Removed {removed} unreferenced chunks from {vault_name}")
@@ -0,0 +1,242 @@
+"""Process pool for AES-GCM segment work
+
+AES-GCM itself is fast, but a big upload, download or deep rotation still
+spends long stretches holding the GIL around it, so one large transfer
+slows every other request in a threaded worker. With
+PODVAULT_CRYPTO_PROCESSES set, vault_format hands segments to worker
+processes in batches of up to CRYPTO_BATCH_BYTES instead.
+
+Segment data never goes through pickling. Each batch is copied into a
+shared memory slot; the worker transforms it into the slot's second half
+and returns only the output sizes. There are CRYPTO_SLOTS slots. A stream
+waits for a free one when all are busy (backpressure), and keeps at most
+_STREAM_WINDOW batches in flight. Streams of a single batch are handled
+inline, where the round trip would cost more than it saves.
+"""
+import atexit
+import multiprocessing
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from app import metrics
+
+CRYPTO_PROCESSES = int(os.environ.get("PODVAULT_CRYPTO_PROCESSES", "0"))
+CRYPTO_SLOTS = int(os.environ.get("PODVAULT_CRYPTO_SLOTS", str(max(2 * CRYPTO_PROCESSES, 2))))
+CRYPTO_BATCH_BYTES = int(os.environ.get("PODVAULT_CRYPTO_BATCH_BYTES", str(1024 * 1024)))
+_STREAM_WINDOW = 2
+_TAG_SIZE = 16
+
+
+def _apply(steps, nonces, data):
+    """Run one segment through steps of ("encrypt" | "decrypt", key, aad)"""
+    for (op, key, aad), nonce in zip(steps, nonces):
+        aead = AESGCM(key)
+        data = aead.encrypt(nonce, data, aad) if op == "encrypt" else aead.decrypt(nonce, data, aad)
+    return data
+
+def _run_batch(shm_name, capacity, steps, nonces, sizes):
+    """Worker side: transform segments packed at the start of a slot into its second half"""
+    shm = SharedMemory(name=shm_name)
+    try:
+        src, dst = 0, capacity
+        out = []
+        for segment_nonces, size in zip(nonces, sizes):
+            result = _apply(steps, segment_nonces, bytes(shm.buf[src:src + size]))
+            shm.buf[dst:dst + len(result)] = result
+            src += size
+            dst += len(result)
+            out.append(len(result))
+        return out
+    finally:
+        shm.close()
+
+
+class CryptoPool:
+    """Worker processes plus the shared memory slots batches travel in"""
+
+    def __init__(self, processes, slots, capacity):
+        self.processes = processes
+        self.capacity = capacity
+        self._slots = [SharedMemory(create=True, size=2 * capacity) for _ in range(slots)]
+        self._free = queue.Queue()
+        for slot in self._slots:
+            self._free.put(slot)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Forking a threaded web process is unsafe; workers come from a clean server
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+            return self._executor
+
+    def _reset_executor(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def queue_depth(self):
+        """{"waiting": streams blocked on a slot, "in_flight": batches being processed, ...}"""
+        with self._lock:
+            return {"waiting": self._waiting, "in_flight": self._in_flight,
+                    "slots": len(self._slots), "processes": self.processes}
+
+    def _acquire(self, block):
+        if not block:
+            return self._free.get_nowait()
+        with self._lock:
+            self._waiting += 1
+        try:
+            return self._free.get()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def _release(self, slot):
+        with self._lock:
+            self._in_flight -= 1
+        self._free.put(slot)
+
+    def _batches(self, steps, segments):
+        """Group (nonces, data) pairs into batches whose input and output fit a slot
+
+        A segment too big for a slot on its own makes a batch of one that
+        doesn't fit; map_segments runs those inline.
+        """
+        growth = _TAG_SIZE * len(steps)
+        batch, used = [], 0
+        for nonces, data in segments:
+            need = len(data) + growth
+            if batch and used + need > self.capacity:
+                yield batch
+                batch, used = [], 0
+            batch.append((nonces, data))
+            used += need
+        if batch:
+            yield batch
+
+    def _submit(self, slot, steps, batch):
+        """Start a batch in a slot; the returned Future yields the outputs"""
+        offset = 0
+        for _, data in batch:
+            slot.buf[offset:offset + len(data)] = data
+            offset += len(data)
+        with self._lock:
+            self._in_flight += 1
+        executor = self._get_executor()
+        try:
+            inner = executor.submit(_run_batch, slot.name, self.capacity, steps,
+                                    [nonces for nonces, _ in batch], [len(data) for _, data in batch])
+        except BaseException:
+            self._release(slot)
+            self._reset_executor(executor)
+            raise
+
+        outer = Future()
+        def collect(inner):
+            # Copy out right away, so a slow consumer never holds a slot
+            try:
+                sizes = inner.result()
+                outputs, offset = [], self.capacity
+                for size in sizes:
+                    outputs.append(bytes(slot.buf[offset:offset + size]))
+                    offset += size
+            except BaseException as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._reset_executor(executor)
+                self._release(slot)
+                outer.set_exception(e)
+                return
+            self._release(slot)
+            outer.set_result(outputs)
+        inner.add_done_callback(collect)
+        return outer
+
+    def map_segments(self, steps, segments):
+        """Yield each segment's output, in order, for (nonces, data) pairs
+
+        ``steps`` is a list of ("encrypt" | "decrypt", key, aad); each
+        segment carries one nonce per step.
+        """
+        batches = self._batches(steps, segments)
+        first = next(batches, None)
+        if first is None:
+            return
+        second = next(batches, None)
+        if second is None:
+            for nonces, data in first:
+                yield _apply(steps, nonces, data)
+            return
+
+        growth = _TAG_SIZE * len(steps)
+        pending = deque()
+        for batch in _chain(first, second, batches):
+            while len(pending) >= _STREAM_WINDOW:
+                yield from pending.popleft().result()
+            if len(batch[0][1]) + growth > self.capacity:
+                while pending:
+                    yield from pending.popleft().result()
+                for nonces, data in batch:
+                    yield _apply(steps, nonces, data)
+                continue
+            slot = None
+            while slot is None:
+                try:
+                    # Only wait for a slot with nothing of ours in flight - what we
+                    # already have finishes first and frees one
+                    slot = self._acquire(block=not pending)
+                except queue.Empty:
+                    yield from pending.popleft().result()
+            pending.append(self._submit(slot, steps, batch))
+        while pending:
+            yield from pending.popleft().result()
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        for slot in self._slots:
+            slot.close()
+            slot.unlink()
+
+
+def _chain(first, second, rest):
+    yield first
+    yield second
+    yield from rest
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_crypto_pool():
+    """The shared pool, or None when crypto runs inline (PODVAULT_CRYPTO_PROCESSES=0)"""
+    global _pool
+    if CRYPTO_PROCESSES <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = CryptoPool(CRYPTO_PROCESSES, CRYPTO_SLOTS, CRYPTO_BATCH_BYTES)
+            atexit.register(_pool.close)
+        return _pool
+
+def queue_depth():
+    """The pool's queue_depth(), or None when crypto runs inline"""
+    return _pool.queue_depth() if _pool is not None else None
+
+metrics.gauge("crypto_pool", "Crypto pool streams waiting for a slot, batches in flight, slots and processes",
+              queue_depth)
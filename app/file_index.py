@@ -0,0 +1,201 @@
+"""SQLite index of vault contents (the VaultFile table).
+
+Uploads and rotation update it as they go; the reconciler repairs
+whatever drifts (files written by older versions, crashes between the
+storage operation and the commit, changes made behind the app's back).
+Listing pages and file counts read only the index.
+"""
+import logging
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+
+from app import db
+from app.models import VaultFile
+from app.podman_manager import list_vaults
+from app.storage import get_storage
+from app.vault_format import FLAG_MANIFEST, MAX_HEADER_SIZE, is_legacy, parse_header, plaintext_size
+
+log = logging.getLogger(__name__)
+
+FILES_PER_PAGE = int(os.environ.get("PODVAULT_FILES_PER_PAGE", "25"))
+RECONCILE_MINUTES = int(os.environ.get("PODVAULT_RECONCILE_MINUTES", "15"))
+# Files and rows touched this recently are left alone by the reconciler,
+# since an upload may still be between storage and commit
+RECONCILE_GRACE = timedelta(seconds=60)
+
+# What an upload knows about the file it just stored
+StoredFile = namedtuple("StoredFile", "filename plaintext_size ciphertext_size content_hash key_version")
+
+_SORT_ORDERS = {
+    "name": (VaultFile.filename.asc(),),
+    "newest": (VaultFile.updated_at.desc(), VaultFile.filename.asc()),
+    "size": (VaultFile.plaintext_size.desc(), VaultFile.filename.asc()),
+}
+
+_app = None
+
+def init_app(app):
+    """Let index updates made outside a request (rotation threads) find the app"""
+    global _app
+    _app = app
+
+@contextmanager
+def _app_context():
+    """Yields True with an app context active, False if there is no app to use"""
+    if has_app_context():
+        yield True
+    elif _app is not None:
+        with _app.app_context():
+            yield True
+    else:
+        yield False
+
+
+def describe_blob(ciphertext_size, head):
+    """(plaintext size, key version) from a blob's size and first bytes"""
+    if not ciphertext_size or is_legacy(head):
+        # Fernet tokens don't record their plaintext size
+        return (0 if not ciphertext_size else None), None
+    header = parse_header(head)
+    if header.flags & FLAG_MANIFEST:
+        # Chunked files record their size inside the encrypted manifest
+        return None, header.key_id.hex() if header.key_id else None
+    size = plaintext_size(ciphertext_size, header.segment_size, header.size)
+    return size, header.key_id.hex() if header.key_id else None
+
+def list_files(vault_name, page=1, sort="name", per_page=FILES_PER_PAGE):
+    """One page of a vault's files, as a Flask-SQLAlchemy Pagination"""
+    order = _SORT_ORDERS.get(sort, _SORT_ORDERS["name"])
+    return (VaultFile.query.filter_by(vault_name=vault_name)
+            .order_by(*order)
+            .paginate(page=page, per_page=per_page, error_out=False))
+
+def count_files(vault_name):
+    return VaultFile.query.filter_by(vault_name=vault_name).count()
+
+def record_upload(vault_name, stored):
+    """Add or refresh a file's row; the caller commits (with its audit entry)"""
+    row = VaultFile.query.filter_by(vault_name=vault_name, filename=stored.filename).first()
+    return _apply_upload(row, vault_name, stored, datetime.utcnow())
+
+def record_uploads(vault_name, stored_files, batch=500):
+    """record_upload for many files, looking up existing rows in batches"""
+    now = datetime.utcnow()
+    stored_files = list({stored.filename: stored for stored in stored_files}.values())
+    for start in range(0, len(stored_files), batch):
+        chunk = stored_files[start:start + batch]
+        rows = {row.filename: row for row in VaultFile.query.filter(
+            VaultFile.vault_name == vault_name,
+            VaultFile.filename.in_([stored.filename for stored in chunk]))}
+        for stored in chunk:
+            _apply_upload(rows.get(stored.filename), vault_name, stored, now)
+
+def _apply_upload(row, vault_name, stored, now):
+    if row is None:
+        row = VaultFile(vault_name=vault_name, filename=stored.filename)
+        db.session.add(row)
+    row.plaintext_size = stored.plaintext_size
+    row.ciphertext_size = stored.ciphertext_size
+    row.content_hash = stored.content_hash
+    row.key_version = stored.key_version
+    row.updated_at = now
+    row.rotated_at = None
+    return row
+
+def record_rotation(vault_name, key_version, updates):
+    """Note that files now sit under key_version
+
+    ``updates`` maps filenames to (ciphertext size, plaintext size) for
+    re-encrypted files, or (None, None) when only the key slot changed.
+    Commits on its own; failures only log, the reconciler catches up.
+    """
+    if not updates:
+        return
+    with _app_context() as active:
+        if not active:
+            return
+        try:
+            now = datetime.utcnow()
+            rows = VaultFile.query.filter(VaultFile.vault_name == vault_name,
+                                          VaultFile.filename.in_(list(updates)))
+            for row in rows:
+                ciphertext_size, size = updates[row.filename]
+                row.key_version = key_version
+                row.rotated_at = now
+                if ciphertext_size is not None:
+                    row.ciphertext_size = ciphertext_size
+                if size is not None:
+                    row.plaintext_size = size
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Failed to update file index for {vault_name}: {e}")
+
+def reconcile_vault(vault_name):
+    """Make a vault's rows match its stored files; returns (added, updated, removed)"""
+    storage = get_storage()
+    names = [name for name in storage.list(vault_name, "data") if name.endswith(".enc")]
+    rows = {row.filename: row for row in VaultFile.query.filter_by(vault_name=vault_name)}
+    recent = datetime.utcnow() - RECONCILE_GRACE
+    added = updated = removed = 0
+
+    for name in names:
+        row = rows.pop(name, None)
+        if row is not None and row.updated_at and row.updated_at > recent:
+            continue
+        try:
+            size, mtime = storage.stat(vault_name, f"data/{name}")
+        except Exception:
+            continue  # Deleted since the listing
+        if row is not None and row.ciphertext_size == size:
+            continue
+        modified = datetime.utcfromtimestamp(mtime)
+        if modified > recent:
+            continue
+        head = b"".join(storage.iter_read(vault_name, f"data/{name}", 0, MAX_HEADER_SIZE))
+        size_plain, key_version = describe_blob(size, head)
+        if row is None:
+            row = VaultFile(vault_name=vault_name, filename=name, created_at=modified)
+            db.session.add(row)
+            added += 1
+        else:
+            row.content_hash = None  # Changed outside the app; hash unknown
+            updated += 1
+        row.ciphertext_size = size
+        row.plaintext_size = size_plain
+        row.key_version = key_version
+        row.updated_at = modified
+
+    for row in rows.values():
+        if row.updated_at and row.updated_at > recent:
+            continue
+        db.session.delete(row)
+        removed += 1
+
+    db.session.commit()
+    return added, updated, removed
+
+def reconcile_all_vaults():
+    """Repair index drift for every vault (scheduler job)"""
+    with _app_context() as active:
+        if not active:
+            return
+        try:
+            vault_names = list_vaults()
+        except Exception as e:
+            log.error(f"❌ Failed to list vaults for reconciling: {e}")
+            return
+
+        for vault_name in vault_names:
+            try:
+                added, updated, removed = reconcile_vault(vault_name)
+            except Exception as e:
+                db.session.rollback()
+                log.warning(f"⚠️ Failed to reconcile file index for {vault_name}: {e}")
+                continue
+            if added or updated or removed:
+                log.info(f"🗂️ Reconciled {vault_name}: {added} added, {updated} updated, {removed} removed")
@@ -0,0 +1,269 @@
+"""Leases in the application database, so several app processes share background work.
+
+Every process that creates the app starts the same scheduler. Jobs that must
+run once across all of them (index reconcile, pool refill, audit compaction,
+chunk cleanup) are wrapped in ``singleton``: the process holding the job's
+``job:<id>`` lease is its leader and runs it, the others skip their ticks.
+Per-vault work is claimed with a ``vault:<name>`` lease instead, so it is
+split between processes - every process runs the rotation planner, and each
+rotates only the vaults it claimed.
+
+A lease can also be held shared (``acquire_shared``): any number of
+holders, each a ``<name>/<holder>`` row, while ``acquire_exclusive`` only
+takes ``<name>`` when nobody holds it either way - the cross-process
+counterpart of the readers/writer locks in app/vault_locks.py.
+
+Leases are rows of JobLease with an owner, a heartbeat and an expiry. A
+heartbeat thread renews this process's leases every LEASE_SECONDS / 3 and
+keeps a ``worker:<owner>`` lease too, which is how live_workers() counts
+processes. A lease nobody renews expires after LEASE_SECONDS and is free to
+take; leases are released on clean shutdown.
+
+Leases coordinate exactly the processes that share the database. On SQLite
+that is the processes of one host using the same file; workers on several
+hosts need a PostgreSQL database.
+"""
+import atexit
+import logging
+import os
+import secrets
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import has_app_context
+from sqlalchemy import case, delete, func, or_, select
+
+from app import db, upsert
+from app.models import JobLease
+
+log = logging.getLogger(__name__)
+
+LEASE_SECONDS = int(os.environ.get("PODVAULT_LEASE_SECONDS", "60"))
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+WORKER_LEASE = f"worker:{OWNER}"
+
+_app = None
+_held = set()
+_held_lock = threading.Lock()
+_thread = None
+_stop = threading.Event()
+
+
+def init_app(app):
+    """Register this process as a worker and start heartbeating"""
+    global _app
+    _app = app
+    with app.app_context():
+        acquire(WORKER_LEASE)
+    atexit.register(release_all)
+
+@contextmanager
+def _app_context():
+    if has_app_context():
+        yield True
+    elif _app is not None:
+        with _app.app_context():
+            yield True
+    else:
+        yield False
+
+def _take(name, now, connection=None):
+    """Insert the lease, or take it over if it is ours or expired; True if we hold it now"""
+    expires = now + timedelta(seconds=LEASE_SECONDS)
+    statement = upsert(JobLease).values(name=name, owner=OWNER, acquired_at=now, heartbeat_at=now,
+                                        expires_at=expires)
+    statement = statement.on_conflict_do_update(
+        index_elements=["name"],
+        set_={"owner": OWNER, "heartbeat_at": now, "expires_at": expires,
+              "acquired_at": case((JobLease.owner == OWNER, JobLease.acquired_at), else_=now)},
+        where=or_(JobLease.owner == OWNER, JobLease.expires_at < now))
+    return (connection or db.session).execute(statement).rowcount == 1
+
+def acquire(name):
+    """Take a lease unless another live process holds it; True if this process holds it"""
+    with _app_context() as active:
+        if not active:
+            return False
+        try:
+            taken = _take(name, datetime.utcnow())
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Failed to take lease {name}: {e}")
+            return False
+    with _held_lock:
+        if taken:
+            _held.add(name)
+        else:
+            _held.discard(name)
+    if taken:
+        _ensure_heartbeat()
+    return taken
+
+def release(name):
+    """Give up a lease so another process can take it right away"""
+    with _held_lock:
+        _held.discard(name)
+    with _app_context() as active:
+        if not active:
+            return
+        try:
+            # On a connection of its own, whatever the caller's session holds
+            with db.engine.begin() as connection:
+                connection.execute(delete(JobLease).where(JobLease.name == name, JobLease.owner == OWNER))
+        except Exception as e:
+            log.warning(f"⚠️ Failed to release lease {name}: {e}")
+
+def _take_unless(name, conflict):
+    """Take a lease, then give it back if a live lease matching ``conflict`` exists
+
+    Each step commits on a connection of its own, whatever the caller's
+    session holds: of two processes taking conflicting leases at once, at
+    least one sees the other's, so they never both keep theirs.
+    """
+    with _app_context() as active:
+        if not active:
+            return True  # No other process to share with
+        try:
+            with db.engine.begin() as connection:
+                taken = _take(name, datetime.utcnow(), connection)
+            if taken:
+                with db.engine.connect() as connection:
+                    clash = connection.execute(select(func.count()).select_from(JobLease).where(
+                        conflict, JobLease.expires_at >= datetime.utcnow())).scalar()
+                if clash:
+                    with db.engine.begin() as connection:
+                        connection.execute(delete(JobLease).where(JobLease.name == name,
+                                                                  JobLease.owner == OWNER))
+                    taken = False
+        except Exception as e:
+            log.warning(f"⚠️ Failed to take lease {name}: {e}")
+            return False
+    if taken:
+        with _held_lock:
+            _held.add(name)
+        _ensure_heartbeat()
+    return taken
+
+def acquire_shared(name, holder=None, timeout=0):
+    """Hold a lease shared, as this process (or one ``holder`` within it)
+
+    Waits up to ``timeout`` seconds while another process holds it
+    exclusively; True once held. Without an app there is nothing to share
+    and it's always True.
+    """
+    reader = f"{name}/{holder or OWNER}"
+    deadline = time.monotonic() + timeout
+    while not _take_unless(reader, JobLease.name == name):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(min(1.0, max(deadline - time.monotonic(), 0)))
+    return True
+
+def release_shared(name, holder=None):
+    release(f"{name}/{holder or OWNER}")
+
+def acquire_exclusive(name):
+    """Take a lease only if no process holds it, shared or exclusively; True if taken
+
+    Give it back with ``release``.
+    """
+    return _take_unless(name, JobLease.name.startswith(f"{name}/", autoescape=True))
+
+def release_all():
+    _stop.set()
+    with _held_lock:
+        names = list(_held)
+    for name in names:
+        release(name)
+
+def holds(name):
+    """Whether this process held the lease at its last heartbeat"""
+    with _held_lock:
+        return name in _held
+
+def live_workers():
+    """App processes with a live worker lease (at least 1: this one)"""
+    count = JobLease.query.filter(JobLease.name.startswith("worker:"),
+                                  JobLease.expires_at >= datetime.utcnow()).count()
+    return max(count, 1)
+
+def _heartbeat():
+    """Renew every lease this process holds; forget the ones it lost"""
+    with _held_lock:
+        names = set(_held)
+    if not names:
+        return
+    with _app_context() as active:
+        if not active:
+            return
+        now = datetime.utcnow()
+        try:
+            (JobLease.query.filter(JobLease.owner == OWNER, JobLease.name.in_(names))
+             .update({"heartbeat_at": now, "expires_at": now + timedelta(seconds=LEASE_SECONDS)},
+                     synchronize_session=False))
+            kept = {name for (name,) in db.session.query(JobLease.name).filter(
+                JobLease.owner == OWNER, JobLease.name.in_(names))}
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Lease heartbeat failed: {e}")
+            return
+        finally:
+            db.session.remove()
+    lost = names - kept
+    if lost:
+        log.warning(f"⚠️ Lost leases: {', '.join(sorted(lost))}")
+        with _held_lock:
+            _held.difference_update(lost)
+    if WORKER_LEASE in lost:
+        acquire(WORKER_LEASE)
+
+def _run():
+    while not _stop.wait(LEASE_SECONDS / 3):
+        _heartbeat()
+
+def _ensure_heartbeat():
+    global _thread
+    with _held_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="lease-heartbeat", daemon=True)
+            _thread.start()
+
+def _record_run(name, status):
+    with _app_context() as active:
+        if not active:
+            return
+        try:
+            JobLease.query.filter_by(name=name, owner=OWNER).update(
+                {"last_run_at": datetime.utcnow(), "last_status": status}, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Failed to record run of {name}: {e}")
+
+def singleton(job_id, func):
+    """Wrap a scheduler job so only the process holding its lease runs it
+
+    The lease is kept between runs: the leader stays leader while it
+    heartbeats, and another process takes over within LEASE_SECONDS of it
+    stopping.
+    """
+    name = f"job:{job_id}"
+
+    @wraps(func)
+    def run(*args, **kwargs):
+        if not acquire(name):
+            return None
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            _record_run(name, "failed")
+            raise
+        _record_run(name, "ok")
+        return result
+    return run
@@ -0,0 +1,135 @@
+"""In-process cache of vault keyrings, kept honest across app processes.
+
+Each process caches keys on its own, so a rotation in one process must
+reach the others: every change of a vault's keys bumps its VaultKeyEpoch
+row (``keys_changed``), and a cached keyring is only used while the
+epoch it was loaded under is still current (``key_epoch``). That costs
+one small database read per lookup instead of reading keys/ through the
+storage backend. Without an app (scripts, benchmarks) there is no epoch
+and entries only expire.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import has_app_context
+from sqlalchemy import select
+
+from app import db, upsert
+from app.models import VaultKeyEpoch
+
+log = logging.getLogger(__name__)
+
+KEY_CACHE_TTL = float(os.environ.get("PODVAULT_KEY_CACHE_TTL", "300"))
+KEY_CACHE_SIZE = int(os.environ.get("PODVAULT_KEY_CACHE_SIZE", "256"))
+
+
+def _wipe(buffers):
+    for buffer in buffers:
+        buffer[:] = bytes(len(buffer))
+
+
+class KeyCache:
+    """Bounded LRU of vault keyrings, each entry living at most ``ttl`` seconds
+
+    Keys are held in bytearrays and zeroed when an entry expires, is evicted
+    or invalidated. Callers get immutable copies, so a request already using
+    a key isn't affected; those copies go away with the request. An entry
+    put with a key epoch is only returned to lookups with the same one.
+    """
+
+    def __init__(self, ttl=KEY_CACHE_TTL, size=KEY_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, vault_name, epoch=None):
+        """Cached keys for a vault, or None"""
+        with self._lock:
+            entry = self._entries.get(vault_name)
+            if entry is None:
+                return None
+            expires, entry_epoch, buffers = entry
+            if expires <= time.monotonic() or entry_epoch != epoch:
+                del self._entries[vault_name]
+                _wipe(buffers)
+                return None
+            self._entries.move_to_end(vault_name)
+            return [bytes(buffer) for buffer in buffers]
+
+    def put(self, vault_name, keys, epoch=None):
+        if self.ttl <= 0 or self.size <= 0:
+            return
+        buffers = [bytearray(key) for key in keys]
+        with self._lock:
+            old = self._entries.pop(vault_name, None)
+            if old:
+                _wipe(old[2])
+            self._entries[vault_name] = (time.monotonic() + self.ttl, epoch, buffers)
+            while len(self._entries) > self.size:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                _wipe(evicted)
+
+    def invalidate(self, vault_name):
+        with self._lock:
+            entry = self._entries.pop(vault_name, None)
+        if entry:
+            _wipe(entry[2])
+
+    def clear(self):
+        with self._lock:
+            entries, self._entries = self._entries, OrderedDict()
+        for _, _, buffers in entries.values():
+            _wipe(buffers)
+
+
+_cache = KeyCache()
+_app = None
+
+def get_key_cache():
+    """The process-wide vault key cache"""
+    return _cache
+
+def init_app(app):
+    """Let key lookups and changes outside a request (rotation threads) reach the database"""
+    global _app
+    _app = app
+
+@contextmanager
+def _app_context():
+    if has_app_context():
+        yield True
+    elif _app is not None:
+        with _app.app_context():
+            yield True
+    else:
+        yield False
+
+def key_epoch(vault_name):
+    """The vault's current key epoch, or None without an app to ask"""
+    with _app_context() as active:
+        if not active:
+            return None
+        # A connection of its own: the session's transaction may still see an
+        # older snapshot of the row
+        with db.engine.connect() as connection:
+            epoch = connection.execute(select(VaultKeyEpoch.epoch)
+                                       .where(VaultKeyEpoch.vault_name == vault_name)).scalar()
+        return epoch or 0
+
+def keys_changed(vault_name):
+    """Drop the vault's cached keys, in this process and (by bumping its key epoch) all others"""
+    _cache.invalidate(vault_name)
+    with _app_context() as active:
+        if not active:
+            return
+        # Committed on its own connection, whatever the caller's session holds
+        statement = upsert(VaultKeyEpoch).values(vault_name=vault_name, epoch=1)
+        with db.engine.begin() as connection:
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=["vault_name"], set_={"epoch": VaultKeyEpoch.epoch + 1}))
+    log.debug(f"🔑 Keys of {vault_name} changed, cached copies dropped")
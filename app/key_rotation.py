@@ -1,7 +1,48 @@
 from cryptography.fernet import Fernet
+import base64
+import hashlib
+import io
+import json
+import logging
 import os
-import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import partial
+from app import chunk_store, metrics, rotation_planner, stats
+from app.crypto_pool import get_crypto_pool
+from app.file_index import StoredFile, record_rotation
+from app.key_cache import get_key_cache, key_epoch, keys_changed
+from app.vault_lifecycle import hibernate_vault
+from app.podman_manager import list_vault_containers, list_vaults
+from app.storage import get_storage, sha256_chunks, vault_container
+from app.vault_format import (
+    DEFAULT_SEGMENT_SIZE, FLAG_MANIFEST, HEADER_SIZE, KEY_SLOT_OFFSET, MAX_HEADER_SIZE, TAG_SIZE, ChunkReader,
+    file_key, is_legacy,
+    iter_decrypt, iter_decrypt_range, iter_encrypt, iter_reencrypt, key_id, parse_header,
+    plaintext_size, rewrap_key_slot, segment_range
+)
+from app.vault_locks import ROTATION_LOCK_TIMEOUT, VaultBusy, file_lock, rotation_slot, vault_lock
+
+# Pace for deep (full re-encryption) rotations, in bytes per second per vault
+DEEP_REENCRYPT_RATE = int(os.environ.get("PODVAULT_DEEP_REENCRYPT_RATE", str(20 * 1024 * 1024)))
+# Pace for all re-encryption together, every vault and both kinds of rotation (0 is unpaced)
+ROTATION_IO_RATE = int(os.environ.get("PODVAULT_ROTATION_IO_RATE", str(64 * 1024 * 1024)))
+# Vaults rotated concurrently, files rotated concurrently within one vault,
+# and threads doing segment re-encryption for deep rotations
+ROTATION_WORKERS = int(os.environ.get("PODVAULT_ROTATION_WORKERS", "8"))
+ROTATION_FILE_WORKERS = int(os.environ.get("PODVAULT_ROTATION_FILE_WORKERS", "4"))
+ROTATION_CRYPTO_WORKERS = int(os.environ.get("PODVAULT_ROTATION_CRYPTO_WORKERS", str(os.cpu_count() or 2)))
+# Time one scheduler tick spends on a vault before saving progress for the next,
+# and files handled between journal saves
+ROTATION_TICK_SECONDS = float(os.environ.get("PODVAULT_ROTATION_TICK_SECONDS", "240"))
+ROTATION_BATCH = int(os.environ.get("PODVAULT_ROTATION_BATCH", "64"))
+
+ROTATION_JOURNAL = "keys/rotation.json"
+
+log = logging.getLogger(__name__)
 
 def get_vault_key_path(vault_name):
     """Get key file path for specific vault"""
@@ -12,267 +53,738 @@ def generate_vault_key(vault_name):
     key = Fernet.generate_key()
     
     # Store inside Podman container
-    subprocess.run([
-        "podman", "exec", vault_name,
-        "sh", "-c", f"mkdir -p /vault/keys && echo '{key.decode()}' > /vault/keys/master.key"
-    ])
+    get_storage().write(vault_name, "keys/master.key", [key + b"\n"])
+    keys_changed(vault_name)
     return key
 
+def load_vault_keys(vault_name):
+    """Keys that may protect a vault's files, the one for new files first
+
+    Outside a rotation that's just master.key. While a rotation is in
+    progress its journal adds the new key, which also becomes the key new
+    files are encrypted with. Callers hold the vault lock shared, so a
+    rotation can't start or finish halfway through.
+    
+    Served from the key cache while the vault's key epoch is unchanged;
+    a rotation in any app process bumps it.
+    """
+    # The epoch is read first: keys read after it are at least that new
+    epoch = key_epoch(vault_name)
+    keys = get_key_cache().get(vault_name, epoch)
+    if keys is not None:
+        return keys
+    
+    log.debug(f"🔑 Loading key for {vault_name}...")
+    with metrics.span("key_load"):
+        key_str = get_storage().read(vault_name, "keys/master.key").decode().strip()
+        log.debug(f"   Key length: {len(key_str)} chars")
+        log.debug(f"   Key preview: {key_str[:20]}...")
+        
+        master = key_str.encode()
+        keys = [master]
+        journal = _read_journal(vault_name)
+        if journal and journal["old_key"].encode() == master:
+            log.debug(f"   Rotation in progress, new files use the new key")
+            keys = [journal["new_key"].encode(), master]
+    get_key_cache().put(vault_name, keys, epoch)
+    return keys
+
 def load_vault_key(vault_name):
-    """Load key from specific vault container"""
-    print(f"🔑 Loading key for {vault_name}...")
-    result = subprocess.run([
-        "podman", "exec", vault_name,
-        "cat", "/vault/keys/master.key"
-    ], capture_output=True, text=True)
-    
-    key_str = result.stdout.strip()
-    print(f"   Key length: {len(key_str)} chars")
-    print(f"   Key preview: {key_str[:20]}...")
-    
-    return key_str.encode()
+    """Load the key new files in a vault are encrypted with"""
+    return load_vault_keys(vault_name)[0]
+
+def vault_read_range(vault_name, path, offset, length):
+    """Read a byte range of a vault file"""
+    return b"".join(get_storage().iter_read(vault_name, path, offset, length))
+
+class _HashingReader:
+    """File-like wrapper that hashes, counts and times what is read through it"""
+    
+    def __init__(self, src):
+        self.src = src
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.seconds = 0.0
+    
+    def read(self, size=-1):
+        started = time.perf_counter()
+        data = self.src.read(size)
+        self.seconds += time.perf_counter() - started
+        self.digest.update(data)
+        self.size += len(data)
+        return data
+
+def store_stream_in_vault(src, filename, vault_name):
+    """Encrypt a file-like stream straight into the vault; returns a StoredFile"""
+    log.debug(f"🔤 Encrypting {filename} into {vault_name}")
+    
+    # The key must not rotate between loading it and the write, and the
+    # file must not be replaced while someone reads or rotates it
+    with vault_lock(vault_name).shared(), chunk_store.chunk_writes(vault_name), \
+            file_lock(vault_name, filename + ".enc").exclusive():
+        return _store_stream(src, filename, vault_name)
+
+def store_streams_in_vault(entries, vault_name):
+    """Encrypt (filename, stream) pairs into the vault over one storage session
+
+    Yields a StoredFile per entry as soon as it's stored. The key is loaded
+    once and all writes share one agent channel, so small files cost their
+    crypto and little else. The first failure ends the batch (the request
+    body may be unusable by then); what was yielded before it is stored.
+    """
+    storage = get_storage()
+    with vault_lock(vault_name).shared(), chunk_store.chunk_writes(vault_name):
+        key = load_vault_key(vault_name)
+        with storage.writer(vault_name) as write:
+            for filename, src in entries:
+                with file_lock(vault_name, filename + ".enc").exclusive():
+                    stored = _store_stream(src, filename, vault_name, key, write)
+                yield stored
+
+def _store_stream(src, filename, vault_name, key=None, write=None):
+    # Vault listings hide dotfiles and data/ is flat
+    if filename.startswith(".") or "/" in filename:
+        raise Exception(f"Invalid file name: {filename}")
+    key = key or load_vault_key(vault_name)
+    write = write or partial(get_storage().write, vault_name)
+    enc_filename = filename + ".enc"
+    path = f"data/{enc_filename}"
+    
+    # The agent writes a .part file, reports its size and sha256, then renames
+    # it - so verification happens on the same stream, with no extra exec
+    digest = hashlib.sha256()
+    plaintext = _HashingReader(src)
+    chunks_written = []
+    if chunk_store.DEDUP_ENABLED:
+        # The blob becomes a manifest of deduplicated, compressed chunks
+        with metrics.span("dedup_chunks"):
+            manifest, chunks_written = chunk_store.write_chunks(plaintext, vault_name, key, write)
+        encrypted = metrics.TimedIter(iter_encrypt(key, io.BytesIO(manifest), flags=FLAG_MANIFEST))
+    else:
+        encrypted = metrics.TimedIter(iter_encrypt(key, plaintext, offload=get_crypto_pool()))
+    chunks = metrics.TimedIter(sha256_chunks(encrypted, digest))
+    started = time.perf_counter()
+    try:
+        stored_size, stored_digest = write(path, chunks)
+    except Exception as e:
+        log.error(f"   ❌ Storage failed: {e}")
+        raise Exception(f"Failed to store encrypted file: {e}")
+    log.debug(f"   ✅ Stored as: {enc_filename} ({stored_size} bytes)")
+    
+    if stored_digest != digest.hexdigest():
+        get_storage().remove(vault_name, path)
+        raise Exception(f"Integrity check failed! Expected sha256 {digest.hexdigest()[:12]}, "
+                        f"got {stored_digest[:12]} ({stored_size} bytes)")
+    key = _check_key_still_current(vault_name, path, key, chunks_written)
+    
+    log.debug(f"   ✅ Verified sha256: {stored_digest[:12]}...")
+    # The phases interleave in one pipeline: each is what its stage added
+    reading = 0.0 if chunk_store.DEDUP_ENABLED else plaintext.seconds
+    metrics.observe("span", plaintext.seconds, span="upload_read")
+    metrics.observe("span", encrypted.seconds - reading, span="encrypt")
+    metrics.observe("span", chunks.seconds - encrypted.seconds, span="verify")
+    metrics.observe("span", time.perf_counter() - started - chunks.seconds, span="storage_write")
+    metrics.count("bytes_processed", plaintext.size, op="encrypt")
+    rotation_planner.note_write(vault_name, plaintext.size)
+    return StoredFile(enc_filename, plaintext.size, stored_size,
+                      plaintext.digest.hexdigest(), key_id(key).hex())
+
+def _check_key_still_current(vault_name, path, key, chunks=()):
+    """The key a just-stored file is under, if it is still the vault's key for new files
+
+    The vault lock only keeps rotations in this process out. A rotation
+    another process started meanwhile may have listed the vault's files
+    before this one was written, and would commit without it; unless that
+    rotation has already got to the file, it goes (with the chunks the
+    upload wrote) and the upload fails.
+    """
+    current = load_vault_key(vault_name)
+    if current == key:
+        return key
+    head = vault_read_range(vault_name, path, 0, MAX_HEADER_SIZE)
+    if parse_header(head).key_id == key_id(current):
+        return current
+    get_storage().remove(vault_name, path)
+    chunk_store.discard_chunks(vault_name, chunks, key)
+    raise Exception("The vault's key was rotated during the upload, please try again")
 
 def encrypt_file_for_vault(filepath, vault_name):
     """Encrypt file using vault-specific key"""
-    print(f"\n🔤 ENCRYPTING FILE")
-    print(f"   File: {filepath}")
-    print(f"   Vault: {vault_name}")
-    
-    key = load_vault_key(vault_name)
-    f = Fernet(key)
-    
     with open(filepath, "rb") as f_in:
-        data = f_in.read()
-    
-    print(f"   File size: {len(data)} bytes")
-    
-    encrypted = f.encrypt(data)
-    print(f"   Encrypted size: {len(encrypted)} bytes")
-    
-    # Store in vault's container - FIXED: Write to temp file first
-    enc_filename = os.path.basename(filepath) + ".enc"
-    temp_enc_path = f"/tmp/{enc_filename}"
-    
-    # Write encrypted data to temporary file
-    with open(temp_enc_path, "wb") as f_out:
-        f_out.write(encrypted)
-    
-    print(f"   💾 Temp file: {temp_enc_path} ({len(encrypted)} bytes)")
-    
-    # Copy temp file into container using podman cp
-    result = subprocess.run([
-        "podman", "cp", 
-        temp_enc_path,
-        f"{vault_name}:/vault/data/{enc_filename}"
-    ], capture_output=True, text=True)
-    
-    # Clean up temp file
-    if os.path.exists(temp_enc_path):
-        os.remove(temp_enc_path)
+        return store_stream_in_vault(f_in, os.path.basename(filepath), vault_name).filename
+
+class VaultDownload:
+    """Decrypting reader for one stored file that can serve byte ranges
+
+    Holds the file's lock shared from construction until ``close()``, so the
+    header it read stays valid while the response streams - against this
+    process. A rotation in another one can still re-encrypt the blob; each
+    range then fails cleanly instead of decrypting a mix (see iter_range).
+    """
+    
+    def __init__(self, filename, vault_name):
+        self.filename = filename
+        self.vault_name = vault_name
+        self.path = f"data/{filename}"
+        # Keys first: the file lock must never be held while waiting on the vault's
+        with vault_lock(vault_name).shared():
+            self.key = load_vault_keys(vault_name)
+        self._lock = file_lock(vault_name, filename)
+        self._lock.acquire_shared()
+        try:
+            self._open()
+        except BaseException:
+            self.close()
+            raise
     
-    if result.returncode == 0:
-        print(f"   ✅ Stored as: {enc_filename}")
-        
-        # Verify file was written correctly
-        verify = subprocess.run([
-            "podman", "exec", vault_name,
-            "stat", "-c", "%s", f"/vault/data/{enc_filename}"
-        ], capture_output=True, text=True)
+    def _open(self):
+        try:
+            stored_size, mtime = get_storage().stat(self.vault_name, self.path)
+        except Exception:
+            raise Exception(f"❌ File not found in vault: {self.filename}")
+        self.header = vault_read_range(self.vault_name, self.path, 0, MAX_HEADER_SIZE)
+        self.etag = f"{stored_size}-{mtime}"
+        self.seekable = not is_legacy(self.header)
+        self._manifest = None
         
-        if verify.returncode == 0:
-            stored_size = int(verify.stdout.strip())
-            print(f"   ✅ Verified size: {stored_size} bytes")
-            if stored_size != len(encrypted):
-                raise Exception(f"Size mismatch! Expected {len(encrypted)}, got {stored_size}")
+        if self.seekable and chunk_store.is_manifest(self.header):
+            # Deduplicated file: ranges come from the chunks the manifest lists
+            blob = get_storage().read(self.vault_name, self.path)
+            self._manifest = chunk_store.read_manifest(self.key, blob)
+            self.size = self._manifest["size"]
+            self._plaintext = None
+        elif self.seekable:
+            header = parse_header(self.header)
+            self.header = self.header[:header.size]
+            self._aad = header.aad
+            self.segment_size = header.segment_size
+            self.size = plaintext_size(stored_size, self.segment_size, header.size)
+            self._plaintext = None
         else:
-            print(f"   ⚠️ Could not verify file size")
-    else:
-        print(f"   ❌ Storage failed: {result.stderr}")
-        raise Exception(f"Failed to store encrypted file: {result.stderr}")
-    
-    return enc_filename
+            # Legacy Fernet blobs can't be decrypted piecewise
+            blob = get_storage().read(self.vault_name, self.path)
+            self._plaintext = b"".join(iter_decrypt(self.key, ChunkReader([blob])))
+            self.size = len(self._plaintext)
+    
+    def iter_range(self, start=0, end=None):
+        """Yield decrypted bytes [start, end), reading only the segments needed"""
+        end = self.size if end is None else end
+        if start >= end:
+            return
+        if self._plaintext is not None:
+            yield self._plaintext[start:end]
+            return
+        if self._manifest is not None:
+            yield from chunk_store.iter_manifest_range(self.vault_name, self.key, self._manifest, start, end)
+            return
+        
+        _, offset, count = segment_range(start, end, self.segment_size, len(self.header))
+        stream = get_storage().iter_read(self.vault_name, self.path, offset, count * (self.segment_size + TAG_SIZE))
+        chunks = metrics.TimedIter(stream)
+        plaintexts = metrics.TimedIter(iter_decrypt_range(self.key, self.header, ChunkReader(chunks),
+                                                          start, end, self.size, offload=get_crypto_pool()))
+        sent = 0
+        try:
+            try:
+                data = next(plaintexts, None)
+            except Exception:
+                # A segment stream reads the blob it opened to the end, so only
+                # its first segment can be from another blob than the header
+                stream.close()
+                self._check_unchanged()
+                raise
+            while data is not None:
+                sent += len(data)
+                yield data
+                data = next(plaintexts, None)
+        finally:
+            metrics.observe("span", chunks.seconds, span="storage_read")
+            metrics.observe("span", plaintexts.seconds - chunks.seconds, span="decrypt")
+            metrics.count("bytes_processed", sent, op="decrypt")
+    
+    def _check_unchanged(self):
+        """Raise if the blob was re-encrypted since the download opened"""
+        head = vault_read_range(self.vault_name, self.path, 0, MAX_HEADER_SIZE)
+        if is_legacy(head) or parse_header(head).aad != self._aad:
+            raise Exception(f"❌ {self.filename} was re-encrypted during the download, please try again")
+    
+    def close(self):
+        """Release the vault lock (idempotent)"""
+        if self._lock is not None:
+            self._lock.release_shared()
+            self._lock = None
 
+# ============ KEY ROTATION (JOURNALED ENVELOPE REWRAP) ============
+#
+# A rotation is recorded in keys/rotation.json before any file changes:
+# both keys, a cursor (every file up to it is done, in name order), the
+# files done past the cursor, and the old key slots of rewraps in flight.
+# While the journal exists both keys are valid and new files use the new
+# one, so rotation can stop at any point - a crash, or the end of a
+# scheduler tick's time budget - and resume without redoing finished work.
+# master.key only changes once every file is done.
 
-def decrypt_file_from_vault(filename, vault_name):
-    """Decrypt file from specific vault"""
-    print(f"\n🔥 DECRYPTING FILE")
-    print(f"   File: {filename}")
-    print(f"   Vault: {vault_name}")
-    
-    key = load_vault_key(vault_name)
-    f = Fernet(key)
-    
-    # Copy encrypted file from container to temp location - FIXED
-    temp_enc_path = f"/tmp/{filename}"
-    
-    result = subprocess.run([
-        "podman", "cp",
-        f"{vault_name}:/vault/data/{filename}",
-        temp_enc_path
-    ], capture_output=True, text=True)
-    
-    if result.returncode != 0:
-        raise Exception(f"❌ Failed to copy file from container: {result.stderr}")
-    
-    # Read the encrypted file
-    with open(temp_enc_path, "rb") as f_in:
-        encrypted_data = f_in.read()
-    
-    print(f"   Encrypted data size: {len(encrypted_data)} bytes")
-    
-    if not encrypted_data or len(encrypted_data) < 10:
-        raise Exception(f"❌ Encrypted file is empty or invalid: {filename}")
+class _Pacer:
+    """Paces any number of concurrent chunk streams to a shared bytes/sec budget"""
+    
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+    
+    def pace(self, chunks):
+        for chunk in chunks:
+            yield chunk
+            with self._lock:
+                now = time.monotonic()
+                self._next = max(self._next, now) + len(chunk) / self.bytes_per_sec
+                delay = self._next - now
+            if delay > 0:
+                time.sleep(delay)
+
+_io_pacer = _Pacer(ROTATION_IO_RATE) if ROTATION_IO_RATE > 0 else None
+
+_crypto_pool = None
+_crypto_pool_lock = threading.Lock()
+
+def _get_crypto_pool():
+    """Shared pool for segment re-encryption (AES-GCM releases the GIL)"""
+    global _crypto_pool
+    with _crypto_pool_lock:
+        if _crypto_pool is None:
+            _crypto_pool = ThreadPoolExecutor(max_workers=ROTATION_CRYPTO_WORKERS,
+                                              thread_name_prefix="rotation-crypto")
+        return _crypto_pool
+
+def _bounded_map(executor, fn, items, window):
+    """Order-preserving executor map with at most ``window`` items in flight"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _reencrypt_vault_file(vault_name, filename, old_keys, new_key, pacer=None):
+    """Re-encrypt one vault file in constant memory with a fresh data key"""
+    path = f"data/{filename}"
+    
+    # Read and write run on separate channels; the backend only replaces the
+    # original once the new blob has been written completely. Segments are
+    # converted by worker processes (PODVAULT_CRYPTO_PROCESSES) or else the
+    # rotation thread pool, while this thread keeps the I/O moving.
+    chunks = get_storage().iter_read(vault_name, path)
+    if pacer:
+        chunks = pacer.pace(chunks)
+    if _io_pacer:
+        chunks = _io_pacer.pace(chunks)
+    pool = _get_crypto_pool()
+    def map_segments(fn, segments):
+        return _bounded_map(pool, fn, segments, ROTATION_CRYPTO_WORKERS * 2)
+    size, _ = get_storage().write(vault_name, path, iter_reencrypt(old_keys, new_key, ChunkReader(chunks),
+                                                                  map_segments, offload=get_crypto_pool()))
+    return size
+
+
+def _read_journal(vault_name):
+    """The vault's rotation journal, or None if no rotation is in progress"""
+    if "rotation.json" not in get_storage().list(vault_name, "keys"):
+        return None
+    return json.loads(get_storage().read(vault_name, ROTATION_JOURNAL))
+
+def _save_journal(vault_name, journal):
+    # Storage writes are atomic (temp file + rename): a crash leaves the
+    # previous journal or this one, never a mix
+    get_storage().write(vault_name, ROTATION_JOURNAL, [json.dumps(journal, indent=1).encode()])
+
+def _advance_cursor(journal, files):
+    """Fold files done in name order into the cursor"""
+    done = set(journal["done"])
+    cursor = journal["cursor"]
+    for filename in files:
+        if filename <= cursor:
+            continue
+        if filename not in done:
+            break
+        cursor = filename
+        done.discard(filename)
+    journal["cursor"], journal["done"] = cursor, sorted(done)
+
+def _remaining_files(journal, files):
+    done = set(journal["done"])
+    return [name for name in files if name > journal["cursor"] and name not in done]
+
+def _begin_rotation(vault_name, deep):
+    """Resume the vault's rotation journal, or start one (vault lock held exclusively)"""
+    old_key_data = get_storage().read(vault_name, "keys/master.key").decode().strip()
+    old_key = old_key_data.encode()
+    Fernet(old_key)  # Validate before touching any files
+    
+    journal = _read_journal(vault_name)
+    if journal and journal["new_key"].encode() == old_key:
+        # The last rotation committed but stopped before dropping its journal
+        get_storage().remove(vault_name, ROTATION_JOURNAL)
+        journal = None
+    if journal:
+        if journal["old_key"].encode() != old_key:
+            raise Exception("Rotation journal doesn't match master.key")
+        if journal["deep"] != deep:
+            log.info(f"   Finishing the {'deep ' if journal['deep'] else ''}rotation already in progress")
+        log.info(f"   Resuming rotation started {journal['started']} "
+              f"(cursor {journal['cursor'] or '-'}, {len(journal['done'])} more done)")
+        return journal
+    
+    log.debug(f"   Old key loaded: {old_key_data[:20]}...")
+    new_key = Fernet.generate_key()
+    log.debug(f"   New key generated: {new_key.decode()[:20]}...")
     
+    # Archive the old key up front; until the rotation commits it also
+    # lives in the journal
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     try:
-        decrypted = f.decrypt(encrypted_data)
-        print(f"   ✅ Decrypted size: {len(decrypted)} bytes")
+        get_storage().write(vault_name, f"keys/archive/key_{timestamp}.old", [old_key + b"\n"])
     except Exception as e:
-        print(f"   ❌ Decryption failed: {str(e)}")
-        print(f"   Key being used: {key[:20]}...")
+        log.warning(f"⚠️ Failed to archive old key for {vault_name}: {e}")
+    
+    journal = {
+        "old_key": old_key.decode(),
+        "new_key": new_key.decode(),
+        "deep": deep,
+        "started": datetime.now().isoformat(timespec="seconds"),
+        "cursor": "",
+        "done": [],
+        "pending": {},
+    }
+    _save_journal(vault_name, journal)
+    return journal
+
+def _recover_pending(vault_name, journal, keys):
+    """Put back key slots that an interrupted in-place rewrap may have torn"""
+    for filename, slot in journal["pending"].items():
+        path = f"data/{filename}"
+        with file_lock(vault_name, filename).exclusive(ROTATION_LOCK_TIMEOUT):
+            try:
+                head = vault_read_range(vault_name, path, 0, MAX_HEADER_SIZE)
+            except Exception:
+                continue  # Gone since
+            try:
+                file_key(keys, parse_header(head))
+            except Exception:
+                get_storage().patch(vault_name, path, KEY_SLOT_OFFSET, base64.b64decode(slot))
+                log.info(f"  🩹 Restored key slot of {filename}")
+    journal["pending"] = {}
+
+def _claim_file(vault_name, filename, new_key, deep):
+    """Lock a file for rotation and decide what it needs
+
+    Returns (action, header bytes, lock). action is None when there is
+    nothing to do (empty, or already under new_key - e.g. uploaded during
+    the rotation) and the lock is then already released; otherwise it is
+    'rewrapped' or 're-encrypted' and the caller must release the lock.
+    """
+    lock = file_lock(vault_name, filename)
+    lock.acquire_exclusive(ROTATION_LOCK_TIMEOUT)
+    try:
+        path = f"data/{filename}"
+        size, _ = get_storage().stat(vault_name, path)
+        head = vault_read_range(vault_name, path, 0, MAX_HEADER_SIZE) if size else b""
+        header = None if not head or is_legacy(head) else parse_header(head)
+        if not size or (header and header.version == 2 and header.key_id == key_id(new_key)):
+            action = None
+        elif header and header.version == 2 and not deep:
+            action = "rewrapped"
+        else:
+            action = "re-encrypted"
+    except BaseException:
+        lock.release_exclusive()
         raise
-    finally:
-        # Clean up temp encrypted file
-        if os.path.exists(temp_enc_path):
-            os.remove(temp_enc_path)
-    
-    # Save decrypted file temporarily for download
-    dec_path = f"/tmp/{filename.replace('.enc', '')}"
-    with open(dec_path, "wb") as f_out:
-        f_out.write(decrypted)
-    
-    print(f"   💾 Saved to: {dec_path}")
-    return dec_path
+    if action is None:
+        lock.release_exclusive()
+    return action, head, lock
+
+_FILE_SPANS = {"rewrapped": "rotation_file_rewrap", "re-encrypted": "rotation_file_reencrypt"}
+
+def _rotate_batch(vault_name, batch, journal, keys, new_key, deep, pacer, executor, counts, updates):
+    """Rotate a batch of files; returns how many failed
 
-# ============ KEY ROTATION WITH RE-ENCRYPTION ============
+    Files now under new_key are added to ``updates`` for the file index.
 
-def rotate_vault_key(vault_name):
-    """Rotate encryption key for specific vault and re-encrypt all files"""
+    Version 2 blobs only get their wrapped data key rewritten in place. Their
+    current key slots are journaled first, so a rewrap torn by a crash can be
+    undone. Older formats (and every file in deep mode) are re-encrypted in
+    full into a temp file that replaces the original when complete.
+    """
+    def claim(filename):
+        try:
+            return _claim_file(vault_name, filename, new_key, deep), None
+        except Exception as e:
+            return None, e
+    
+    failures = 0
+    claimed = {}
+    for filename, (result, error) in zip(batch, executor.map(claim, batch)):
+        if isinstance(error, VaultBusy):
+            log.info(f"  ⏭️ {filename} is in use, leaving it for next time")
+        elif error:
+            log.error(f"  ❌ Error rotating {filename}: {error}")
+            failures += 1
+        elif result[0] is None:
+            journal["done"].append(filename)
+            updates[filename] = (None, None)
+            log.debug(f"  ⚠️ Nothing to rotate: {filename}, skipping")
+        else:
+            claimed[filename] = result
     
-    print(f"🔄 Starting key rotation for {vault_name}...")
+    def apply(filename):
+        action, head, _ = claimed[filename]
+        started = time.perf_counter()
+        try:
+            if action == "rewrapped":
+                get_storage().patch(vault_name, f"data/{filename}", KEY_SLOT_OFFSET,
+                                    rewrap_key_slot(head, keys, new_key))
+                return (None, None), None
+            size = _reencrypt_vault_file(vault_name, filename, keys, new_key, pacer)
+            metrics.count("bytes_processed", size, op="reencrypt")
+            if not is_legacy(head) and parse_header(head).flags & FLAG_MANIFEST:
+                return (size, None), None  # A manifest's size says nothing about the file's
+            # Re-encryption keeps the segment size (Fernet blobs get the default)
+            segment_size = DEFAULT_SEGMENT_SIZE if is_legacy(head) else parse_header(head).segment_size
+            return (size, plaintext_size(size, segment_size, HEADER_SIZE)), None
+        except Exception as e:
+            return None, e
+        finally:
+            metrics.observe("span", time.perf_counter() - started, span=_FILE_SPANS[action])
     
-    # 1. Load old key
     try:
-        old_key_data = subprocess.run([
-            "podman", "exec", vault_name,
-            "cat", "/vault/keys/master.key"
-        ], capture_output=True, text=True, check=True).stdout.strip()
+        slots = {name: base64.b64encode(head[KEY_SLOT_OFFSET:parse_header(head).size]).decode()
+                 for name, (action, head, _) in claimed.items() if action == "rewrapped"}
+        if slots:
+            journal["pending"].update(slots)
+            _save_journal(vault_name, journal)
         
-        old_key = old_key_data.encode()
-        old_fernet = Fernet(old_key)
-        print(f"   Old key loaded: {old_key_data[:20]}...")
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Failed to load key for {vault_name}: {e}")
-        return False
-    
-    # 2. Generate new key
-    new_key = Fernet.generate_key()
-    new_fernet = Fernet(new_key)
-    print(f"   New key generated: {new_key.decode()[:20]}...")
+        for filename, (update, error) in zip(claimed, executor.map(apply, claimed)):
+            action = claimed[filename][0]
+            if error:
+                # A failed rewrap stays pending; the next resume checks it
+                log.error(f"  ❌ Error rotating {filename}: {error}")
+                failures += 1
+                continue
+            journal["pending"].pop(filename, None)
+            journal["done"].append(filename)
+            updates[filename] = update
+            counts[action] += 1
+            log.debug(f"  ✅ {action.capitalize()}: {filename}")
+    finally:
+        for _, _, lock in claimed.values():
+            lock.release_exclusive()
+    return failures
+
+def rotate_vault_key(vault_name, deep=False):
+    """Rotate encryption key for specific vault, rewrapping each file's data key
+
+    Journaled and resumable: each call works for at most ROTATION_TICK_SECONDS
+    and later calls pick up where it stopped. Files are rotated
+    ROTATION_FILE_WORKERS at a time under their own locks, so user traffic
+    keeps flowing; the vault's key lock is only taken to start and to commit.
+    With deep=True every file is fully re-encrypted under a fresh data key,
+    paced to DEEP_REENCRYPT_RATE bytes/sec for the whole vault.
+
+    Returns True once the rotation has committed, False on failure and None
+    if it will continue on a later call (or the vault was busy).
+    """
+    return {"ok": True, "failed": False}.get(_rotate_vault_key(vault_name, deep))
+
+def _rotate_vault_key(vault_name, deep):
+    """Returns 'ok', 'partial' (more to do next time), 'failed' or 'skipped'"""
+    try:
+        with rotation_slot(vault_name):
+            return _rotation_tick(vault_name, deep)
+    except VaultBusy as e:
+        log.info(f"⏭️ Skipping {vault_name}: {e}")
+        return "skipped"
+
+def _rotation_tick(vault_name, deep):
+    deadline = time.monotonic() + ROTATION_TICK_SECONDS
+    log.info(f"🔄 Starting {'deep ' if deep else ''}key rotation for {vault_name}...")
     
-    # 3. Get all encrypted files
+    # 1. Start or resume the journal
     try:
-        files_output = subprocess.run([
-            "podman", "exec", vault_name,
-            "ls", "/vault/data"
-        ], capture_output=True, text=True, check=True).stdout.strip()
-        
-        if not files_output:
-            print(f"⚠️ No files in {vault_name}, skipping re-encryption")
-            files = []
-        else:
-            files = [f for f in files_output.split('\n') if f.strip()]
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Failed to list files in {vault_name}: {e}")
-        return False
+        with vault_lock(vault_name).exclusive(ROTATION_LOCK_TIMEOUT):
+            get_key_cache().invalidate(vault_name)
+            journal = _begin_rotation(vault_name, deep)
+            # Before any file is listed, so other processes' uploads either
+            # landed already or find out (_check_key_still_current)
+            keys_changed(vault_name)
+            get_key_cache().put(vault_name, [journal["new_key"].encode(), journal["old_key"].encode()],
+                                key_epoch(vault_name))
+    except VaultBusy:
+        raise
+    except Exception as e:
+        log.error(f"❌ Failed to start key rotation for {vault_name}: {e}")
+        return "failed"
+    old_key, new_key = journal["old_key"].encode(), journal["new_key"].encode()
+    keys = [old_key, new_key]
+    deep = journal["deep"]
     
-    # 4. Re-encrypt each file
-    re_encrypted_count = 0
-    for filename in files:
-        if not filename.endswith('.enc'):
-            continue
+    # 2. Get all encrypted files
+    try:
+        if journal["pending"]:
+            _recover_pending(vault_name, journal, keys)
+            _save_journal(vault_name, journal)
+        files = sorted([name for name in get_storage().list(vault_name, "data") if name.endswith('.enc')]
+                       + chunk_store.list_chunk_blobs(vault_name))
         
-        try:
-            # Read encrypted file
-            encrypted_data = subprocess.run([
-                "podman", "exec", vault_name,
-                "cat", f"/vault/data/{filename}"
-            ], capture_output=True, check=True).stdout
-            
-            if not encrypted_data:
-                print(f"  ⚠️ Empty file: {filename}, skipping")
-                continue
-            
-            # Decrypt with old key
-            plaintext = old_fernet.decrypt(encrypted_data)
-            
-            # Re-encrypt with new key
-            new_encrypted = new_fernet.encrypt(plaintext)
-            
-            # Write back to container
-            subprocess.run([
-                "podman", "exec", vault_name,
-                "sh", "-c", f"cat > /vault/data/{filename}"
-            ], input=new_encrypted, check=True)
-            
-            re_encrypted_count += 1
-            print(f"  ✅ Re-encrypted: {filename}")
-            
-        except Exception as e:
-            print(f"  ❌ Error re-encrypting {filename}: {e}")
-            continue
+        if not files:
+            log.info(f"⚠️ No files in {vault_name}, skipping re-encryption")
+    except VaultBusy:
+        raise
+    except Exception as e:
+        log.error(f"❌ Failed to list files in {vault_name}: {e}")
+        return "failed"
+    
+    # 3. Rewrap (or re-encrypt) the files not done yet, batch by batch until
+    # the tick's time is up
+    # A re-encryption holds a read and a write stream at once; stay within
+    # what the backend can open so workers can't deadlock on each other
+    workers = ROTATION_FILE_WORKERS
+    max_streams = get_storage().max_streams
+    if max_streams:
+        workers = max(1, min(workers, max_streams // 2 if deep else max_streams))
+    
+    pacer = _Pacer(DEEP_REENCRYPT_RATE) if deep and DEEP_REENCRYPT_RATE > 0 else None
+    todo = _remaining_files(journal, files)
+    counts = {"rewrapped": 0, "re-encrypted": 0}
+    failures = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for start in range(0, len(todo), ROTATION_BATCH):
+                if time.monotonic() >= deadline:
+                    break
+                batch = todo[start:start + ROTATION_BATCH]
+                updates = {}
+                failures += _rotate_batch(vault_name, batch, journal, keys, new_key, deep,
+                                          pacer, executor, counts, updates)
+                _advance_cursor(journal, files)
+                _save_journal(vault_name, journal)
+                record_rotation(vault_name, key_id(new_key).hex(), updates)
+    except Exception as e:
+        log.error(f"❌ Failed to save rotation progress for {vault_name}: {e}")
+        return "failed"
     
-    # 5. Archive old key
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    remaining = _remaining_files(journal, files)
+    if remaining:
+        log.info(f"⏸️ Key rotation for {vault_name} paused with {len(remaining)} files left "
+              f"({counts['rewrapped']} rewrapped, {counts['re-encrypted']} re-encrypted)")
+        return "failed" if failures else "partial"
+    
+    # 4. Commit: the new key becomes master.key, then the journal goes
     try:
-        subprocess.run([
-            "podman", "exec", vault_name,
-            "sh", "-c", 
-            f"mkdir -p /vault/keys/archive && "
-            f"echo '{old_key_data}' > /vault/keys/archive/key_{timestamp}.old"
-        ], check=True)
-    except subprocess.CalledProcessError as e:
-        print(f"⚠️ Failed to archive old key for {vault_name}: {e}")
-    
-    # 6. Save new key as active
+        with vault_lock(vault_name).exclusive(ROTATION_LOCK_TIMEOUT):
+            get_key_cache().invalidate(vault_name)
+            get_storage().write(vault_name, "keys/master.key", [new_key + b"\n"])
+            get_storage().remove(vault_name, ROTATION_JOURNAL)
+        log.debug(f"   ✅ New key saved")
+    except VaultBusy as e:
+        log.info(f"⏸️ Key rotation for {vault_name} will commit next time: {e}")
+        return "partial"
+    except Exception as e:
+        log.error(f"❌ Failed to save new key for {vault_name}: {e}")
+        return "failed"
     try:
-        subprocess.run([
-            "podman", "exec", vault_name,
-            "sh", "-c", f"echo '{new_key.decode()}' > /vault/keys/master.key"
-        ], check=True)
-        print(f"   ✅ New key saved")
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Failed to save new key for {vault_name}: {e}")
-        return False
-    
-    print(f"✅ Key rotation completed for {vault_name} ({re_encrypted_count} files re-encrypted)")
-    return True
-
-def rotate_all_vaults():
-    """Rotate keys for all active vaults"""
-    print("\n🔄 Starting key rotation for all vaults...")
+        # Caches elsewhere still hold the old key; the new one stays valid either way
+        keys_changed(vault_name)
+        get_key_cache().put(vault_name, [new_key], key_epoch(vault_name))
+    except Exception as e:
+        log.warning(f"⚠️ Failed to announce the new key of {vault_name}: {e}")
     
+    log.info(f"✅ Key rotation completed for {vault_name} "
+          f"({counts['rewrapped']} rewrapped, {counts['re-encrypted']} re-encrypted)")
+    return "ok"
+
+def _timed_rotation(vault_name, deep):
+    started = time.monotonic()
     try:
-        result = subprocess.run([
-            "podman", "ps", 
-            "--filter", "name=vault_",
-            "--format", "{{.Names}}"
-        ], capture_output=True, text=True, check=True)
-        
-        vault_names = [v.strip() for v in result.stdout.strip().split('\n') 
-                      if v.strip() and v.strip().startswith('vault_')]
-        
-        if not vault_names:
-            print("⚠️ No active vaults found")
-            return
-        
-        print(f"📦 Found {len(vault_names)} active vaults")
-        
-        success_count = 0
-        for vault_name in vault_names:
-            if rotate_vault_key(vault_name):
-                success_count += 1
-        
-        print(f"\n✅ Key rotation completed: {success_count}/{len(vault_names)} vaults successful")
-        
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Failed to list vaults: {e}")
\ No newline at end of file
+        status = _rotate_vault_key(vault_name, deep)
+    except Exception as e:
+        log.error(f"❌ Key rotation crashed for {vault_name}: {e}")
+        status = "failed"
+    seconds = time.monotonic() - started
+    metrics.count("rotations", status=status)
+    if status != "skipped":
+        stats.add("rotations", vault_name, total=int(seconds * 1000))
+        metrics.observe("span", seconds, span="rotation_vault")
+    return {"status": status, "seconds": round(seconds, 3)}
+
+def _rotate_container(container, vaults, asleep):
+    """Rotate the vaults of one container, {vault_name: deep} (a shard's tenants go one at a time)"""
+    started = time.monotonic()
+    results = {vault_name: _timed_rotation(vault_name, deep) for vault_name, deep in vaults.items()}
+    if asleep:
+        # Woken only for rotation - back to sleep unless its owner showed up meanwhile
+        hibernate_vault(container, idle_since=started)
+    return results
+
+def rotate_vaults(vaults):
+    """Rotate {vault_name: deep}, ROTATION_WORKERS containers at a time
+
+    Hibernated vaults are included: storage wakes them if it needs to, and
+    they are stopped again once their rotation is done. Tenants sharing a
+    shard container are rotated one after another, so there is one task
+    per container. Returns {vault_name: {"status", "seconds"}} with status
+    "ok", "partial" (continues next tick), "failed" or "skipped" (vault busy).
+    """
+    asleep = set(list_vault_containers(all=True)) - set(list_vault_containers())
+    by_container = {}
+    for vault_name, deep in vaults.items():
+        by_container.setdefault(vault_container(vault_name), {})[vault_name] = deep
+    log.info(f"📦 Rotating {len(vaults)} vaults in {len(by_container)} containers, "
+          f"{len(asleep & set(by_container))} hibernated ({ROTATION_WORKERS} workers)")
+    
+    results = {}
+    with ThreadPoolExecutor(max_workers=ROTATION_WORKERS, thread_name_prefix="rotation") as executor:
+        futures = [executor.submit(_rotate_container, container, members, container in asleep)
+                   for container, members in by_container.items()]
+        for future in as_completed(futures):
+            results.update(future.result())
+    return results
+
+def rotate_all_vaults(deep=False):
+    """Rotate keys for all vaults at once (see rotate_vaults)
+
+    The scheduler goes through rotation_planner instead, which only
+    rotates the vaults their policy makes due.
+
+    Returns a report: {"wall_time": seconds, "vaults": {name: {"status", "seconds"}}}.
+    """
+    log.info(f"🔄 Starting {'deep ' if deep else ''}key rotation for all vaults...")
+    started = time.monotonic()
+    report = {"wall_time": 0.0, "vaults": {}}
+    
+    try:
+        vault_names = list_vaults(all=True)
+    except Exception as e:
+        log.error(f"❌ Failed to list vaults: {e}")
+        return report
+    
+    if not vault_names:
+        log.warning("⚠️ No vaults found")
+        return report
+    
+    try:
+        report["vaults"] = rotate_vaults(dict.fromkeys(vault_names, deep))
+    except Exception as e:
+        log.error(f"❌ Failed to list vault containers: {e}")
+        return report
+    report["wall_time"] = round(time.monotonic() - started, 3)
+    
+    results = report["vaults"]
+    by_status = {status: sum(1 for r in results.values() if r["status"] == status)
+                 for status in ("ok", "partial", "skipped")}
+    log.info(f"✅ Key rotation completed: {by_status['ok']}/{len(vault_names)} vaults successful, "
+          f"{by_status['partial']} in progress, {by_status['skipped']} skipped, "
+          f"{report['wall_time']:.2f}s wall time")
+    slowest = sorted(results.items(), key=lambda item: item[1]["seconds"], reverse=True)
+    for vault_name, result in slowest[:10]:
+        log.info(f"   ⏱️ {vault_name}: {result['status']} in {result['seconds']:.2f}s")
+    return report
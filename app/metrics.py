@@ -0,0 +1,154 @@
+"""Timing spans, counters and gauges for vault operations, served at /metrics.
+
+    with metrics.span("key_load"):
+        ...
+
+adds the block's duration to the podvault_span_seconds histogram under
+span="key_load". Streaming phases that interleave (reading an upload,
+encrypting it, writing it to the vault) are measured with TimedIter and
+recorded with ``observe``. Spans:
+
+    key_load          vault keys read from storage (key cache misses)
+    upload_read       receiving an upload's plaintext from the client
+    encrypt, decrypt  segment crypto of uploads and downloads
+    dedup_chunks      chunking, compressing and storing a deduplicated upload
+    verify            hashing the stored blob and checking it
+    storage_write     writing a blob to the vault (podman exec agent, volume, ...)
+    storage_read      reading a blob from the vault for a download
+    agent_<command>   one vault agent round trip (stat, list, read, ...)
+    agent_start       starting a vault agent (podman exec)
+    db_commit         committing file index rows for a request
+    audit_write       one batch of the audit writer
+    rotation_file_rewrap, rotation_file_reencrypt   one file of a rotation
+    rotation_vault    one rotation tick of one vault
+
+Everything is kept in memory per process and rendered in the Prometheus
+text format; with several app processes, scrape each of them.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+            1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+_HELP = {
+    "podvault_span_seconds": "Time spent in each phase of vault operations",
+    "podvault_request_seconds": "Time to handle a web request until its response starts, by endpoint",
+    "podvault_bytes_processed_total": "Bytes encrypted, decrypted (plaintext) or re-encrypted (stored blobs)",
+    "podvault_actions_total": "Audited vault actions, by action and status",
+    "podvault_rotations_total": "Vault key rotation ticks, by outcome",
+}
+
+_lock = threading.Lock()
+_histograms = {}  # name -> {labels: [bucket counts..., sum, count]}
+_counters = {}    # name -> {labels: value}
+_gauges = {}      # name -> (help, fn returning {labels: value} or a number)
+
+
+def observe(name, seconds, **labels):
+    """Add a duration to the podvault_<name>_seconds histogram"""
+    key = tuple(sorted(labels.items()))
+    index = bisect_left(_BUCKETS, seconds)
+    with _lock:
+        series = _histograms.setdefault(f"podvault_{name}_seconds", {})
+        values = series.get(key)
+        if values is None:
+            values = series[key] = [0] * len(_BUCKETS) + [0.0, 0]
+        if index < len(_BUCKETS):
+            values[index] += 1
+        values[-2] += seconds
+        values[-1] += 1
+
+@contextmanager
+def span(name):
+    """Time a block into podvault_span_seconds{span=name}"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("span", time.perf_counter() - started, span=name)
+
+def count(name, amount=1, **labels):
+    """Add to the podvault_<name>_total counter"""
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        series = _counters.setdefault(f"podvault_{name}_total", {})
+        series[key] = series.get(key, 0) + amount
+
+def gauge(name, help, fn):
+    """Report fn() as podvault_<name> at each scrape
+
+    fn returns a number, or {label value: number} for a gauge labelled by
+    its ``kind``; None leaves the gauge out.
+    """
+    _gauges[f"podvault_{name}"] = (help, fn)
+
+
+class TimedIter:
+    """Wraps an iterator, adding up the time spent producing its items"""
+
+    def __init__(self, iterable):
+        self._it = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return next(self._it)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+def _labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        histograms = {name: {key: list(values) for key, values in series.items()}
+                      for name, series in _histograms.items()}
+        counters = {name: dict(series) for name, series in _counters.items()}
+
+    for name, series in sorted(histograms.items()):
+        lines += [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} histogram"]
+        for key, values in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket in zip(_BUCKETS, values):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{_labels(key + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(key + (('le', '+Inf'),))} {values[-1]}")
+            lines.append(f"{name}_sum{_labels(key)} {_number(values[-2])}")
+            lines.append(f"{name}_count{_labels(key)} {values[-1]}")
+
+    for name, series in sorted(counters.items()):
+        lines += [f"# HELP {name} {_HELP.get(name, name)}", f"# TYPE {name} counter"]
+        for key, value in sorted(series.items()):
+            lines.append(f"{name}{_labels(key)} {_number(value)}")
+
+    for name, (help, fn) in sorted(_gauges.items()):
+        try:
+            value = fn()
+        except Exception:
+            continue
+        if value is None:
+            continue
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+        if isinstance(value, dict):
+            for kind, number in sorted(value.items()):
+                lines.append(f"{name}{_labels((('kind', kind),))} {_number(number)}")
+        else:
+            lines.append(f"{name} {_number(value)}")
+    return "\n".join(lines) + "\n"
@@ -18,3 +18,86 @@ class AuditLog(db.Model):
     ip_address = db.Column(db.String(50))  # NEW: Security audit
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='success')  # NEW: Track failures
+
+    # Activity listings page newest-first per user, per vault or app-wide
+    # (which is also the order retention compaction goes in)
+    __table_args__ = (
+        db.Index('ix_audit_user_time', 'user', 'timestamp', 'id'),
+        db.Index('ix_audit_vault_time', 'vault_name', 'timestamp', 'id'),
+        db.Index('ix_audit_time', 'timestamp', 'id'),
+    )
+
+class VaultFile(db.Model):
+    """Index of the files stored in each vault, kept in step with uploads,
+    deletes and key rotation (and repaired by the reconciler)"""
+    id = db.Column(db.Integer, primary_key=True)
+    vault_name = db.Column(db.String(100), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)  # Stored name, e.g. report.pdf.enc
+    plaintext_size = db.Column(db.BigInteger)  # None until known (legacy blobs)
+    ciphertext_size = db.Column(db.BigInteger)
+    content_hash = db.Column(db.String(64))  # sha256 of the plaintext, None if not seen on upload
+    key_version = db.Column(db.String(16))  # Id of the master key wrapping the file's data key
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    rotated_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('vault_name', 'filename', name='uq_vault_file_name'),
+        db.Index('ix_vault_file_updated', 'vault_name', 'updated_at'),
+        db.Index('ix_vault_file_size', 'vault_name', 'plaintext_size'),
+    )
+
+class StatRollup(db.Model):
+    """Hourly totals of one dashboard metric, per vault ('' for app-wide)"""
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(32), nullable=False)
+    vault_name = db.Column(db.String(100), nullable=False, default='')
+    hour = db.Column(db.DateTime, nullable=False)  # Start of the hour (UTC)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+    total = db.Column(db.BigInteger, nullable=False, default=0)  # Bytes, milliseconds, ...
+
+    __table_args__ = (
+        db.UniqueConstraint('metric', 'vault_name', 'hour', name='uq_stat_rollup'),
+        db.Index('ix_stat_rollup_hour', 'metric', 'hour'),
+    )
+
+class StatCounter(db.Model):
+    """App-wide running total (users, audit entries ever recorded, ...)"""
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+class VaultRotation(db.Model):
+    """Key rotation policy and state of one vault (see app/rotation_planner.py)"""
+    vault_name = db.Column(db.String(100), primary_key=True)
+    key_issued_at = db.Column(db.DateTime, default=datetime.utcnow)  # When master.key last changed (or first seen)
+    due_at = db.Column(db.DateTime)  # Jittered max-age deadline
+    writes = db.Column(db.BigInteger, nullable=False, default=0)  # Files stored under the current key
+    bytes_written = db.Column(db.BigInteger, nullable=False, default=0)
+    requested = db.Column(db.String(8))  # 'rotate' or 'deep' when asked for outside the policy
+    in_progress = db.Column(db.Boolean, nullable=False, default=False)  # Journal left for the next tick
+    retry_at = db.Column(db.DateTime)  # Set after a failure
+    last_seconds = db.Column(db.Float)  # Duration of the last rotation tick
+    # Policy overrides; None uses PODVAULT_ROTATION_MAX_AGE_HOURS / _MAX_BYTES
+    max_age_hours = db.Column(db.Float)
+    max_bytes = db.Column(db.BigInteger)
+
+class JobLease(db.Model):
+    """Lease on a background job or a vault, held by one app process at a time
+    (see app/job_leases.py)"""
+    name = db.Column(db.String(150), primary_key=True)  # job:<id>, vault:<name>, worker:<owner>, or <name>/<holder> if shared
+    owner = db.Column(db.String(100), nullable=False)  # host:pid:nonce of the holding process
+    acquired_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    last_run_at = db.Column(db.DateTime)  # Jobs: when the holder last finished a run
+    last_status = db.Column(db.String(20))  # Jobs: 'ok' or 'failed'
+
+    __table_args__ = (
+        db.Index('ix_job_lease_owner', 'owner'),
+    )
+
+class VaultKeyEpoch(db.Model):
+    """Bumped whenever a vault's keys change, so every app process drops its
+    cached copy (see app/key_cache.py)"""
+    vault_name = db.Column(db.String(100), primary_key=True)
+    epoch = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,339 @@
+import asyncio
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import tarfile
+from urllib.parse import quote, urlencode
+
+API_VERSION = "v4.0.0"
+POOL_SIZE = int(os.environ.get("PODVAULT_PODMAN_POOL", "8"))
+READ_SIZE = 64 * 1024
+
+
+def default_socket_path():
+    """Podman socket from PODMAN_SOCKET, else the rootless or rootful default"""
+    if os.environ.get("PODMAN_SOCKET"):
+        return os.environ["PODMAN_SOCKET"]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.exists(f"{runtime_dir}/podman/podman.sock"):
+        return f"{runtime_dir}/podman/podman.sock"
+    return "/run/podman/podman.sock"
+
+
+class PodmanAPIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Podman API error {status}: {message}")
+        self.status = status
+
+
+def _url(path, params=None):
+    url = f"/{API_VERSION}/libpod{path}"
+    if params:
+        url += "?" + urlencode({k: json.dumps(v) if isinstance(v, (dict, list)) else v
+                                for k, v in params.items()})
+    return url
+
+
+def _parse(status, data, ok, parse):
+    if status not in ok:
+        try:
+            message = json.loads(data).get("message", data)
+        except Exception:
+            message = data[:200]
+        raise PodmanAPIError(status, message)
+    if parse == "json":
+        return json.loads(data) if data else None
+    if parse == "exists":
+        return status == 204
+    if parse == "raw":
+        return data
+    return None
+
+
+def tar_single_file(name, data, mode=0o600):
+    """Build an in-memory tar holding one file, for put_archive"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = mode
+        tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class _Endpoints:
+    """libpod endpoints shared by the sync and asyncio clients
+
+    Each method returns whatever ``_call`` returns - a value for the sync
+    client, an awaitable for the async one.
+    """
+
+    def list_containers(self, name_filter=None, all=True):
+        params = {"all": "true" if all else "false"}
+        if name_filter:
+            params["filters"] = {"name": [name_filter]}
+        return self._call("GET", "/containers/json", params)
+
+    def container_exists(self, name):
+        return self._call("GET", f"/containers/{quote(name)}/exists", ok=(204, 404), parse="exists")
+
+    def inspect_container(self, name):
+        return self._call("GET", f"/containers/{quote(name)}/json")
+
+    def create_container(self, name, image, command, volumes=(), labels=None):
+        spec = {
+            "name": name,
+            "image": image,
+            "command": list(command),
+            "volumes": [{"Name": vol, "Dest": dest} for vol, dest in volumes],
+            "labels": labels or {},
+        }
+        return self._call("POST", "/containers/create", body=spec, ok=(201,))
+
+    def start_container(self, name):
+        return self._call("POST", f"/containers/{quote(name)}/start", ok=(204, 304), parse=None)
+
+    def stop_container(self, name, timeout=10):
+        return self._call("POST", f"/containers/{quote(name)}/stop", {"timeout": timeout},
+                          ok=(204, 304, 404), parse=None)
+
+    def remove_container(self, name, force=True):
+        return self._call("DELETE", f"/containers/{quote(name)}", {"force": "true" if force else "false"},
+                          ok=(200, 204, 404), parse=None)
+
+    def rename_container(self, name, new_name):
+        return self._call("POST", f"/containers/{quote(name)}/rename", {"name": new_name},
+                          ok=(204,), parse=None)
+
+    def create_volume(self, name, labels=None):
+        return self._call("POST", "/volumes/create", body={"Name": name, "Labels": labels or {}},
+                          ok=(201, 409), parse=None)
+
+    def inspect_volume(self, name):
+        return self._call("GET", f"/volumes/{quote(name)}/json")
+
+    def remove_volume(self, name, force=True):
+        return self._call("DELETE", f"/volumes/{quote(name)}", {"force": "true" if force else "false"},
+                          ok=(204, 404), parse=None)
+
+    def image_exists(self, reference):
+        return self._call("GET", f"/images/{quote(reference, safe='')}/exists",
+                          ok=(204, 404), parse="exists")
+
+    def pull_image(self, reference):
+        return self._call("POST", "/images/pull", {"reference": reference}, parse="raw")
+
+    def get_archive(self, name, path, fileobj):
+        """Write a tar of ``path`` inside the container to fileobj as it arrives"""
+        return self._call("GET", f"/containers/{quote(name)}/archive", {"path": path},
+                          parse=None, sink=fileobj)
+
+    def put_archive(self, name, path, data):
+        """Extract a tar (bytes or an iterable of chunks) at ``path``"""
+        return self._call("PUT", f"/containers/{quote(name)}/archive", {"path": path},
+                          body=data, ok=(200,), parse=None)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class PodmanClient(_Endpoints):
+    """Blocking libpod client with a pool of keep-alive unix-socket connections"""
+
+    def __init__(self, socket_path=None, pool_size=POOL_SIZE, timeout=60):
+        self.socket_path = socket_path or default_socket_path()
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(None)
+
+    def _checkout(self):
+        conn = self._pool.get()
+        return conn or UnixHTTPConnection(self.socket_path, self.timeout)
+
+    def _checkin(self, conn):
+        self._pool.put(conn)
+
+    def _send(self, conn, method, url, body):
+        headers = {}
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        if body is None or isinstance(body, (bytes, bytearray)):
+            conn.request(method, url, body=body, headers=headers)
+        else:
+            headers["Content-Type"] = "application/x-tar"
+            conn.request(method, url, body=body, headers=headers, encode_chunked=True)
+        return conn.getresponse()
+
+    def _call(self, method, path, params=None, body=None, ok=(200,), parse="json", sink=None):
+        url = _url(path, params)
+        conn = self._checkout()
+        try:
+            try:
+                response = self._send(conn, method, url, body)
+            except (ConnectionError, http.client.RemoteDisconnected, http.client.CannotSendRequest):
+                # Pooled keep-alive connection went stale; retry on a fresh one
+                if body is not None and not isinstance(body, (bytes, bytearray, dict)):
+                    raise
+                conn.close()
+                response = self._send(conn, method, url, body)
+            if sink is not None and response.status in ok:
+                # Successful bodies go to the sink a piece at a time
+                for chunk in iter(lambda: response.read(READ_SIZE), b""):
+                    sink.write(chunk)
+                data = b""
+            else:
+                data = response.read()
+        except Exception:
+            conn.close()
+            self._checkin(None)
+            raise
+        if response.will_close:
+            conn.close()
+            conn = None
+        self._checkin(conn)
+        return _parse(response.status, data, ok, parse)
+
+    def ping(self):
+        """True if the API socket answers"""
+        try:
+            conn = UnixHTTPConnection(self.socket_path, timeout=2)
+            conn.request("GET", "/_ping")
+            ok = conn.getresponse().status == 200
+            conn.close()
+            return ok
+        except OSError:
+            return False
+
+    def close(self):
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            if conn:
+                conn.close()
+
+
+class AsyncPodmanClient(_Endpoints):
+    """asyncio libpod client for driving many vaults concurrently"""
+
+    def __init__(self, socket_path=None, pool_size=POOL_SIZE):
+        self.socket_path = socket_path or default_socket_path()
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def _call(self, method, path, params=None, body=None, ok=(200,), parse="json", sink=None):
+        async with self._slots:
+            conn = self._idle.pop() if self._idle else await asyncio.open_unix_connection(self.socket_path)
+            try:
+                status, data, keep_alive = await self._roundtrip(conn, method, _url(path, params), body,
+                                                                 sink, ok)
+            except Exception:
+                conn[1].close()
+                raise
+            if keep_alive:
+                self._idle.append(conn)
+            else:
+                conn[1].close()
+        return _parse(status, data, ok, parse)
+
+    async def _roundtrip(self, conn, method, url, body, sink=None, ok=(200,)):
+        reader, writer = conn
+        headers = ["Host: localhost"]
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+            headers.append("Content-Type: application/json")
+        elif body is not None and not isinstance(body, (bytes, bytearray)):
+            body = b"".join(body)
+            headers.append("Content-Type: application/x-tar")
+        headers.append(f"Content-Length: {len(body) if body else 0}")
+        head = f"{method} {url} HTTP/1.1\r\n" + "".join(f"{h}\r\n" for h in headers) + "\r\n"
+        writer.write(head.encode())
+        if body:
+            writer.write(body)
+        await writer.drain()
+
+        # Interim replies (100 Continue) come before the real one
+        status, response_headers = await self._read_head(reader)
+        while 100 <= status < 200 and status != 101:
+            status, response_headers = await self._read_head(reader)
+        keep_alive = status != 101 and response_headers.get("connection", "").lower() != "close"
+        if method == "HEAD" or status in (101, 204, 304):
+            # No body, whatever Content-Length says
+            return status, b"", keep_alive
+
+        chunks = []
+        emit = sink.write if sink is not None and status in ok else chunks.append
+
+        async def copy(size):
+            while size:
+                data = await reader.read(min(size, READ_SIZE))
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", size)
+                emit(data)
+                size -= len(data)
+
+        if response_headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                await copy(size)
+                await reader.readline()
+        elif "content-length" in response_headers:
+            await copy(int(response_headers["content-length"]))
+        else:
+            # Delimited by the server closing the connection
+            while data := await reader.read(READ_SIZE):
+                emit(data)
+            keep_alive = False
+        return status, b"".join(chunks), keep_alive
+
+    @staticmethod
+    async def _read_head(reader):
+        """Status and lower-cased headers of the next response"""
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Podman API closed the connection")
+        status = int(line.split()[1])
+        response_headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+        return status, response_headers
+
+    async def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle = []
+
+
+_client = None
+
+def get_podman_client():
+    """Shared PodmanClient if the API socket is reachable, else None (use the CLI)"""
+    global _client
+    if _client is None:
+        client = PodmanClient()
+        if not client.ping():
+            return None
+        _client = client
+    return _client
@@ -0,0 +1,231 @@
+"""In-process fake of the libpod REST API subset used by PodmanClient.
+
+Serves HTTP/1.1 over a unix socket with keep-alive, keeps containers and
+volumes in memory, and backs each volume with a real directory so the
+archive endpoints move actual files. Meant for tests and benchmarks only.
+"""
+import io
+import json
+import os
+import re
+import shutil
+import socketserver
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _reply(self, status, payload=None, content_type="application/json"):
+        if isinstance(payload, (dict, list)):
+            payload = json.dumps(payload).encode()
+        payload = payload or b""
+        self.send_response(status)
+        if status not in (204, 304):
+            # Like podman, no length on replies that can't have a body
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if payload and self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def _dispatch(self):
+        server = self.server.fake
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._body()
+        path = re.sub(r"^/v[\d.]+/libpod", "", url.path)
+        status, payload, content_type = server.handle(self.command, unquote(path), params, body)
+        self._reply(status, payload, content_type)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _dispatch
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler wants a (host, port) client address
+        return request, ("local", 0)
+
+
+class FakePodmanServer:
+    """Minimal libpod API over a unix socket, for tests and benchmarks"""
+
+    def __init__(self, root_dir=None, socket_path=None, latency=0.0):
+        self.root_dir = root_dir or tempfile.mkdtemp(prefix="fake-podman-")
+        self.socket_path = socket_path or os.path.join(self.root_dir, "podman.sock")
+        self.latency = latency
+        self.containers = {}
+        self.volumes = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = _UnixServer(self.socket_path, _Handler)
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # ---- state helpers ----
+
+    def _volume(self, name):
+        if name not in self.volumes:
+            mountpoint = os.path.join(self.root_dir, "volumes", name, "_data")
+            os.makedirs(mountpoint, exist_ok=True)
+            self.volumes[name] = {"Name": name, "Mountpoint": mountpoint, "Labels": {}}
+        return self.volumes[name]
+
+    def _host_path(self, container, path):
+        """Map a path inside a container to the directory backing it"""
+        for mount in container["Mounts"]:
+            dest = mount["Destination"]
+            if path == dest or path.startswith(dest.rstrip("/") + "/"):
+                return os.path.join(self.volumes[mount["Name"]]["Mountpoint"], path[len(dest):].lstrip("/"))
+        return os.path.join(self.root_dir, "rootfs", container["Id"], path.lstrip("/"))
+
+    def _find(self, name):
+        container = self.containers.get(name)
+        if container is None:
+            container = next((c for c in self.containers.values() if c["Id"].startswith(name)), None)
+        return container
+
+    # ---- request handling ----
+
+    def handle(self, method, path, params, body):
+        with self._lock:
+            try:
+                return self._route(method, path, params, body)
+            except KeyError as e:
+                return 404, {"message": f"no such object: {e}"}, "application/json"
+
+    def _route(self, method, path, params, body):
+        parts = path.strip("/").split("/")
+        json_type = "application/json"
+
+        if path == "/_ping":
+            return 200, b"OK", "text/plain"
+
+        if parts[0] == "containers":
+            if parts[1:] == ["json"]:
+                pattern = json.loads(params.get("filters", "{}")).get("name", [None])[0]
+                show_all = params.get("all") == "true"
+                listed = [
+                    {"Id": c["Id"], "Names": [n], "State": c["State"], "Labels": c["Labels"]}
+                    for n, c in self.containers.items()
+                    if (show_all or c["State"] == "running") and (not pattern or re.search(pattern, n))
+                ]
+                return 200, listed, json_type
+            if parts[1:] == ["create"]:
+                spec = json.loads(body)
+                if spec["name"] in self.containers:
+                    return 409, {"message": "container name in use"}, json_type
+                mounts = []
+                for vol in spec.get("volumes", []):
+                    self._volume(vol["Name"])
+                    mounts.append({"Type": "volume", "Name": vol["Name"], "Destination": vol["Dest"],
+                                   "Source": self.volumes[vol["Name"]]["Mountpoint"]})
+                container_id = uuid.uuid4().hex
+                self.containers[spec["name"]] = {
+                    "Id": container_id, "Name": spec["name"], "State": "created",
+                    "Image": spec.get("image"), "Labels": spec.get("labels") or {}, "Mounts": mounts,
+                }
+                return 201, {"Id": container_id, "Warnings": []}, json_type
+
+            container = self._find(parts[1])
+            action = parts[2] if len(parts) > 2 else None
+            if container is None:
+                if action == "exists":
+                    return 404, None, json_type
+                raise KeyError(parts[1])
+            if method == "DELETE":
+                del self.containers[container["Name"]]
+                return 200, [{"Id": container["Id"]}], json_type
+            if action == "exists":
+                return 204, None, json_type
+            if action == "json":
+                state = {"Status": container["State"], "Running": container["State"] == "running"}
+                return 200, dict(container, State=state), json_type
+            if action in ("start", "stop"):
+                new_state = "running" if action == "start" else "exited"
+                if container["State"] == new_state:
+                    return 304, None, json_type
+                container["State"] = new_state
+                return 204, None, json_type
+            if action == "rename":
+                new_name = params["name"]
+                if new_name in self.containers:
+                    return 409, {"message": "name in use"}, json_type
+                self.containers[new_name] = self.containers.pop(container["Name"])
+                container["Name"] = new_name
+                return 204, None, json_type
+            if action == "archive":
+                target = self._host_path(container, params["path"])
+                if method == "PUT":
+                    os.makedirs(target, exist_ok=True)
+                    with tarfile.open(fileobj=io.BytesIO(body)) as tar:
+                        tar.extractall(target)
+                    return 200, None, json_type
+                if not os.path.exists(target):
+                    raise KeyError(params["path"])
+                buffer = io.BytesIO()
+                with tarfile.open(fileobj=buffer, mode="w") as tar:
+                    tar.add(target, arcname=os.path.basename(params["path"].rstrip("/")) or ".")
+                return 200, buffer.getvalue(), "application/x-tar"
+
+        if parts[0] == "volumes":
+            if parts[1:] == ["create"]:
+                spec = json.loads(body)
+                if spec["Name"] in self.volumes:
+                    return 409, {"message": "volume already exists"}, json_type
+                volume = self._volume(spec["Name"])
+                volume["Labels"] = spec.get("Labels") or {}
+                return 201, volume, json_type
+            name = parts[1]
+            if method == "DELETE":
+                if name not in self.volumes:
+                    return 404, {"message": "no such volume"}, json_type
+                shutil.rmtree(os.path.dirname(self.volumes.pop(name)["Mountpoint"]), ignore_errors=True)
+                return 204, None, json_type
+            return 200, self.volumes[name], json_type
+
+        if parts[0] == "images":
+            if parts[-1] == "exists":
+                return 204, None, json_type
+            if parts[1:] == ["pull"]:
+                return 200, {"images": [params.get("reference")]}, json_type
+
+        return 404, {"message": f"unsupported endpoint {method} {path}"}, json_type
@@ -1,11 +1,149 @@
+import hashlib
+import logging
 import subprocess
 from cryptography.fernet import Fernet
+from app.key_cache import keys_changed
+from app.podman_api import get_podman_client, tar_single_file
+from app.storage import (
+    SHARD_COUNT, TENANT_PATTERN, get_storage, is_shard, shard_name, vault_container, vault_mounts
+)
+
+log = logging.getLogger(__name__)
+
+VAULT_IMAGE = "alpine:latest"
+
+def _create_vault_via_api(client, vault_name, with_key=True):
+    """Create the vault container through the libpod REST API"""
+    if client.container_exists(vault_name):
+        log.warning(f"⚠️ Vault {vault_name} already exists, using existing vault")
+        client.start_container(vault_name)
+        return vault_name
+    
+    client.create_volume(f"{vault_name}_data")
+    client.create_volume(f"{vault_name}_keys")
+    log.info(f"✅ Volumes created for {vault_name}")
+    
+    try:
+        if not client.image_exists(VAULT_IMAGE):
+            client.pull_image(VAULT_IMAGE)
+        result = client.create_container(
+            vault_name, VAULT_IMAGE, ["sleep", "infinity"],
+            volumes=[(f"{vault_name}_data", "/vault/data"), (f"{vault_name}_keys", "/vault/keys")]
+        )
+        client.start_container(vault_name)
+        log.info(f"✅ Container created: {vault_name}")
+        log.info(f"   Container ID: {result['Id'][:12]}")
+    except Exception as e:
+        log.error(f"❌ Container creation failed: {e}")
+        raise Exception(f"Failed to create Podman container: {e}")
+    
+    if not with_key:
+        return vault_name
+    
+    # Generate initial key - written with an archive upload, no exec needed
+    try:
+        key = Fernet.generate_key()
+        client.put_archive(vault_name, "/vault/keys", tar_single_file("master.key", key + b"\n"))
+        log.info(f"✅ Encryption key generated for {vault_name}")
+    except Exception as e:
+        log.error(f"❌ Key generation failed: {e}")
+        client.remove_container(vault_name)
+        raise Exception(f"Failed to generate encryption key: {e}")
+    
+    return vault_name
 
 def create_user_vault(username):
-    """Create isolated Podman container for user"""
+    """Create isolated Podman container for user
+
+    Claims a pre-warmed container from the vault pool when one is ready,
+    otherwise creates one from scratch.
+    """
+    from app.vault_pool import claim_pool_vault
+    
+    if is_shard(f"vault_{username}"):
+        raise Exception(f"Username {username} is reserved")
+    if SHARD_COUNT:
+        return _create_tenant_vault(username)
+    
     vault_name = f"vault_{username}"
     
-    print(f"🔧 Creating vault: {vault_name}")
+    log.info(f"🔧 Creating vault: {vault_name}")
+    
+    keys_changed(vault_name)
+    storage = get_storage()
+    if not storage.requires_container:
+        # Storage backend owns the vault tree (local/dev mode) - no container
+        storage.provision(vault_name)
+        storage.write(vault_name, "keys/master.key", [Fernet.generate_key() + b"\n"])
+        log.info(f"✅ Vault storage provisioned for {vault_name}")
+        return vault_name
+    
+    if not vault_exists(vault_name) and claim_pool_vault(vault_name):
+        return vault_name
+    return create_vault_container(vault_name)
+
+def tenant_vault_name(username):
+    """Vault name of a user in sharded mode: "<shard>/<username>", shard picked by hash"""
+    if not TENANT_PATTERN.fullmatch(username):
+        raise Exception("Usernames may only contain letters, digits, '_', '.' and '-'")
+    index = int.from_bytes(hashlib.sha256(username.encode()).digest()[:8], "big") % SHARD_COUNT
+    return f"{shard_name(index)}/{username}"
+
+def ensure_shard(shard):
+    """Create a shard container (no key of its own) unless it exists"""
+    storage = get_storage()
+    if not storage.requires_container:
+        storage.provision(shard)
+    elif not vault_exists(shard):
+        create_vault_container(shard, with_key=False)
+
+def _create_tenant_vault(username):
+    """Add a user's vault to their shard container"""
+    vault_name = tenant_vault_name(username)
+    log.info(f"🔧 Creating vault: {vault_name}")
+    
+    keys_changed(vault_name)
+    ensure_shard(vault_container(vault_name))
+    storage = get_storage()
+    try:
+        storage.stat(vault_name, "keys/master.key")
+        log.warning(f"⚠️ Vault {vault_name} already exists, using existing vault")
+        return vault_name
+    except Exception:
+        pass
+    storage.provision(vault_name)
+    storage.write(vault_name, "keys/master.key", [Fernet.generate_key() + b"\n"])
+    log.info(f"✅ Vault {vault_name} added to its shard")
+    return vault_name
+
+def vault_exists(vault_name):
+    """Whether a container with this exact name exists (in any state)"""
+    client = get_podman_client()
+    if client:
+        return client.container_exists(vault_name)
+    result = subprocess.run([
+        "podman", "ps", "-a", "--filter", f"name=^{vault_name}$", "--format", "{{.Names}}"
+    ], capture_output=True, text=True, check=True)
+    return vault_name in result.stdout.split()
+
+def rename_vault(vault_name, new_name):
+    """Rename a vault container (its volumes keep their names)"""
+    client = get_podman_client()
+    if client:
+        client.rename_container(vault_name, new_name)
+    else:
+        subprocess.run(["podman", "rename", vault_name, new_name],
+                       capture_output=True, text=True, check=True)
+    get_storage().release(vault_name)
+
+def create_vault_container(vault_name, with_key=True):
+    """Create (or start, if it exists) a vault container with volumes and a key
+
+    Shard containers are made with_key=False; their tenants have their own.
+    """
+    client = get_podman_client()
+    if client:
+        return _create_vault_via_api(client, vault_name, with_key)
     
     # Check if vault already exists
     try:
@@ -14,12 +152,12 @@ def create_user_vault(username):
         ], capture_output=True, text=True, check=True)
         
         if vault_name in check_container.stdout:
-            print(f"⚠️ Vault {vault_name} already exists, using existing vault")
+            log.warning(f"⚠️ Vault {vault_name} already exists, using existing vault")
             # Make sure it's running
             subprocess.run(["podman", "start", vault_name], stderr=subprocess.DEVNULL)
             return vault_name
     except subprocess.CalledProcessError as e:
-        print(f"❌ Error checking for existing vault: {e.stderr}")
+        log.error(f"❌ Error checking for existing vault: {e.stderr}")
         raise Exception(f"Podman check failed: {e.stderr}")
     
     # Create volumes (ignore if already exist)
@@ -28,9 +166,9 @@ def create_user_vault(username):
                        stderr=subprocess.DEVNULL, check=False)
         subprocess.run(["podman", "volume", "create", f"{vault_name}_keys"], 
                        stderr=subprocess.DEVNULL, check=False)
-        print(f"✅ Volumes created for {vault_name}")
+        log.info(f"✅ Volumes created for {vault_name}")
     except Exception as e:
-        print(f"⚠️ Volume creation warning: {e}")
+        log.warning(f"⚠️ Volume creation warning: {e}")
     
     # Create container - FIXED: Use proper list format
     try:
@@ -39,17 +177,20 @@ def create_user_vault(username):
             "--name", vault_name,
             "-v", f"{vault_name}_data:/vault/data",
             "-v", f"{vault_name}_keys:/vault/keys",
-            "alpine:latest",
+            VAULT_IMAGE,
             "sleep", "infinity"
         ], capture_output=True, text=True, check=True)
-        print(f"✅ Container created: {vault_name}")
-        print(f"   Container ID: {result.stdout.strip()[:12]}")
+        log.info(f"✅ Container created: {vault_name}")
+        log.info(f"   Container ID: {result.stdout.strip()[:12]}")
     except subprocess.CalledProcessError as e:
-        print(f"❌ Container creation failed:")
-        print(f"   stdout: {e.stdout}")
-        print(f"   stderr: {e.stderr}")
+        log.error(f"❌ Container creation failed:")
+        log.error(f"   stdout: {e.stdout}")
+        log.error(f"   stderr: {e.stderr}")
         raise Exception(f"Failed to create Podman container: {e.stderr}")
     
+    if not with_key:
+        return vault_name
+    
     # Generate initial key
     try:
         key = Fernet.generate_key()
@@ -58,11 +199,11 @@ def create_user_vault(username):
             "sh", "-c", 
             f"mkdir -p /vault/keys /vault/data && echo '{key.decode()}' > /vault/keys/master.key"
         ], capture_output=True, text=True, check=True)
-        print(f"✅ Encryption key generated for {vault_name}")
+        log.info(f"✅ Encryption key generated for {vault_name}")
     except subprocess.CalledProcessError as e:
-        print(f"❌ Key generation failed:")
-        print(f"   stdout: {e.stdout}")
-        print(f"   stderr: {e.stderr}")
+        log.error(f"❌ Key generation failed:")
+        log.error(f"   stdout: {e.stdout}")
+        log.error(f"   stderr: {e.stderr}")
         # Clean up the container if key generation fails
         subprocess.run(["podman", "rm", "-f", vault_name], stderr=subprocess.DEVNULL)
         raise Exception(f"Failed to generate encryption key: {e.stderr}")
@@ -72,28 +213,83 @@ def create_user_vault(username):
 def list_user_files(vault_name):
     """List all files in user's vault"""
     try:
-        result = subprocess.run([
-            "podman", "exec", vault_name,
-            "ls", "/vault/data"
-        ], capture_output=True, text=True, check=True)
-        
-        files = [f.strip() for f in result.stdout.strip().split('\n') if f.strip()]
-        return files if files else []
-    except subprocess.CalledProcessError as e:
-        print(f"⚠️ Error listing files in {vault_name}: {e.stderr}")
+        files = get_storage().list(vault_name, "data")
+        # Hide blobs that are still being written by the agent
+        return [f for f in files if not f.endswith('.part')]
+    except Exception as e:
+        log.warning(f"⚠️ Error listing files in {vault_name}: {e}")
         return []
 
+def list_vault_containers(all=False):
+    """Names of vault containers (only running ones unless all=True)"""
+    storage = get_storage()
+    if not storage.requires_container:
+        return storage.list_vaults()
+    
+    client = get_podman_client()
+    if client:
+        containers = client.list_containers("^vault_", all=all)
+        return sorted(c["Names"][0] for c in containers if c["Names"][0].startswith("vault_"))
+    
+    result = subprocess.run([
+        "podman", "ps", *(["-a"] if all else []),
+        "--filter", "name=vault_",
+        "--format", "{{.Names}}"
+    ], capture_output=True, text=True, check=True)
+    
+    return [v.strip() for v in result.stdout.strip().split('\n')
+            if v.strip() and v.strip().startswith('vault_')]
+
+def list_vaults(all=False):
+    """Names of all vaults: per-user containers plus the tenants of shard containers
+
+    Only vaults in running containers unless all=True.
+    """
+    storage = get_storage()
+    vault_names = []
+    for container in list_vault_containers(all=all):
+        if not is_shard(container):
+            vault_names.append(container)
+            continue
+        try:
+            tenants = storage.list_tenants(container)
+        except Exception as e:
+            log.warning(f"⚠️ Failed to list tenants of {container}: {e}")
+            continue
+        vault_names.extend(f"{container}/{tenant}" for tenant in tenants)
+    return vault_names
+
 def delete_vault(vault_name):
     """Delete user's vault container and volumes"""
     try:
+        storage = get_storage()
+        storage.release(vault_name)
+        keys_changed(vault_name)
+        if not storage.requires_container or "/" in vault_name:
+            # Backend-owned storage, or a tenant of a shard container
+            storage.destroy(vault_name)
+            log.info(f"✅ Vault {vault_name} deleted successfully")
+            return
+        # Vaults claimed from the pool keep their original volume names
+        try:
+            volumes = [name for name, _ in vault_mounts(vault_name).values() if name]
+        except Exception:
+            volumes = [f"{vault_name}_data", f"{vault_name}_keys"]
+        client = get_podman_client()
+        if client:
+            client.stop_container(vault_name)
+            client.remove_container(vault_name)
+            for volume in volumes:
+                client.remove_volume(volume)
+            log.info(f"✅ Vault {vault_name} deleted successfully")
+            return
         subprocess.run(["podman", "stop", vault_name], 
                       stderr=subprocess.DEVNULL, check=False)
         subprocess.run(["podman", "rm", vault_name], 
                       stderr=subprocess.DEVNULL, check=False)
-        subprocess.run(["podman", "volume", "rm", f"{vault_name}_data"], 
-                      stderr=subprocess.DEVNULL, check=False)
-        subprocess.run(["podman", "volume", "rm", f"{vault_name}_keys"], 
-                      stderr=subprocess.DEVNULL, check=False)
-        print(f"✅ Vault {vault_name} deleted successfully")
+        for volume in volumes:
+            subprocess.run(["podman", "volume", "rm", volume], 
+                          stderr=subprocess.DEVNULL, check=False)
+        log.info(f"✅ Vault {vault_name} deleted successfully")
     except Exception as e:
-        print(f"⚠️ Error deleting vault {vault_name}: {e}")
\ No newline at end of file
+        log.warning(f"⚠️ Error deleting vault {vault_name}: {e}")
\ No newline at end of file
@@ -0,0 +1,274 @@
+"""Policy-driven, staggered key rotation.
+
+Rather than rotating every vault in one burst, a planner job runs every
+ROTATION_PLAN_SECONDS and rotates only the vaults whose policy calls for it:
+
+    resume  a rotation paused at its tick's time limit continues
+    event   a rotation was asked for (``request_rotation``, ``flask rotate-vault``)
+    bytes   at least max bytes were encrypted under the current key
+    age     the current key is past its max age
+
+A key that has protected no new files since it was issued is left alone
+whatever its age. Max age and max bytes default to ROTATION_MAX_AGE_HOURS
+and ROTATION_MAX_BYTES and can be set per vault (``flask rotation-policy``).
+
+Age deadlines are drawn up to ROTATION_JITTER of the window early, and a
+vault seen for the first time gets one anywhere in its first window, so
+rotations spread out instead of lining up. Each tick only starts what the
+budget allows: rotation time accrues at ROTATION_CPU_SHARE seconds per
+second, and a vault is charged what its last rotation took. Re-encryption
+across all vaults is paced to PODVAULT_ROTATION_IO_RATE (key_rotation).
+
+With several app processes, each runs the planner on a share of the budget
+and rotates only the vaults whose ``vault:<name>`` lease it takes
+(job_leases), so every due vault is rotated once.
+"""
+import atexit
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+
+from app import db, job_leases, upsert
+from app.models import VaultRotation
+from app.podman_manager import list_vaults
+
+log = logging.getLogger(__name__)
+
+ROTATION_PLAN_SECONDS = int(os.environ.get("PODVAULT_ROTATION_PLAN_SECONDS", "60"))
+ROTATION_MAX_AGE_HOURS = float(os.environ.get("PODVAULT_ROTATION_MAX_AGE_HOURS", "24"))
+ROTATION_MAX_BYTES = int(os.environ.get("PODVAULT_ROTATION_MAX_BYTES", str(10 * 1024 ** 3)))
+ROTATION_JITTER = float(os.environ.get("PODVAULT_ROTATION_JITTER", "0.2"))
+ROTATION_CPU_SHARE = float(os.environ.get("PODVAULT_ROTATION_CPU_SHARE", "0.25"))
+# Wait before trying a vault again after its rotation failed
+_RETRY_AFTER = timedelta(minutes=15)
+# Charge for a vault that hasn't been rotated yet, in seconds
+_FIRST_ESTIMATE = 1.0
+_PRIORITY = ("resume", "event", "bytes", "age")
+
+_app = None
+_lock = threading.Lock()
+_writes = {}  # vault_name -> [files, bytes] not added to VaultRotation yet
+_budget = 0.0  # Seconds of rotation the planner may still start
+_budget_at = None
+
+
+def init_app(app):
+    """Use app's database for rotation state outside requests"""
+    global _app
+    _app = app
+    atexit.register(flush_writes)
+
+@contextmanager
+def _app_context():
+    if has_app_context():
+        yield True
+    elif _app is not None:
+        with _app.app_context():
+            yield True
+    else:
+        yield False
+
+def note_write(vault_name, nbytes):
+    """Count a file encrypted under the vault's current key"""
+    with _lock:
+        totals = _writes.setdefault(vault_name, [0, 0])
+        totals[0] += 1
+        totals[1] += nbytes
+
+def flush_writes():
+    """Add counted writes to the vaults' VaultRotation rows"""
+    with _lock:
+        writes = dict(_writes)
+        _writes.clear()
+    if not writes:
+        return
+    with _app_context() as active:
+        if not active:
+            return
+        try:
+            for vault_name, (files, nbytes) in writes.items():
+                statement = upsert(VaultRotation).values(vault_name=vault_name, key_issued_at=datetime.utcnow(),
+                                                         writes=files, bytes_written=nbytes)
+                db.session.execute(statement.on_conflict_do_update(
+                    index_elements=["vault_name"],
+                    set_={"writes": VaultRotation.writes + files,
+                          "bytes_written": VaultRotation.bytes_written + nbytes}))
+            db.session.commit()
+            return
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Failed to record vault writes for rotation: {e}")
+    with _lock:
+        for vault_name, (files, nbytes) in writes.items():
+            totals = _writes.setdefault(vault_name, [0, 0])
+            totals[0] += files
+            totals[1] += nbytes
+
+def _get_state(vault_name):
+    row = db.session.get(VaultRotation, vault_name)
+    if row is None:
+        # History unknown: treat the key as having protected new files
+        row = VaultRotation(vault_name=vault_name, key_issued_at=datetime.utcnow(), writes=1,
+                            bytes_written=0, in_progress=False)
+        db.session.add(row)
+    return row
+
+def request_rotation(vault_name, deep=False):
+    """Have the planner rotate a vault on its next tick (deep re-encrypts every file)"""
+    row = _get_state(vault_name)
+    if deep or row.requested is None:
+        row.requested = "deep" if deep else "rotate"
+    db.session.commit()
+
+def set_policy(vault_name, max_age_hours=None, max_bytes=None):
+    """Override a vault's max key age and bytes (None goes back to the defaults)"""
+    row = _get_state(vault_name)
+    row.max_age_hours = max_age_hours
+    row.max_bytes = max_bytes
+    row.due_at = _deadline(row, row.key_issued_at or datetime.utcnow())
+    db.session.commit()
+
+def _deadline(row, issued_at, first=False):
+    """When a key issued at issued_at is due by age, with jitter; None if age doesn't count"""
+    hours = row.max_age_hours if row.max_age_hours is not None else ROTATION_MAX_AGE_HOURS
+    if hours <= 0:
+        return None
+    fraction = random.random() if first else 1 - ROTATION_JITTER * random.random()
+    return issued_at + timedelta(hours=hours * fraction)
+
+def _due_reason(row, now):
+    if row.retry_at and now < row.retry_at:
+        return None
+    if row.in_progress:
+        return "resume"
+    if row.requested:
+        return "event"
+    if not row.writes:
+        return None
+    max_bytes = row.max_bytes if row.max_bytes is not None else ROTATION_MAX_BYTES
+    if max_bytes > 0 and row.bytes_written >= max_bytes:
+        return "bytes"
+    if row.due_at and now >= row.due_at:
+        return "age"
+    return None
+
+def _top_up_budget():
+    global _budget, _budget_at
+    now = time.monotonic()
+    # Processes split the share between them
+    share = ROTATION_CPU_SHARE / job_leases.live_workers()
+    limit = share * ROTATION_PLAN_SECONDS
+    if _budget_at is None:
+        _budget = limit
+    else:
+        _budget = min(_budget + share * (now - _budget_at), limit)
+    _budget_at = now
+
+def _plan(vault_names, now):
+    """[(reason, row)] of the listed vaults that are due, most urgent first"""
+    rows = {row.vault_name: row for row in VaultRotation.query}
+    for vault_name in vault_names:
+        row = rows.get(vault_name) or _get_state(vault_name)
+        if row.due_at is None:
+            row.due_at = _deadline(row, now, first=True)
+        rows[vault_name] = row
+    try:
+        db.session.commit()
+    except Exception as e:
+        # Another process added the same vaults; their rows are there next tick
+        db.session.rollback()
+        log.warning(f"⚠️ Failed to save key rotation state: {e}")
+        return []
+    due = [(reason, rows[vault_name]) for vault_name in vault_names
+           if (reason := _due_reason(rows[vault_name], now))]
+    due.sort(key=lambda item: (_PRIORITY.index(item[0]), item[1].due_at or now))
+    return due
+
+def _record(row, writes, nbytes, result, now):
+    status = result["status"]
+    if status == "skipped":
+        return  # Busy vault - due again next tick
+    row.last_seconds = result["seconds"]
+    if status == "partial":
+        row.in_progress, row.retry_at = True, None
+    elif status == "failed":
+        row.retry_at = now + _RETRY_AFTER
+    else:
+        # Files stored while it ran are under the new key and stay counted
+        row.writes = VaultRotation.writes - writes
+        row.bytes_written = VaultRotation.bytes_written - nbytes
+        row.key_issued_at, row.due_at = now, _deadline(row, now)
+        row.requested, row.in_progress, row.retry_at = None, False, None
+
+def plan_rotations():
+    """Rotate the vaults that are due, as many as the budget allows (scheduler job)"""
+    global _budget
+    from app.key_rotation import rotate_vaults
+
+    flush_writes()
+    with _app_context() as active:
+        if not active:
+            return
+        try:
+            vault_names = list_vaults(all=True)
+        except Exception as e:
+            log.error(f"❌ Failed to list vaults for key rotation: {e}")
+            return
+        due = _plan(vault_names, datetime.utcnow())
+        if not due:
+            return
+
+        _top_up_budget()
+        chosen = []
+        for reason, row in due:
+            if _budget <= 0:
+                break
+            if not job_leases.acquire(f"vault:{row.vault_name}"):
+                continue  # Another process has it
+            db.session.refresh(row)
+            reason = _due_reason(row, datetime.utcnow())
+            if not reason:
+                # Rotated by another process since this tick read it
+                job_leases.release(f"vault:{row.vault_name}")
+                continue
+            cost = row.last_seconds or _FIRST_ESTIMATE
+            _budget -= cost
+            chosen.append((row, reason, row.writes, row.bytes_written, cost))
+        if not chosen:
+            log.info(f"⏳ {len(due)} vaults due for key rotation, none started (budget spent or claimed elsewhere)")
+            return
+        reasons = {}
+        for _, reason, _, _, _ in chosen:
+            reasons[reason] = reasons.get(reason, 0) + 1
+        log.info(f"🗓️ {len(due)} vaults due for key rotation, starting {len(chosen)} "
+              f"({', '.join(f'{count} {reason}' for reason, count in reasons.items())})"
+              + (f", {len(due) - len(chosen)} left for later" if len(due) > len(chosen) else ""))
+
+        # The leases go only once the results are saved, or another process
+        # could take a vault and still find it due
+        try:
+            try:
+                results = rotate_vaults({row.vault_name: row.requested == "deep" for row, *_ in chosen})
+            except Exception as e:
+                log.error(f"❌ Key rotation failed to start: {e}")
+                results = {}
+            now = datetime.utcnow()
+            for row, _, writes, nbytes, cost in chosen:
+                result = results.get(row.vault_name, {"status": "skipped", "seconds": 0.0})
+                # Charge what the rotation actually took
+                _budget += cost - result["seconds"]
+                _record(row, writes, nbytes, result, now)
+            try:
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                log.warning(f"⚠️ Failed to save key rotation state: {e}")
+        finally:
+            for row, *_ in chosen:
+                job_leases.release(f"vault:{row.vault_name}")
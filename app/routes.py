@@ -1,12 +1,44 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file
+from flask import (
+    Blueprint, Response, abort, g, render_template, request, redirect, url_for, flash, stream_with_context
+)
 from flask_login import login_user, logout_user, login_required, current_user
-from app.models import db, AuditLog, User
-from app.podman_manager import create_user_vault, list_user_files
-from app.key_rotation import encrypt_file_for_vault, decrypt_file_from_vault
+from app.models import db, User
+from app.podman_manager import create_user_vault
+from app.key_rotation import store_stream_in_vault, store_streams_in_vault, VaultDownload
+from app.file_index import count_files, list_files, record_upload, record_uploads
+from app.upload_stream import iter_bulk_upload, open_uploaded_file
+from app.vault_export import EXPORT_FORMATS, export_filenames, iter_export
+from app.storage import get_storage, vault_container
+from app import audit_log, metrics, stats, vault_lifecycle
+import hmac
+import logging
 import os
-import traceback
+import time
 
 main = Blueprint('main', __name__)
+log = logging.getLogger(__name__)
+
+# Bearer token /metrics requires, if set
+METRICS_TOKEN = os.environ.get("PODVAULT_METRICS_TOKEN")
+
+@main.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@main.after_request
+def record_latency(response):
+    if 'started' in g:
+        metrics.observe("request", time.perf_counter() - g.started, endpoint=request.endpoint or "unknown")
+    return response
+
+@main.before_request
+def keep_vault_awake():
+    """User activity resets the vault's idle clock; a hibernated vault starts waking now"""
+    if current_user.is_authenticated and current_user.vault_name:
+        container = vault_container(current_user.vault_name)
+        vault_lifecycle.touch(container)
+        if get_storage().needs_running_container:
+            vault_lifecycle.wake_vault_async(container)
 
 @main.route('/')
 def landing():
@@ -37,9 +69,15 @@ def logout():
 @main.route('/home')
 @login_required
 def index():
-    logs = AuditLog.query.filter_by(user=current_user.username).order_by(AuditLog.timestamp.desc()).all()
-    vault_files = list_user_files(current_user.vault_name)
-    return render_template('index.html', logs=logs, user=current_user, vault_files=vault_files)
+    sort = request.args.get('sort', 'name')
+    files = list_files(current_user.vault_name, page=request.args.get('page', 1, type=int), sort=sort)
+    # Activity pages by cursor; the first one includes entries still being written
+    before = request.args.get('before')
+    logs, older = audit_log.audit_page(user=current_user.username, before=before)
+    if not before:
+        logs = audit_log.pending_entries(current_user.username) + logs
+    return render_template('index.html', logs=logs, older=older, before=before,
+                           user=current_user, files=files, sort=sort)
 @main.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -50,30 +88,27 @@ def register():
             flash('❌ Username already exists!')
             return redirect(url_for('main.register'))
         
-        # ADD DETAILED LOGGING HERE
-        print(f"\n🔧 DEBUG: Attempting to create vault for {username}")
+        log.debug(f"🔧 Attempting to create vault for {username}")
         try:
             vault_name = create_user_vault(username)
-            print(f"✅ DEBUG: Vault created successfully: {vault_name}")
+            log.debug(f"✅ Vault created successfully: {vault_name}")
         except Exception as e:
-            print(f"❌ DEBUG: Vault creation failed: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
+            log.exception(f"❌ Vault creation failed: {str(e)}")
             flash(f'❌ Failed to create vault: {str(e)}')
             return redirect(url_for('main.register'))
         
         user = User(username=username, password=password, vault_name=vault_name)
         db.session.add(user)
         db.session.commit()
+        stats.incr("users")
         
-        db.session.add(AuditLog(
+        audit_log.record(
             action="vault_created",
             filename=None,
             user=username,
             vault_name=vault_name,
             ip_address=request.remote_addr
-        ))
-        db.session.commit()
+        )
         
         flash(f'✅ Account created! Your vault: {vault_name}')
         return redirect(url_for('main.login'))
@@ -83,126 +118,231 @@ def register():
 @main.route('/upload', methods=['POST'])
 @login_required
 def upload():
-    file = request.files['file']
-    if file:
-        temp_path = os.path.join("/tmp", file.filename)
-        file.save(temp_path)
-        
+    # Parse the multipart body as it arrives - plaintext never touches disk
+    filename, stream = open_uploaded_file(request, 'file')
+    if filename:
         vault_name = current_user.vault_name
         try:
-            enc_filename = encrypt_file_for_vault(temp_path, vault_name)
+            stored = store_stream_in_vault(stream, filename, vault_name)
             
-            db.session.add(AuditLog(
+            record_upload(vault_name, stored)
+            with metrics.span("db_commit"):
+                db.session.commit()
+            stats.add("bytes_uploaded", vault_name, total=stored.plaintext_size)
+            audit_log.record(
                 action="Encrypted Upload",
-                filename=file.filename,
+                filename=filename,
                 user=current_user.username,
                 vault_name=vault_name,
                 ip_address=request.remote_addr,
                 status='success'
-            ))
-            db.session.commit()
+            )
             
-            flash(f"✅ File '{file.filename}' encrypted successfully!")
+            flash(f"✅ File '{filename}' encrypted successfully!")
         except Exception as e:
-            print(f"❌ UPLOAD ERROR: {str(e)}")
-            print(traceback.format_exc())
+            db.session.rollback()
+            log.exception(f"❌ UPLOAD ERROR: {str(e)}")
             
-            db.session.add(AuditLog(
+            audit_log.record(
                 action="Upload Failed",
-                filename=file.filename,
+                filename=filename,
                 user=current_user.username,
                 vault_name=vault_name,
                 ip_address=request.remote_addr,
                 status='failed'
-            ))
-            db.session.commit()
+            )
             flash(f"❌ Upload failed: {str(e)}")
-        finally:
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
     
     return redirect(url_for('main.index'))
 
+@main.route('/upload/bulk', methods=['POST'])
+@login_required
+def upload_bulk():
+    # Many files (or a tar archive) in one request, each encrypted as it arrives
+    vault_name = current_user.vault_name
+    stored_files = []
+    error = None
+    try:
+        for stored in store_streams_in_vault(iter_bulk_upload(request), vault_name):
+            stored_files.append(stored)
+    except Exception as e:
+        error = e
+        log.exception(f"❌ BULK UPLOAD ERROR after {len(stored_files)} files: {str(e)}")
+    
+    # Index rows for the whole batch go in one commit
+    try:
+        record_uploads(vault_name, stored_files)
+        with metrics.span("db_commit"):
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        log.error(f"❌ BULK UPLOAD ERROR recording {len(stored_files)} files: {str(e)}")
+    for stored in stored_files:
+        stats.add("bytes_uploaded", vault_name, total=stored.plaintext_size)
+        audit_log.record(
+            action="Encrypted Upload",
+            filename=stored.filename[:-len('.enc')],
+            user=current_user.username,
+            vault_name=vault_name,
+            ip_address=request.remote_addr,
+            status='success'
+        )
+    if error:
+        audit_log.record(
+            action="Bulk Upload Failed",
+            filename=None,
+            user=current_user.username,
+            vault_name=vault_name,
+            ip_address=request.remote_addr,
+            status='failed'
+        )
+    
+    if error:
+        flash(f"❌ Bulk upload stopped after {len(stored_files)} files: {str(error)}")
+    elif stored_files:
+        flash(f"✅ {len(stored_files)} files encrypted successfully!")
+    return redirect(url_for('main.index'))
+
 @main.route('/decrypt/<filename>')
 @login_required
 def decrypt(filename):
     vault_name = current_user.vault_name
     
-    print(f"\n🔍 DECRYPT REQUEST:")
-    print(f"  Filename: {filename}")
-    print(f"  Vault: {vault_name}")
-    print(f"  User: {current_user.username}")
+    log.debug(f"🔍 Decrypt request for {filename} from {vault_name} by {current_user.username}")
     
+    download = None
     try:
-        # Decrypt file from vault
-        print(f"  🔓 Attempting decryption...")
-        dec_path = decrypt_file_from_vault(filename, vault_name)
-        print(f"  ✅ Decrypted to: {dec_path}")
+        # Stat the blob and read its header; nothing is staged on disk
+        log.debug(f"  🔓 Opening encrypted stream...")
+        download = VaultDownload(filename, vault_name)
         
-        # Verify file exists
-        if not os.path.exists(dec_path):
-            raise FileNotFoundError(f"Decrypted file not found at {dec_path}")
+        # Serve a single byte range if asked for (and If-Range still matches)
+        byte_range = None
+        if download.seekable and request.range is not None:
+            if_range = request.if_range
+            if (if_range.etag is None and if_range.date is None) or if_range.etag == download.etag:
+                byte_range = request.range.range_for_length(download.size)
+                if byte_range is None:
+                    download.close()
+                    response = Response(status=416)
+                    response.headers['Content-Range'] = f"bytes */{download.size}"
+                    return response
+        start, end = byte_range or (0, download.size)
+        stats.add("bytes_downloaded", vault_name, total=end - start)
         
         # Log successful download
-        db.session.add(AuditLog(
+        audit_log.record(
             action="Decrypted Download",
             filename=filename,
             user=current_user.username,
             vault_name=vault_name,
             ip_address=request.remote_addr,
             status='success'
-        ))
-        db.session.commit()
+        )
         
-        # Send file with proper cleanup
         original_filename = filename.replace('.enc', '')
-        print(f"  📤 Sending file as: {original_filename}")
+        log.debug(f"  📤 Streaming file as: {original_filename} (bytes {start}-{end - 1}/{download.size})")
         
-        response = send_file(
-            dec_path, 
-            as_attachment=True, 
-            download_name=original_filename,
+        response = Response(
+            stream_with_context(download.iter_range(start, end)),
+            status=206 if byte_range else 200,
             mimetype='application/octet-stream'
         )
-        
-        # Clean up after download
-        @response.call_on_close
-        def cleanup():
-            try:
-                if os.path.exists(dec_path):
-                    os.remove(dec_path)
-                    print(f"  🗑️ Cleaned up temp file: {dec_path}")
-            except Exception as e:
-                print(f"  ⚠️ Cleanup failed: {e}")
-        
+        response.content_length = end - start
+        # The download holds the vault's lock until the stream is done
+        response.call_on_close(download.close)
+        response.headers.set('Content-Disposition', 'attachment', filename=original_filename)
+        if download.seekable:
+            response.headers['Accept-Ranges'] = 'bytes'
+            response.set_etag(download.etag)
+        if byte_range:
+            response.headers['Content-Range'] = f"bytes {start}-{end - 1}/{download.size}"
         return response
     
     except Exception as e:
-        error_details = traceback.format_exc()
-        print(f"\n❌ DECRYPTION ERROR:")
-        print(f"  Error: {str(e)}")
-        print(f"  Details:\n{error_details}")
+        if download:
+            download.close()
+        log.exception(f"❌ DECRYPTION ERROR: {str(e)}")
         
         # Log failed download
-        db.session.add(AuditLog(
+        audit_log.record(
             action="Decrypt Failed",
             filename=filename,
             user=current_user.username,
             vault_name=vault_name,
             ip_address=request.remote_addr,
             status='failed'
-        ))
-        db.session.commit()
+        )
         
         flash(f"❌ Download failed: {str(e)}")
         return redirect(url_for('main.index'))
 
+@main.route('/export')
+@login_required
+def export():
+    # ?format=tar|tar.gz|zip, and files=<name.enc> (repeatable) to export a selection
+    vault_name = current_user.vault_name
+    fmt = request.args.get('format', 'tar.gz')
+    if fmt not in EXPORT_FORMATS:
+        flash(f"❌ Unknown export format: {fmt}")
+        return redirect(url_for('main.index'))
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    archive_name = f"{current_user.username}-vault.{extension}"
+    
+    try:
+        filenames = export_filenames(vault_name, request.args.getlist('files'))
+    except Exception as e:
+        log.error(f"❌ EXPORT ERROR: {str(e)}")
+        audit_log.record(
+            action="Export Failed",
+            filename=archive_name,
+            user=current_user.username,
+            vault_name=vault_name,
+            ip_address=request.remote_addr,
+            status='failed'
+        )
+        flash(f"❌ Export failed: {str(e)}")
+        return redirect(url_for('main.index'))
+    
+    audit_log.record(
+        action="Vault Export",
+        filename=archive_name,
+        user=current_user.username,
+        vault_name=vault_name,
+        ip_address=request.remote_addr,
+        status='success'
+    )
+    log.info(f"📦 Exporting {len(filenames)} files from {vault_name} as {archive_name}")
+    
+    response = Response(stream_with_context(iter_export(vault_name, filenames, fmt)), mimetype=mimetype)
+    response.headers.set('Content-Disposition', 'attachment', filename=archive_name)
+    return response
+
 @main.route('/dashboard')
 @login_required
 def dashboard():
-    total_vaults = User.query.count()
-    total_logs = AuditLog.query.count()
-    total_files = len(list_user_files(current_user.vault_name))
-    recent_logs = AuditLog.query.order_by(AuditLog.timestamp.desc()).limit(10).all()
+    # Running counters and the last 24 hourly rollups - no table scans
+    total_vaults = stats.counter("users")
+    total_logs = stats.counter("audit_entries")
+    total_files = count_files(current_user.vault_name)
+    activity = stats.hourly("actions")
+    uploaded = sum(total for _, _, total in stats.hourly("bytes_uploaded"))
+    downloaded = sum(total for _, _, total in stats.hourly("bytes_downloaded"))
+    failures = sum(count for _, count, _ in stats.hourly("failures", vault_name=current_user.vault_name))
+    rotations = stats.hourly("rotations")
+    rotation_count = sum(count for _, count, _ in rotations)
+    rotation_seconds = sum(total for _, _, total in rotations) / 1000 / rotation_count if rotation_count else 0
+
+    return render_template('dashboard.html', total_logs=total_logs, total_files=total_files, total_vaults=total_vaults,
+                           hours=[hour.strftime('%H:00') for hour, _, _ in activity],
+                           actions=[count for _, count, _ in activity],
+                           uploaded=uploaded, downloaded=downloaded, failures=failures,
+                           rotation_seconds=rotation_seconds)
 
-    return render_template('dashboard.html', total_logs=total_logs, total_files=total_files, total_vaults=total_vaults, logs=recent_logs)
+@main.route('/metrics')
+def metrics_endpoint():
+    # Prometheus scrape target; counts are this process's own
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                 f"Bearer {METRICS_TOKEN}"):
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,84 @@
+"""Moving per-user vault containers into shard containers
+
+With PODVAULT_SHARDS set, new users get tenant vaults while existing users
+keep their own containers until migrated:
+
+    PODVAULT_SHARDS=16 flask --app run migrate-to-shards
+
+Run it while the web app is stopped. Each vault's files and keys (journal
+and archived keys included) are copied to its tenant directories and
+checked, then the user and their index rows point at the tenant vault,
+and only then is the old container removed. A vault that fails is left
+untouched and can simply be migrated again.
+"""
+import logging
+
+from app import db
+from app.chunk_store import CHUNK_DIR, has_chunk_store, list_chunk_blobs
+from app.key_cache import keys_changed
+from app.models import User, VaultFile
+from app.podman_manager import delete_vault, ensure_shard, tenant_vault_name
+from app.storage import SHARD_COUNT, get_storage, vault_container
+from app.vault_locks import rotation_slot, vault_lock
+
+log = logging.getLogger(__name__)
+
+
+def _vault_files(vault_name, path):
+    """Paths of the files under a directory, recursing into subdirectories"""
+    storage = get_storage()
+    for name in storage.list(vault_name, path):
+        child = f"{path}/{name}"
+        if name.endswith(".part"):
+            continue
+        try:
+            entries = storage.list(vault_name, child)
+        except Exception:
+            yield child  # Not a directory
+            continue
+        if entries:
+            yield from _vault_files(vault_name, child)
+
+def migrate_user_vault(user):
+    """Move one user's per-user vault into their shard; returns the new vault name"""
+    old_name = user.vault_name
+    new_name = tenant_vault_name(user.username)
+    storage = get_storage()
+    ensure_shard(vault_container(new_name))
+
+    with rotation_slot(old_name), vault_lock(old_name).exclusive():
+        paths = [f"data/{name}" for name in storage.list(old_name, "data") if not name.endswith(".part")]
+        if has_chunk_store(old_name):
+            paths += [f"data/{CHUNK_DIR}/.keep"] + [f"data/{name}" for name in list_chunk_blobs(old_name)]
+        paths += list(_vault_files(old_name, "keys"))
+        storage.provision(new_name)
+        for path in paths:
+            size, _ = storage.stat(old_name, path)
+            copied, _ = storage.write(new_name, path, storage.iter_read(old_name, path))
+            if copied != size:
+                raise Exception(f"Copy of {path} is {copied} bytes, expected {size}")
+
+        user.vault_name = new_name
+        VaultFile.query.filter_by(vault_name=old_name).update({"vault_name": new_name})
+        db.session.commit()
+        keys_changed(new_name)
+
+    delete_vault(old_name)
+    log.info(f"✅ Migrated {old_name} → {new_name} ({len(paths)} files)")
+    return new_name
+
+def migrate_all_users():
+    """Migrate every user still on a per-user vault; returns (migrated, failed)"""
+    if not SHARD_COUNT:
+        raise Exception("Set PODVAULT_SHARDS to the number of shard containers first")
+    migrated = failed = 0
+    users = User.query.filter(User.vault_name.isnot(None), ~User.vault_name.contains("/")).all()
+    for user in users:
+        try:
+            migrate_user_vault(user)
+            migrated += 1
+        except Exception as e:
+            db.session.rollback()
+            failed += 1
+            log.error(f"❌ Failed to migrate {user.vault_name}: {e}")
+    return migrated, failed
@@ -0,0 +1,201 @@
+"""Incrementally maintained counters and hourly rollups for the dashboard.
+
+Events add to in-memory totals as they happen (``add``, ``incr``); a
+scheduler job folds them into the StatRollup and StatCounter tables every
+STATS_FLUSH_SECONDS with SQLite upserts, so the dashboard reads a handful
+of rows instead of counting AuditLog.
+
+Rollups are per metric, per vault ("" for app-wide) and per hour:
+
+    actions           audit entries recorded
+    failures          audit entries with status 'failed'
+    bytes_uploaded    files stored (count) and their plaintext bytes (total)
+    bytes_downloaded  downloads served (count) and bytes requested (total)
+    rotations         key rotations (count) and their duration in ms (total)
+
+Audit history is kept forever unless PODVAULT_AUDIT_RETENTION_DAYS is set:
+then raw AuditLog rows older than that are deleted by ``compact_audit_log``;
+rows from before the rollups existed are folded into them first, so the
+hourly history stays complete.
+"""
+import atexit
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from flask import has_app_context
+
+from app import db, upsert
+from app.models import AuditLog, StatCounter, StatRollup, User
+
+log = logging.getLogger(__name__)
+
+STATS_FLUSH_SECONDS = int(os.environ.get("PODVAULT_STATS_FLUSH_SECONDS", "10"))
+# Days of raw audit entries to keep; 0 keeps all of them (the default)
+AUDIT_RETENTION_DAYS = int(os.environ.get("PODVAULT_AUDIT_RETENTION_DAYS", "0"))
+# AuditLog rows deleted (and, if older than the rollups, folded in) per transaction
+COMPACT_BATCH = 5000
+# Counter holding when incremental rollups started (UTC epoch seconds)
+_SINCE = "rollups_since"
+_EPOCH = datetime(1970, 1, 1)
+
+_app = None
+_lock = threading.Lock()
+_rollups = {}   # (metric, vault_name, hour) -> [count, total]
+_counters = {}  # name -> increment
+
+
+def init_app(app):
+    """Seed the counters from existing tables the first time, then keep them up"""
+    global _app
+    _app = app
+    with app.app_context():
+        if db.session.get(StatCounter, _SINCE) is None:
+            # Workers starting together may all get here; the first one's rows stay
+            db.session.execute(upsert(StatCounter).values([
+                {"name": "users", "value": User.query.count()},
+                {"name": "audit_entries", "value": AuditLog.query.count()},
+                {"name": _SINCE, "value": int((datetime.utcnow() - _EPOCH).total_seconds())},
+            ]).on_conflict_do_nothing(index_elements=["name"]))
+            db.session.commit()
+    atexit.register(flush_stats)
+
+@contextmanager
+def _app_context():
+    if has_app_context():
+        yield True
+    elif _app is not None:
+        with _app.app_context():
+            yield True
+    else:
+        yield False
+
+def _hour(when):
+    return when.replace(minute=0, second=0, microsecond=0)
+
+def add(metric, vault_name=None, total=0, count=1, when=None):
+    """Count an event (and an amount such as bytes) in its hour's rollup"""
+    key = (metric, vault_name or "", _hour(when or datetime.utcnow()))
+    with _lock:
+        totals = _rollups.setdefault(key, [0, 0])
+        totals[0] += count
+        totals[1] += total
+
+def incr(name, amount=1):
+    """Bump an app-wide running counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def _upsert(rollups, counters):
+    for (metric, vault_name, hour), (count, total) in rollups.items():
+        statement = upsert(StatRollup).values(metric=metric, vault_name=vault_name, hour=hour,
+                                              count=count, total=total)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=["metric", "vault_name", "hour"],
+            set_={"count": StatRollup.count + count, "total": StatRollup.total + total}))
+    for name, amount in counters.items():
+        statement = upsert(StatCounter).values(name=name, value=amount)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=["name"], set_={"value": StatCounter.value + amount}))
+
+def flush_stats():
+    """Write accumulated increments to the database (scheduler job)"""
+    with _lock:
+        rollups, counters = dict(_rollups), dict(_counters)
+        _rollups.clear()
+        _counters.clear()
+    if not rollups and not counters:
+        return
+    with _app_context() as active:
+        if not active:
+            return
+        try:
+            _upsert(rollups, counters)
+            db.session.commit()
+            return
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Failed to write stats: {e}")
+    # Put them back for the next flush
+    with _lock:
+        for key, (count, total) in rollups.items():
+            totals = _rollups.setdefault(key, [0, 0])
+            totals[0] += count
+            totals[1] += total
+        for name, amount in counters.items():
+            _counters[name] = _counters.get(name, 0) + amount
+
+def counter(name):
+    """A running counter, including increments not flushed yet"""
+    row = db.session.get(StatCounter, name)
+    with _lock:
+        return (row.value if row else 0) + _counters.get(name, 0)
+
+def hourly(metric, hours=24, vault_name=None):
+    """[(hour, count, total)] for the last ``hours`` hours, oldest first, gaps as zeros"""
+    end = _hour(datetime.utcnow())
+    start = end - timedelta(hours=hours - 1)
+    query = StatRollup.query.filter(StatRollup.metric == metric, StatRollup.hour >= start)
+    if vault_name is not None:
+        query = query.filter(StatRollup.vault_name == vault_name)
+    buckets = {}
+    for row in query:
+        totals = buckets.setdefault(row.hour, [0, 0])
+        totals[0] += row.count
+        totals[1] += row.total
+    with _lock:
+        for (pending_metric, pending_vault, hour), (count, total) in _rollups.items():
+            if pending_metric == metric and hour >= start and vault_name in (None, pending_vault):
+                totals = buckets.setdefault(hour, [0, 0])
+                totals[0] += count
+                totals[1] += total
+    return [(start + timedelta(hours=i), *buckets.get(start + timedelta(hours=i), (0, 0)))
+            for i in range(hours)]
+
+def compact_audit_log():
+    """Delete AuditLog rows past the retention period (scheduler job)
+
+    Rows from before incremental rollups started are added to the hourly
+    rollups first; later ones were counted as they were recorded.
+    """
+    if AUDIT_RETENTION_DAYS <= 0:
+        return
+    with _app_context() as active:
+        if not active:
+            return
+        since = db.session.get(StatCounter, _SINCE)
+        rolled_up_from = _EPOCH + timedelta(seconds=since.value) if since else datetime.min
+        cutoff = datetime.utcnow() - timedelta(days=AUDIT_RETENTION_DAYS)
+        removed = 0
+        try:
+            while True:
+                rows = (AuditLog.query.filter(AuditLog.timestamp < cutoff)
+                        .order_by(AuditLog.timestamp, AuditLog.id).limit(COMPACT_BATCH).all())
+                if not rows:
+                    break
+                # Delete first: if another compaction got some of these rows, its
+                # rollups have them and this batch is abandoned
+                deleted = AuditLog.query.filter(AuditLog.id.in_([row.id for row in rows])).delete(
+                    synchronize_session=False)
+                if deleted != len(rows):
+                    db.session.rollback()
+                    break
+                rollups = {}
+                for row in rows:
+                    if row.timestamp is None or row.timestamp >= rolled_up_from:
+                        continue
+                    vault_name = row.vault_name or ""
+                    metrics = ["actions", "failures"] if row.status == "failed" else ["actions"]
+                    for metric in metrics:
+                        totals = rollups.setdefault((metric, vault_name, _hour(row.timestamp)), [0, 0])
+                        totals[0] += 1
+                _upsert(rollups, {})
+                db.session.commit()
+                removed += len(rows)
+        except Exception as e:
+            db.session.rollback()
+            log.warning(f"⚠️ Audit log compaction failed after {removed} rows: {e}")
+        if removed:
+            log.info(f"🗜️ Compacted {removed} audit entries older than {AUDIT_RETENTION_DAYS} days")
@@ -0,0 +1,432 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import subprocess
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from app import vault_agent, vault_lifecycle
+from app.podman_api import get_podman_client
+
+STORAGE_BACKEND = os.environ.get("PODVAULT_STORAGE", "exec")
+STORAGE_MMAP = os.environ.get("PODVAULT_STORAGE_MMAP", "0") == "1"
+LOCAL_STORAGE_ROOT = os.environ.get("PODVAULT_LOCAL_ROOT", "vault_storage")
+# Shard containers holding many tenant vaults each (0 = one container per user)
+SHARD_COUNT = int(os.environ.get("PODVAULT_SHARDS", "0"))
+SHARD_PREFIX = "vault_shard"
+TENANT_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9_.-]*")
+READ_CHUNK = 256 * 1024
+
+
+class VaultStorage:
+    """Access to the files under a vault's /vault tree
+
+    Paths are relative to /vault ("data/report.pdf.enc", "keys/master.key").
+    ``write`` must be atomic: readers see either the old file or the
+    complete new one, never a partial write.
+    """
+
+    # Whether the vault lives in a container (as opposed to backend-owned storage)
+    requires_container = True
+    # Whether I/O needs that container running (woken from hibernation first)
+    needs_running_container = False
+    # Streams (open reads/writes) one vault can have at once; None if unbounded
+    max_streams = None
+
+    def list(self, vault_name, path):
+        raise NotImplementedError
+
+    def stat(self, vault_name, path):
+        """Return (size, mtime)"""
+        raise NotImplementedError
+
+    def read(self, vault_name, path):
+        return b"".join(self.iter_read(vault_name, path))
+
+    def iter_read(self, vault_name, path, offset=0, length=None):
+        raise NotImplementedError
+
+    def write(self, vault_name, path, chunks):
+        """Atomically replace path with chunks; returns (size, sha256 hex)"""
+        raise NotImplementedError
+
+    @contextmanager
+    def writer(self, vault_name):
+        """A write(path, chunks) function for many writes in a row (bulk uploads)
+
+        If a write fails midway, leave the block - the session may be unusable.
+        """
+        yield partial(self.write, vault_name)
+
+    def patch(self, vault_name, path, offset, data):
+        """Overwrite bytes in place (small header updates only)"""
+        raise NotImplementedError
+
+    def rename(self, vault_name, src, dst):
+        raise NotImplementedError
+
+    def remove(self, vault_name, path):
+        raise NotImplementedError
+
+    def remove_tree(self, vault_name, path):
+        """Remove a directory and everything under it"""
+        raise NotImplementedError
+
+    def provision(self, vault_name):
+        """Prepare storage for a new vault (no-op when the container owns it)"""
+
+    def release(self, vault_name):
+        """Drop cached handles (agents, mountpoints) for a vault"""
+
+    def destroy(self, vault_name):
+        """Delete storage the backend owns itself (volumes belong to Podman)"""
+
+
+class ExecStorage(VaultStorage):
+    """Goes through the persistent in-container agent (default)
+
+    Every operation wakes a hibernated vault first and keeps it awake
+    until done.
+    """
+
+    max_streams = vault_agent.AGENT_CHANNELS
+    needs_running_container = True
+
+    def list(self, vault_name, path):
+        with vault_lifecycle.in_use(vault_name):
+            return vault_agent.vault_list(vault_name, path)
+
+    def stat(self, vault_name, path):
+        with vault_lifecycle.in_use(vault_name):
+            return vault_agent.vault_stat(vault_name, path)
+
+    def read(self, vault_name, path):
+        with vault_lifecycle.in_use(vault_name):
+            return vault_agent.vault_read(vault_name, path)
+
+    def iter_read(self, vault_name, path, offset=0, length=None):
+        with vault_lifecycle.in_use(vault_name):
+            yield from vault_agent.vault_iter_read(vault_name, path, offset, length)
+
+    def write(self, vault_name, path, chunks):
+        with vault_lifecycle.in_use(vault_name):
+            return vault_agent.vault_write(vault_name, path, chunks)
+
+    @contextmanager
+    def writer(self, vault_name):
+        # All writes go down one agent channel, back to back
+        with vault_lifecycle.in_use(vault_name), \
+                vault_agent.get_agent_pool(vault_name).channel() as agent:
+            yield agent.write
+
+    def patch(self, vault_name, path, offset, data):
+        with vault_lifecycle.in_use(vault_name):
+            vault_agent.vault_patch(vault_name, path, offset, data)
+
+    def rename(self, vault_name, src, dst):
+        with vault_lifecycle.in_use(vault_name):
+            vault_agent.vault_rename(vault_name, src, dst)
+
+    def remove(self, vault_name, path):
+        with vault_lifecycle.in_use(vault_name):
+            vault_agent.vault_remove(vault_name, path)
+
+    def remove_tree(self, vault_name, path):
+        with vault_lifecycle.in_use(vault_name):
+            vault_agent.vault_remove_tree(vault_name, path)
+
+    def release(self, vault_name):
+        vault_agent.close_vault_agents(vault_name)
+
+
+class DirectoryStorage(VaultStorage):
+    """Plain host-filesystem I/O; subclasses decide where a vault lives"""
+
+    def __init__(self, use_mmap=False):
+        self.use_mmap = use_mmap
+
+    def resolve(self, vault_name, path):
+        raise NotImplementedError
+
+    def list(self, vault_name, path):
+        return sorted(name for name in os.listdir(self.resolve(vault_name, path))
+                      if not name.startswith("."))
+
+    def stat(self, vault_name, path):
+        st = os.stat(self.resolve(vault_name, path))
+        return st.st_size, int(st.st_mtime)
+
+    def iter_read(self, vault_name, path, offset=0, length=None):
+        with open(self.resolve(vault_name, path), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if length is None else min(size, offset + length)
+            if self.use_mmap and end > offset:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for start in range(offset, end, READ_CHUNK):
+                        yield mapped[start:min(start + READ_CHUNK, end)]
+                return
+            f.seek(offset)
+            remaining = end - offset
+            while remaining > 0:
+                chunk = f.read(min(READ_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def write(self, vault_name, path, chunks):
+        target = self.resolve(vault_name, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        part = target + ".part"
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(part, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(part, target)
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        return size, digest.hexdigest()
+
+    def patch(self, vault_name, path, offset, data):
+        with open(self.resolve(vault_name, path), "r+b") as f:
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rename(self, vault_name, src, dst):
+        os.replace(self.resolve(vault_name, src), self.resolve(vault_name, dst))
+
+    def remove(self, vault_name, path):
+        try:
+            os.remove(self.resolve(vault_name, path))
+        except FileNotFoundError:
+            pass
+
+    def remove_tree(self, vault_name, path):
+        shutil.rmtree(self.resolve(vault_name, path), ignore_errors=True)
+
+
+def vault_mounts(vault_name):
+    """{destination: (volume name, host path)} for a vault container's mounts"""
+    client = get_podman_client()
+    if client:
+        mounts = client.inspect_container(vault_name).get("Mounts") or []
+    else:
+        output = subprocess.run(["podman", "container", "inspect", vault_name],
+                                capture_output=True, text=True, check=True).stdout
+        mounts = json.loads(output)[0].get("Mounts") or []
+    return {mount["Destination"]: (mount.get("Name"), mount.get("Source")) for mount in mounts}
+
+
+class VolumeStorage(DirectoryStorage):
+    """Reads and writes the vault's named volumes directly at their host mountpoints
+
+    Only for trusted single-host deployments where the app runs with access
+    to Podman's volume storage. Volumes are found through the container's
+    mounts, since vaults claimed from the pool keep their volumes' names.
+    """
+
+    def __init__(self, use_mmap=False):
+        super().__init__(use_mmap)
+        self._mountpoints = {}
+        self._lock = threading.Lock()
+
+    def _mountpoint(self, vault_name, top):
+        with self._lock:
+            if (vault_name, top) in self._mountpoints:
+                return self._mountpoints[(vault_name, top)]
+        try:
+            _, mountpoint = vault_mounts(vault_name)[f"/vault/{top}"]
+        except Exception:
+            mountpoint = None
+        if not mountpoint:
+            # No container to ask - fall back to the default volume name
+            volume_name = f"{vault_name}_{top}"
+            client = get_podman_client()
+            if client:
+                mountpoint = client.inspect_volume(volume_name)["Mountpoint"]
+            else:
+                mountpoint = subprocess.run([
+                    "podman", "volume", "inspect", "--format", "{{.Mountpoint}}", volume_name
+                ], capture_output=True, text=True, check=True).stdout.strip()
+        with self._lock:
+            self._mountpoints[(vault_name, top)] = mountpoint
+        return mountpoint
+
+    def resolve(self, vault_name, path):
+        top, _, rest = path.partition("/")
+        parts = rest.split("/") if rest else []
+        # An empty part ("data//etc") would make rest absolute and escape the volume
+        if top not in ("data", "keys") or any(part in ("", ".", "..") for part in parts):
+            raise Exception(f"Invalid vault path: {path}")
+        return os.path.join(self._mountpoint(vault_name, top), rest)
+
+    def release(self, vault_name):
+        with self._lock:
+            for top in ("data", "keys"):
+                self._mountpoints.pop((vault_name, top), None)
+
+
+class LocalStorage(DirectoryStorage):
+    """Vaults as plain directories under a local root - for tests and benchmarks"""
+
+    requires_container = False
+
+    def __init__(self, root=LOCAL_STORAGE_ROOT, use_mmap=False):
+        super().__init__(use_mmap)
+        self.root = root
+
+    def resolve(self, vault_name, path):
+        parts = [vault_name, *path.split("/")]
+        if any(part in ("", ".", "..") for part in parts[:-1]) or parts[-1] in (".", ".."):
+            raise Exception(f"Invalid vault path: {path}")
+        return os.path.join(self.root, *parts)
+
+    def list_vaults(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if name.startswith("vault_"))
+
+    def provision(self, vault_name):
+        for top in ("data", "keys"):
+            os.makedirs(os.path.join(self.root, vault_name, top), exist_ok=True)
+
+    def destroy(self, vault_name):
+        shutil.rmtree(os.path.join(self.root, vault_name), ignore_errors=True)
+
+
+def shard_name(index):
+    return f"{SHARD_PREFIX}{index:02d}"
+
+def is_shard(container_name):
+    return re.fullmatch(rf"{SHARD_PREFIX}\d+", container_name) is not None
+
+def vault_container(vault_name):
+    """Container a vault lives in: itself, or the shard of a tenant vault"""
+    return vault_name.partition("/")[0]
+
+
+class ShardedStorage(VaultStorage):
+    """Tenant vaults ("vault_shard03/alice") inside shared shard containers
+
+    A tenant's files live under data/<tenant>/ and its keys under
+    keys/<tenant>/ in its shard. Per-user vault names pass straight through
+    to the wrapped backend, so both kinds work side by side (e.g. while
+    vaults are being migrated).
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.requires_container = inner.requires_container
+        self.needs_running_container = inner.needs_running_container
+        self.max_streams = inner.max_streams
+
+    def _locate(self, vault_name, path):
+        container, _, tenant = vault_name.partition("/")
+        if not tenant:
+            return container, path
+        top, _, rest = path.partition("/")
+        if top not in ("data", "keys") or not TENANT_PATTERN.fullmatch(tenant):
+            raise Exception(f"Invalid vault path: {vault_name}/{path}")
+        return container, f"{top}/{tenant}/{rest}".rstrip("/")
+
+    def list_tenants(self, shard):
+        return self.inner.list(shard, "keys")
+
+    def list_vaults(self):
+        return self.inner.list_vaults()
+
+    def list(self, vault_name, path):
+        return self.inner.list(*self._locate(vault_name, path))
+
+    def stat(self, vault_name, path):
+        return self.inner.stat(*self._locate(vault_name, path))
+
+    def read(self, vault_name, path):
+        return self.inner.read(*self._locate(vault_name, path))
+
+    def iter_read(self, vault_name, path, offset=0, length=None):
+        return self.inner.iter_read(*self._locate(vault_name, path), offset, length)
+
+    def write(self, vault_name, path, chunks):
+        return self.inner.write(*self._locate(vault_name, path), chunks)
+
+    @contextmanager
+    def writer(self, vault_name):
+        container, _ = self._locate(vault_name, "data")
+        with self.inner.writer(container) as write:
+            yield lambda path, chunks: write(self._locate(vault_name, path)[1], chunks)
+
+    def patch(self, vault_name, path, offset, data):
+        self.inner.patch(*self._locate(vault_name, path), offset, data)
+
+    def rename(self, vault_name, src, dst):
+        container, src = self._locate(vault_name, src)
+        self.inner.rename(container, src, self._locate(vault_name, dst)[1])
+
+    def remove(self, vault_name, path):
+        self.inner.remove(*self._locate(vault_name, path))
+
+    def remove_tree(self, vault_name, path):
+        self.inner.remove_tree(*self._locate(vault_name, path))
+
+    def provision(self, vault_name):
+        container, _, tenant = vault_name.partition("/")
+        self.inner.provision(container)
+        if tenant:
+            # Listing a tenant needs its data directory to exist
+            self.write(vault_name, "data/.keep", [])
+
+    def release(self, vault_name):
+        if "/" not in vault_name:  # A tenant shares its shard's handles
+            self.inner.release(vault_name)
+
+    def destroy(self, vault_name):
+        container, _, tenant = vault_name.partition("/")
+        if not tenant:
+            self.inner.destroy(vault_name)
+            return
+        for top in ("data", "keys"):
+            self.remove_tree(vault_name, top)
+
+
+def sha256_chunks(chunks, digest):
+    """Pass chunks through while feeding them to a hashlib digest"""
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+_storage = None
+
+def get_storage():
+    """The configured storage backend (PODVAULT_STORAGE=exec|volume|local)"""
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == "volume":
+            _storage = VolumeStorage(use_mmap=STORAGE_MMAP)
+        elif STORAGE_BACKEND == "local":
+            _storage = LocalStorage(use_mmap=STORAGE_MMAP)
+        else:
+            _storage = ExecStorage()
+        if SHARD_COUNT:
+            _storage = ShardedStorage(_storage)
+    return _storage
+
+def set_storage(storage):
+    """Swap the storage backend (tests, benchmarks)"""
+    global _storage
+    _storage = storage
@@ -0,0 +1,100 @@
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NEED_DATA
+import os
+import tarfile
+
+READ_SIZE = 64 * 1024
+
+
+class _PartReader:
+    """File-like reader over the data events of one multipart file part"""
+
+    def __init__(self, events):
+        self._events = events
+        self._buffer = b""
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self._buffer) < size):
+            event = next(self._events)
+            self._buffer += event.data
+            if not event.more_data:
+                self.done = True
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def drain(self):
+        while not self.done:
+            self.read(READ_SIZE)
+
+
+def _iter_events(stream, boundary):
+    decoder = MultipartDecoder(boundary)
+    while True:
+        chunk = stream.read(READ_SIZE)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while event is not NEED_DATA:
+            yield event
+            if isinstance(event, Epilogue):
+                return
+            event = decoder.next_event()
+        if not chunk:
+            return
+
+
+def _iter_parts(request, field_names):
+    """Yield (field name, filename, reader) for file parts of the given fields
+
+    Parts without a filename and hidden files (``.name``) are skipped, since
+    vault listings hide them.
+    """
+    boundary = request.mimetype_params.get('boundary')
+    if request.mimetype != 'multipart/form-data' or not boundary:
+        return
+
+    events = _iter_events(request.stream, boundary.encode())
+    for event in events:
+        if not isinstance(event, File) or event.name not in field_names:
+            continue
+        reader = _PartReader(e for e in events if isinstance(e, Data))
+        filename = os.path.basename(event.filename.replace('\\', '/'))
+        if filename and not filename.startswith('.'):
+            yield event.name, filename, reader
+        reader.drain()
+
+
+def iter_uploaded_files(request, field_name):
+    """Yield (filename, reader) for each file in a multipart request, as it arrives
+
+    Reads straight from the WSGI input so nothing is spooled to disk. Each
+    reader must be consumed before the next file is produced.
+    """
+    for _, filename, reader in _iter_parts(request, (field_name,)):
+        yield filename, reader
+
+
+def iter_bulk_upload(request, files_field='files', archive_field='archive'):
+    """Yield (filename, reader) for every file of a bulk upload, as it arrives
+
+    Plain files come from ``files_field``; tar archives (optionally
+    compressed) sent as ``archive_field`` are unpacked on the fly, one
+    entry per regular file. Entries are flattened to their base name and
+    hidden ones are skipped, as hidden files are for single uploads.
+    """
+    for field, filename, reader in _iter_parts(request, (files_field, archive_field)):
+        if field == files_field:
+            yield filename, reader
+            continue
+        with tarfile.open(fileobj=reader, mode='r|*') as archive:
+            for member in archive:
+                name = os.path.basename(member.name)
+                if member.isfile() and name and not name.startswith('.'):
+                    yield name, archive.extractfile(member)
+
+
+def open_uploaded_file(request, field_name):
+    """Return (filename, reader) for the first uploaded file, or (None, None)"""
+    return next(iter_uploaded_files(request, field_name), (None, None))
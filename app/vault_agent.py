@@ -0,0 +1,298 @@
+import os
+import subprocess
+import threading
+from contextlib import contextmanager
+
+from app import metrics
+
+AGENT_CHANNELS = int(os.environ.get("PODVAULT_AGENT_CHANNELS", "4"))
+FRAME_SIZE = 1024 * 1024
+
+# Long-lived shell running inside the vault container (alpine only ships
+# busybox, so the agent is plain sh). Requests are a command line followed by
+# one line per argument; replies are "OK <n>\n" plus n payload bytes, or
+# "ERR <message>\n". WRITE payloads arrive as "<n>\n<n bytes>" frames ending
+# with "0\n"; the file is written to .part, measured, hashed and renamed
+# (a stream that ends without the "0" terminator is discarded). PATCH
+# overwrites a few bytes in place, for rewrapping blob headers. PURGE
+# removes a whole directory tree (a tenant of a shard container).
+AGENT_SCRIPT = r'''
+cd /vault || exit 1
+T=$(mktemp)
+trap 'rm -f "$T"' EXIT
+ok() { printf 'OK %s\n' $(wc -c < "$T"); cat "$T"; }
+err() { printf 'ERR %s\n' "$1"; }
+while IFS= read -r cmd; do
+  IFS= read -r p
+  case "$cmd" in
+    LIST)
+      if [ -d "$p" ] && ls -1 "$p" > "$T" 2>/dev/null; then ok; else err "cannot list $p"; fi ;;
+    STAT)
+      if stat -c '%s %Y' "$p" > "$T" 2>/dev/null; then ok; else err "no such file $p"; fi ;;
+    READ)
+      IFS= read -r off; IFS= read -r len
+      if [ -f "$p" ] && exec 3< "$p"; then
+        n=$(( $(stat -L -c %s /proc/$$/fd/3) - off ))
+        [ "$len" != - ] && [ "$len" -lt "$n" ] && n=$len
+        [ "$n" -lt 0 ] && n=0
+        printf 'OK %s\n' "$n"
+        { tail -c +$((off + 1)) <&3; cat /dev/zero; } 2>/dev/null | head -c "$n"
+        exec 3<&-
+      else err "no such file $p"; fi ;;
+    WRITE)
+      out="$p.part"
+      { mkdir -p "$(dirname "$p")" && : > "$out"; } 2>/dev/null || out=/dev/null
+      complete=
+      while IFS= read -r n; do
+        [ "$n" = 0 ] && { complete=1; break; }
+        dd bs="$n" count=1 iflag=fullblock 2>/dev/null >> "$out"
+      done
+      if [ -n "$complete" ] && [ "$out" != /dev/null ] && wc -c < "$out" > "$T" && sha256sum "$out" >> "$T" \
+          && mv -f "$out" "$p"; then ok; else rm -f "$p.part"; err "cannot write $p"; fi ;;
+    PATCH)
+      IFS= read -r off; IFS= read -r n
+      if [ -f "$p" ] && dd of="$p" bs=1 seek="$off" count="$n" conv=notrunc,fsync 2>/dev/null; then
+        : > "$T"; ok
+      else
+        [ -f "$p" ] || dd of=/dev/null bs=1 count="$n" 2>/dev/null
+        err "cannot patch $p"
+      fi ;;
+    RENAME)
+      IFS= read -r q
+      if mv -f "$p" "$q" 2>/dev/null; then : > "$T"; ok; else err "cannot rename $p"; fi ;;
+    REMOVE)
+      if rm -f "$p" 2>/dev/null; then : > "$T"; ok; else err "cannot remove $p"; fi ;;
+    PURGE)
+      if rm -rf "$p" 2>/dev/null; then : > "$T"; ok; else err "cannot remove $p"; fi ;;
+    *)
+      err "unknown command $cmd" ;;
+  esac
+done
+'''
+
+
+class AgentError(Exception):
+    """Error reported by the agent; the channel itself is still usable"""
+
+
+class VaultAgent:
+    """One persistent `podman exec -i` channel into a vault container"""
+
+    def __init__(self, vault_name):
+        self.vault_name = vault_name
+        self.process = subprocess.Popen([
+            "podman", "exec", "-i", vault_name,
+            "sh", "-c", AGENT_SCRIPT
+        ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def send(self, command, *args):
+        lines = [command, *(str(a) for a in args)]
+        if any("\n" in line for line in lines):
+            raise AgentError("Newlines are not allowed in vault paths")
+        self.process.stdin.write(("\n".join(lines) + "\n").encode())
+        self.process.stdin.flush()
+
+    def reply(self):
+        """Read a reply header and return the payload length"""
+        line = self.process.stdout.readline()
+        if not line:
+            raise Exception(f"Vault agent for {self.vault_name} exited")
+        status, _, rest = line.decode(errors="replace").rstrip("\n").partition(" ")
+        if status == "ERR":
+            raise AgentError(rest)
+        if status != "OK":
+            raise Exception(f"Unexpected reply from vault agent: {line[:80]!r}")
+        return int(rest)
+
+    def payload(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise Exception(f"Vault agent for {self.vault_name} closed mid-reply")
+        return data
+
+    def call(self, command, *args):
+        self.send(command, *args)
+        return self.payload(self.reply())
+
+    def iter_read(self, path, offset=0, length=None, chunk_size=64 * 1024):
+        self.send("READ", path, offset, "-" if length is None else length)
+        remaining = self.reply()
+        while remaining:
+            chunk = self.payload(min(chunk_size, remaining))
+            remaining -= len(chunk)
+            yield chunk
+
+    def write(self, path, chunks):
+        """Stream chunks into path; returns (size, sha256) as stored"""
+        self.send("WRITE", path)
+        pending = []
+        pending_size = 0
+        for chunk in chunks:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size >= FRAME_SIZE:
+                self._frame(b"".join(pending))
+                pending, pending_size = [], 0
+        if pending_size:
+            self._frame(b"".join(pending))
+        self.process.stdin.write(b"0\n")
+        self.process.stdin.flush()
+        size_line, digest_line = self.payload(self.reply()).decode().splitlines()[:2]
+        return int(size_line.strip()), digest_line.split()[0]
+
+    def patch(self, path, offset, data):
+        """Overwrite len(data) bytes of path at offset, in place"""
+        self.send("PATCH", path, offset, len(data))
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+        self.payload(self.reply())
+
+    def _frame(self, data):
+        self.process.stdin.write(f"{len(data)}\n".encode() + data)
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except Exception:
+            pass
+        self.process.kill()
+        self.process.wait()
+
+
+class AgentPool:
+    """A small set of agent channels per vault, reused across requests"""
+
+    def __init__(self, vault_name, size=AGENT_CHANNELS):
+        self.vault_name = vault_name
+        self.size = size
+        self._idle = []
+        self._open = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                while self._idle:
+                    agent = self._idle.pop()
+                    if agent.alive:
+                        return agent
+                    self._open -= 1
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                self._cond.wait()
+        try:
+            with metrics.span("agent_start"):
+                return VaultAgent(self.vault_name)
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, agent):
+        with self._cond:
+            if agent is None:
+                self._open -= 1
+            else:
+                self._idle.append(agent)
+            self._cond.notify()
+
+    @contextmanager
+    def channel(self):
+        agent = self._acquire()
+        try:
+            yield agent
+        except AgentError:
+            self._release(agent)
+            raise
+        except BaseException:
+            # Framing may be out of sync (or a reader was abandoned) - drop it
+            agent.close()
+            self._release(None)
+            raise
+        else:
+            self._release(agent)
+
+    def close(self):
+        with self._cond:
+            for agent in self._idle:
+                agent.close()
+            self._open -= len(self._idle)
+            self._idle = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_agent_pool(vault_name):
+    """Get (or lazily create) the agent pool for a vault"""
+    with _pools_lock:
+        pool = _pools.get(vault_name)
+        if pool is None:
+            pool = _pools[vault_name] = AgentPool(vault_name)
+        return pool
+
+def close_vault_agents(vault_name):
+    """Shut down idle agents for a vault (e.g. before deleting it)"""
+    with _pools_lock:
+        pool = _pools.pop(vault_name, None)
+    if pool:
+        pool.close()
+
+# Read-only calls get one retry in case a cached channel died with its
+# container (restart, stop) since it was last used. Anything that changes
+# the vault is sent once: a channel can die after the agent acted on it.
+_RETRIED = ("LIST", "STAT", "READ")
+
+def _call(vault_name, command, *args):
+    attempts = 2 if command in _RETRIED else 1
+    for attempt in range(1, attempts + 1):
+        try:
+            with metrics.span(f"agent_{command.lower()}"), get_agent_pool(vault_name).channel() as agent:
+                return agent.call(command, *args)
+        except AgentError:
+            raise
+        except Exception:
+            if attempt == attempts:
+                raise
+
+def vault_list(vault_name, path):
+    """List entry names under a /vault-relative directory"""
+    output = _call(vault_name, "LIST", path).decode()
+    return [name for name in output.split("\n") if name.strip()]
+
+def vault_stat(vault_name, path):
+    """Return (size, mtime) for a /vault-relative file"""
+    size, mtime = _call(vault_name, "STAT", path).decode().split()
+    return int(size), int(mtime)
+
+def vault_read(vault_name, path):
+    """Read a whole (small) /vault-relative file"""
+    return _call(vault_name, "READ", path, 0, "-")
+
+def vault_iter_read(vault_name, path, offset=0, length=None):
+    """Stream a /vault-relative file, optionally from an offset"""
+    with get_agent_pool(vault_name).channel() as agent:
+        yield from agent.iter_read(path, offset, length)
+
+def vault_write(vault_name, path, chunks):
+    """Atomically write chunks to a /vault-relative file; returns (size, sha256)"""
+    with get_agent_pool(vault_name).channel() as agent:
+        return agent.write(path, chunks)
+
+def vault_patch(vault_name, path, offset, data):
+    """Overwrite bytes of a /vault-relative file in place"""
+    with metrics.span("agent_patch"), get_agent_pool(vault_name).channel() as agent:
+        agent.patch(path, offset, data)
+
+def vault_rename(vault_name, src, dst):
+    _call(vault_name, "RENAME", src, dst)
+
+def vault_remove(vault_name, path):
+    _call(vault_name, "REMOVE", path)
+
+def vault_remove_tree(vault_name, path):
+    _call(vault_name, "PURGE", path)
@@ -0,0 +1,121 @@
+"""Streaming export of many vault files as one tar or zip archive
+
+Files are decrypted one after another straight into the archive stream;
+nothing is staged on disk and memory stays at a few segments whatever the
+vault's size (legacy Fernet blobs, which only decrypt whole, excepted).
+Tar headers need each entry's size up front, which the blob header gives
+without decrypting anything.
+"""
+import logging
+import tarfile
+import time
+import zipfile
+import zlib
+
+from app.key_rotation import VaultDownload
+from app.storage import get_storage
+
+log = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {
+    # format: (mimetype, extension)
+    "tar": ("application/x-tar", "tar"),
+    "tar.gz": ("application/gzip", "tar.gz"),
+    "zip": ("application/zip", "zip"),
+}
+
+
+class _Sink:
+    """Write-only file object collecting output until it's drained"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_filenames(vault_name, selected=None):
+    """Stored names to export: the selection (if any) that exists, else every file"""
+    stored = sorted(name for name in get_storage().list(vault_name, "data") if name.endswith(".enc"))
+    if not selected:
+        return stored
+    wanted = set(selected)
+    return [name for name in stored if name in wanted]
+
+def _iter_entries(vault_name, filenames):
+    """Yield (archive name, plaintext size, mtime, chunks) per file, one open at a time"""
+    for filename in filenames:
+        try:
+            download = VaultDownload(filename, vault_name)
+        except Exception as e:
+            log.warning(f"⚠️ Skipping {filename} in export: {e}")  # Deleted since it was listed
+            continue
+        try:
+            mtime = int(download.etag.rsplit("-", 1)[1])
+            yield filename[:-len(".enc")], download.size, mtime, download.iter_range()
+        finally:
+            download.close()
+
+def _iter_tar(entries):
+    for name, size, mtime, chunks in entries:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o600
+        yield info.tobuf(tarfile.PAX_FORMAT)
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            yield chunk
+        if written != size:
+            raise Exception(f"{name} decrypted to {written} bytes, expected {size}")
+        yield tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+def _gzip(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _iter_zip(entries):
+    sink = _Sink()
+    method = zipfile.ZIP_DEFLATED
+    with zipfile.ZipFile(sink, "w", compression=method) as archive:
+        for name, size, mtime, chunks in entries:
+            info = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            info.compress_type = method
+            info.file_size = size  # Lets zipfile pick zip64 up front for big files
+            with archive.open(info, "w") as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+def iter_export(vault_name, filenames, fmt="tar.gz"):
+    """Yield the bytes of an archive of the given stored files"""
+    if fmt not in EXPORT_FORMATS:
+        raise Exception(f"Unknown export format: {fmt}")
+    entries = _iter_entries(vault_name, filenames)
+    if fmt == "zip":
+        chunks = _iter_zip(entries)
+    else:
+        chunks = _iter_tar(entries)
+        if fmt == "tar.gz":
+            chunks = _gzip(chunks)
+    for chunk in chunks:
+        if chunk:
+            yield chunk
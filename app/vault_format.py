@@ -0,0 +1,410 @@
+"""Segmented, streaming encryption format for vault blobs.
+
+Version 2 layout (written by default)::
+
+    "PVLT" | version (1) | flags (1) | segment size (4) | nonce prefix (7)
+    | key id (8) | wrapped data key (60)
+    segment 0 | segment 1 | ... | final segment
+
+Every file gets a random 256-bit data key. It is wrapped (AES-GCM) under a
+key-encryption key derived from the vault's master key, and the header
+records which master key did the wrapping. Rotating the master key only
+rewrites the 68 bytes of key id + wrapped key; the segments are untouched
+because their associated data is the fixed 17 byte header prefix.
+
+Every segment holds up to ``segment size`` plaintext bytes encrypted with
+AES-256-GCM, followed by its 16 byte tag. The nonce is the 7 byte prefix, a
+4 byte segment counter and a 1 byte "final segment" flag, so segments cannot
+be reordered, dropped or truncated without failing authentication.
+
+The flags byte is authenticated with the segments. Bit 0 marks a chunk
+store manifest (see chunk_store.py); the high nibble names the codec a
+chunk's plaintext was compressed with before encryption.
+
+Version 1 blobs ("PVLT" | 1 | segment size | salt (16) | nonce prefix) derive
+the data key from the master key with HKDF and the salt, and authenticate the
+whole header. Blobs that don't start with the magic are legacy Fernet tokens.
+Both are still read; rotation upgrades them to version 2.
+
+Functions that read blobs take either one master key or a keyring (a list
+of keys) - during a rotation both the old and the new key are valid. A
+version 2 header names its key; for older formats each key is tried.
+"""
+import base64
+import hashlib
+import os
+import struct
+from collections import namedtuple
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, MultiFernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"PVLT"
+VERSION = 2
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+SALT_SIZE = 16
+KEY_ID_SIZE = 8
+WRAPPED_KEY_SIZE = 12 + 32 + TAG_SIZE
+
+_HEADER_V1 = struct.Struct(">4sBI16s7s")
+_HEADER_V2 = struct.Struct(">4sBBI7s8s60s")
+_PREFIX_V2 = 17  # magic .. nonce prefix, the part segments authenticate
+HEADER_SIZES = {1: _HEADER_V1.size, 2: _HEADER_V2.size}
+HEADER_SIZE = HEADER_SIZES[VERSION]
+MAX_HEADER_SIZE = max(HEADER_SIZES.values())
+KEY_SLOT_OFFSET = _PREFIX_V2
+FLAG_MANIFEST = 0x01
+CODEC_SHIFT = 4
+_MAX_SEGMENTS = 2 ** 32
+
+Header = namedtuple("Header", "version flags segment_size nonce_prefix size aad salt key_id wrapped_key")
+
+
+def _hkdf(vault_key, info, salt=None):
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=info,
+    ).derive(base64.urlsafe_b64decode(vault_key))
+
+
+def _keyring(vault_keys):
+    """One key or a sequence of keys, as a list"""
+    if isinstance(vault_keys, (bytes, str)):
+        return [vault_keys]
+    return list(vault_keys)
+
+
+def key_id(vault_key):
+    """Short, non-secret identifier of a vault master key"""
+    return hashlib.sha256(_hkdf(vault_key, b"podvault-key-id")).digest()[:KEY_ID_SIZE]
+
+
+def wrap_key(vault_key, data_key, aad):
+    """Wrap a data key under the vault's key-encryption key"""
+    nonce = os.urandom(12)
+    return nonce + AESGCM(_hkdf(vault_key, b"podvault-kek-v2")).encrypt(nonce, data_key, aad)
+
+
+def unwrap_key(vault_key, wrapped, aad):
+    return AESGCM(_hkdf(vault_key, b"podvault-kek-v2")).decrypt(wrapped[:12], wrapped[12:], aad)
+
+
+def _nonce(prefix, index, final):
+    if index >= _MAX_SEGMENTS:
+        raise Exception("File too large for segmented format")
+    return prefix + struct.pack(">IB", index, 1 if final else 0)
+
+
+def _read_exact(src, size):
+    """Read up to ``size`` bytes, looping over short reads from pipes"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = src.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def is_legacy(prefix):
+    """True if a blob prefix is not in the segmented format (i.e. Fernet)"""
+    return not prefix.startswith(MAGIC)
+
+
+def header_size(prefix):
+    """Header length for a blob, from at least its first 5 bytes"""
+    if len(prefix) < 5 or is_legacy(prefix):
+        raise Exception("Not a segmented vault blob")
+    if prefix[4] not in HEADER_SIZES:
+        raise Exception(f"Unsupported vault format version: {prefix[4]}")
+    return HEADER_SIZES[prefix[4]]
+
+
+def parse_header(header):
+    """Parse a segmented header (extra trailing bytes are ignored)"""
+    size = header_size(header)
+    if len(header) < size:
+        raise Exception("Truncated vault blob header")
+    header = bytes(header[:size])
+    if header[4] == 1:
+        _, version, segment_size, salt, prefix = _HEADER_V1.unpack(header)
+        flags, aad, kid, wrapped = 0, header, None, None
+    else:
+        _, version, flags, segment_size, prefix, kid, wrapped = _HEADER_V2.unpack(header)
+        salt, aad = None, header[:_PREFIX_V2]
+    if segment_size <= 0:
+        raise Exception("Invalid segment size in header")
+    return Header(version, flags, segment_size, prefix, size, aad, salt, kid, wrapped)
+
+
+def file_key(vault_keys, header):
+    """Recover the AES key protecting a blob's segments
+
+    Version 1 blobs don't record their key, so the first key is used.
+    """
+    keys = _keyring(vault_keys)
+    if header.version == 1:
+        return _hkdf(keys[0], b"podvault-segment-v1", header.salt)
+    for vault_key in keys:
+        if header.key_id == key_id(vault_key):
+            return unwrap_key(vault_key, header.wrapped_key, header.aad)
+    raise Exception("Blob is wrapped with a different vault key")
+
+
+def _segment_ciphers(vault_keys, header):
+    """AES-GCM instances that may open a blob's segments (one, except for version 1)"""
+    keys = _keyring(vault_keys)
+    if header.version == 1:
+        return [AESGCM(_hkdf(k, b"podvault-segment-v1", header.salt)) for k in keys]
+    return [AESGCM(file_key(keys, header))]
+
+
+def _open_segment(ciphers, nonce, stored, aad):
+    """Decrypt a segment with the first cipher that works; returns (cipher, plaintext)"""
+    for aead in ciphers[:-1]:
+        try:
+            return aead, aead.decrypt(nonce, stored, aad)
+        except InvalidTag:
+            continue
+    return ciphers[-1], ciphers[-1].decrypt(nonce, stored, aad)
+
+
+def rewrap_key_slot(header_bytes, old_keys, new_key):
+    """New key id + wrapped key bytes (to write at KEY_SLOT_OFFSET) for new_key"""
+    header = parse_header(header_bytes)
+    if header.version != 2:
+        raise Exception("Only version 2 blobs can be rewrapped")
+    data_key = file_key(old_keys, header)
+    return key_id(new_key) + wrap_key(new_key, data_key, header.aad)
+
+
+def ciphertext_size(plaintext_size, segment_size=DEFAULT_SEGMENT_SIZE, header_size=HEADER_SIZE):
+    """Exact stored size of a plaintext of the given length"""
+    segments = max(1, -(-plaintext_size // segment_size))
+    return header_size + plaintext_size + segments * TAG_SIZE
+
+
+def plaintext_size(ciphertext_size, segment_size=DEFAULT_SEGMENT_SIZE, header_size=HEADER_SIZE):
+    """Plaintext length of a segmented blob of the given stored size"""
+    body = ciphertext_size - header_size
+    full, rest = divmod(body, segment_size + TAG_SIZE)
+    if body < TAG_SIZE or 0 < rest < TAG_SIZE:
+        raise Exception("Invalid encrypted blob size")
+    return full * segment_size + (rest - TAG_SIZE if rest else 0)
+
+
+def _new_blob(vault_key, segment_size, flags):
+    """Fresh data key and header for a new blob: (header bytes, data key, nonce prefix, aad)"""
+    prefix = os.urandom(NONCE_PREFIX_SIZE)
+    data_key = AESGCM.generate_key(bit_length=256)
+    aad = struct.pack(">4sBBI7s", MAGIC, VERSION, flags, segment_size, prefix)
+    header = aad + key_id(vault_key) + wrap_key(vault_key, data_key, aad)
+    return header, data_key, prefix, aad
+
+
+def _iter_stored_segments(src, segment_size):
+    """(index, final, stored bytes) for the segments of a blob positioned past its header"""
+    stored = segment_size + TAG_SIZE
+    index = 0
+    current = _read_exact(src, stored)
+    while True:
+        if len(current) < TAG_SIZE:
+            raise Exception("Truncated vault blob")
+        following = _read_exact(src, stored) if len(current) == stored else b""
+        yield index, not following, current
+        if not following:
+            return
+        current = following
+        index += 1
+
+
+def iter_encrypt(vault_key, src, segment_size=DEFAULT_SEGMENT_SIZE, flags=0, offload=None):
+    """Yield the encrypted blob for file-like ``src`` one segment at a time
+
+    ``offload`` (a crypto_pool.CryptoPool) moves the segment encryption to
+    worker processes.
+    """
+    header, data_key, prefix, aad = _new_blob(vault_key, segment_size, flags)
+    yield header
+
+    def segments():
+        index = 0
+        current = _read_exact(src, segment_size)
+        while True:
+            following = _read_exact(src, segment_size) if len(current) == segment_size else b""
+            final = not following
+            yield (_nonce(prefix, index, final),), current
+            if final:
+                return
+            current = following
+            index += 1
+
+    if offload:
+        yield from offload.map_segments([("encrypt", data_key, aad)], segments())
+        return
+    aead = AESGCM(data_key)
+    for (nonce,), plaintext in segments():
+        yield aead.encrypt(nonce, plaintext, aad)
+
+
+def read_blob_header(src):
+    """Read a header from a stream; returns (Header, or None for Fernet, and the raw bytes)"""
+    start = _read_exact(src, 5)
+    if is_legacy(start):
+        return None, start
+    raw = start + _read_exact(src, header_size(start) - len(start))
+    return parse_header(raw), raw
+
+
+def iter_decrypt(vault_keys, src, offload=None):
+    """Yield plaintext for a stored blob, segmented or legacy Fernet"""
+    header, raw = read_blob_header(src)
+    if header is None:
+        # Legacy Fernet tokens can only be decrypted as a whole
+        token = raw + src.read()
+        if not token:
+            raise Exception("Encrypted file is empty")
+        yield MultiFernet([Fernet(k) for k in _keyring(vault_keys)]).decrypt(token)
+        return
+
+    segments = _iter_stored_segments(src, header.segment_size)
+    if offload and header.version == 2:
+        steps = [("decrypt", file_key(vault_keys, header), header.aad)]
+        yield from offload.map_segments(steps, (((_nonce(header.nonce_prefix, index, final),), stored)
+                                                for index, final, stored in segments))
+        return
+
+    ciphers = _segment_ciphers(vault_keys, header)
+    for index, final, stored in segments:
+        aead, plaintext = _open_segment(ciphers, _nonce(header.nonce_prefix, index, final),
+                                        stored, header.aad)
+        ciphers = [aead]
+        yield plaintext
+
+
+def iter_reencrypt(old_keys, new_key, src, map_segments=map, offload=None):
+    """Re-encrypt a stored blob under a fresh data key, segment by segment
+
+    Segments keep their size and position, so each one is converted
+    independently; ``map_segments`` (an order-preserving map) lets the
+    caller run that CPU work on a pool while ``src`` is read in order.
+    ``offload`` (a crypto_pool.CryptoPool) takes precedence for version 2
+    blobs and converts segments in worker processes.
+    """
+    header, raw = read_blob_header(src)
+    if header is None:
+        # Fernet tokens are one unit; nothing to parallelize
+        rest = iter(lambda: src.read(DEFAULT_SEGMENT_SIZE), b"")
+        yield from iter_encrypt(new_key, ChunkReader(iter_decrypt(old_keys, ChunkReader([raw, *rest]))))
+        return
+
+    new_header, data_key, prefix, aad = _new_blob(new_key, header.segment_size, header.flags)
+    yield new_header
+
+    if offload and header.version == 2:
+        steps = [("decrypt", file_key(old_keys, header), header.aad), ("encrypt", data_key, aad)]
+        yield from offload.map_segments(steps, (
+            ((_nonce(header.nonce_prefix, index, final), _nonce(prefix, index, final)), stored)
+            for index, final, stored in _iter_stored_segments(src, header.segment_size)))
+        return
+
+    old_ciphers = _segment_ciphers(old_keys, header)
+    new_aead = AESGCM(data_key)
+
+    def convert(segment):
+        index, final, stored = segment
+        _, plaintext = _open_segment(old_ciphers, _nonce(header.nonce_prefix, index, final),
+                                     stored, header.aad)
+        return new_aead.encrypt(_nonce(prefix, index, final), plaintext, aad)
+
+    yield from map_segments(convert, _iter_stored_segments(src, header.segment_size))
+
+
+def segment_range(start, end, segment_size=DEFAULT_SEGMENT_SIZE, header_size=HEADER_SIZE):
+    """Segments covering plaintext [start, end): (first index, offset, count)"""
+    first = start // segment_size
+    last = (end - 1) // segment_size
+    return first, header_size + first * (segment_size + TAG_SIZE), last - first + 1
+
+
+def iter_decrypt_range(vault_keys, header, src, start, end, total_size, offload=None):
+    """Yield plaintext [start, end) from ``src`` positioned at its first segment"""
+    header = parse_header(header)
+    segment_size = header.segment_size
+    final_index = max(1, -(-total_size // segment_size)) - 1
+    first, _, count = segment_range(start, end, segment_size, header.size)
+
+    def segments():
+        for index in range(first, first + count):
+            stored = _read_exact(src, segment_size + TAG_SIZE)
+            if len(stored) < TAG_SIZE:
+                raise Exception("Truncated vault blob")
+            yield (_nonce(header.nonce_prefix, index, index == final_index),), stored
+
+    if offload and header.version == 2:
+        steps = [("decrypt", file_key(vault_keys, header), header.aad)]
+        plaintexts = offload.map_segments(steps, segments())
+    else:
+        def open_segments():
+            ciphers = _segment_ciphers(vault_keys, header)
+            for (nonce,), stored in segments():
+                aead, plaintext = _open_segment(ciphers, nonce, stored, header.aad)
+                ciphers = [aead]
+                yield plaintext
+        plaintexts = open_segments()
+
+    for index, plaintext in enumerate(plaintexts, first):
+        offset = index * segment_size
+        yield plaintext[max(start - offset, 0):end - offset]
+
+
+class ChunkReader:
+    """Minimal file-like wrapper around an iterator of byte chunks"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def encrypt_stream(vault_key, src, dst, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Encrypt ``src`` into ``dst``; returns the number of bytes written"""
+    written = 0
+    for chunk in iter_encrypt(vault_key, src, segment_size):
+        dst.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def decrypt_stream(vault_keys, src, dst, offload=None):
+    """Decrypt ``src`` into ``dst``; returns the plaintext size"""
+    written = 0
+    for chunk in iter_decrypt(vault_keys, src, offload):
+        dst.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def reencrypt_stream(old_keys, new_key, src, dst, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Re-encrypt a stored blob under a new key without buffering it"""
+    return encrypt_stream(new_key, ChunkReader(iter_decrypt(old_keys, src)), dst, segment_size)
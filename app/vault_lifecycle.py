@@ -0,0 +1,252 @@
+"""Idle vault hibernation and on-demand wake-up
+
+Vault containers are stopped once their owner has been away for
+IDLE_MINUTES, so a host only pays memory and PIDs for active users.
+The exec storage backend wakes a vault before touching it; concurrent
+wake-ups of one vault share a single `start`, and a vault is never
+stopped while an operation is using it. User requests (not background
+jobs) are what keep a vault awake.
+
+Several app processes share the containers, so each holds the vault's
+``awake:<vault>`` lease shared (job_leases) while it uses the vault or its
+owner was active there within IDLE_MINUTES, and lets go once neither is
+true (release_idle_vaults, in every process). A vault is only stopped
+under that lease held exclusively - when no process holds it at all -
+and only one process looks for idle vaults (hibernate_idle_vaults).
+"""
+import logging
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from app.podman_api import get_podman_client
+
+log = logging.getLogger(__name__)
+
+IDLE_MINUTES = float(os.environ.get("PODVAULT_IDLE_MINUTES", "30"))
+HIBERNATE_CHECK_SECONDS = int(os.environ.get("PODVAULT_HIBERNATE_CHECK_SECONDS", "60"))
+# How long using a vault waits for another process to finish stopping it
+STOP_WAIT_SECONDS = 30
+
+
+class _Transition:
+    """A start or stop in flight for one vault; others wait on ``done``"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.error = None
+        self.done = threading.Event()
+
+
+_lock = threading.Lock()
+_running = set()       # Vaults known to be running
+_transitions = {}      # vault -> _Transition in flight
+_active = {}           # vault -> operations using it right now
+_last_used = {}        # vault -> monotonic time of the last user request
+_awake = set()         # Vaults whose awake lease this process holds
+_lease_lock = threading.Lock()  # Taking and dropping awake leases
+
+
+def _start_container(vault_name):
+    client = get_podman_client()
+    if client:
+        client.start_container(vault_name)
+    else:
+        subprocess.run(["podman", "start", vault_name], capture_output=True, text=True, check=True)
+
+def _stop_container(vault_name):
+    client = get_podman_client()
+    if client:
+        client.stop_container(vault_name)
+    else:
+        subprocess.run(["podman", "stop", vault_name], capture_output=True, text=True, check=True)
+
+def _awake_lease(vault_name):
+    return f"awake:{vault_name}"
+
+def _hold_awake(vault_name, wait=STOP_WAIT_SECONDS):
+    """Hold the vault's awake lease, so no app process stops it; False if it is being stopped"""
+    from app import job_leases
+
+    with _lock:
+        if vault_name in _awake:
+            return True
+    with _lease_lock:
+        with _lock:
+            if vault_name in _awake:
+                return True
+        if not job_leases.acquire_shared(_awake_lease(vault_name), timeout=wait):
+            return False
+        with _lock:
+            # Another process may have stopped it while we didn't hold the lease
+            if vault_name not in _transitions and not _active.get(vault_name):
+                _running.discard(vault_name)
+            _awake.add(vault_name)
+    return True
+
+def _drop_awake(vault_name, idle_since):
+    """Let go of the vault's awake lease unless it's in use here or was used after ``idle_since``"""
+    from app import job_leases
+
+    with _lease_lock:
+        with _lock:
+            if _active.get(vault_name) or _last_used.get(vault_name, 0) > idle_since:
+                return False
+            if vault_name not in _awake:
+                return True
+            _awake.discard(vault_name)
+        job_leases.release_shared(_awake_lease(vault_name))
+    return True
+
+def touch(vault_name):
+    """Record user activity on a vault (resets its idle clock, here and for every process)"""
+    with _lock:
+        _last_used[vault_name] = time.monotonic()
+    if IDLE_MINUTES > 0:
+        _hold_awake(vault_name, wait=0)  # If it's being stopped, the next access waits for that
+
+def wake_vault(vault_name):
+    """Make sure a vault's container is running, sharing any start already in flight"""
+    while True:
+        with _lock:
+            if vault_name in _running:
+                return
+            transition = _transitions.get(vault_name)
+            leader = transition is None
+            if leader:
+                transition = _transitions[vault_name] = _Transition("start")
+        if not leader:
+            transition.done.wait()
+            if transition.kind == "start" and transition.error:
+                raise transition.error
+            continue  # Started by someone else, or stopped - look again
+
+        try:
+            _start_container(vault_name)
+        except Exception as e:
+            transition.error = Exception(f"Failed to wake vault {vault_name}: {e}")
+        with _lock:
+            del _transitions[vault_name]
+            if transition.error is None:
+                _running.add(vault_name)
+        transition.done.set()
+        if transition.error:
+            raise transition.error
+        log.info(f"☀️ Woke vault {vault_name}")
+        return
+
+def wake_vault_async(vault_name):
+    """Start waking a vault in the background (e.g. as its owner logs in)"""
+    with _lock:
+        if vault_name in _running or vault_name in _transitions:
+            return
+
+    def wake():
+        try:
+            wake_vault(vault_name)
+        except Exception as e:
+            log.warning(f"⚠️ {e}")
+
+    threading.Thread(target=wake, name=f"wake-{vault_name}", daemon=True).start()
+
+@contextmanager
+def in_use(vault_name):
+    """Keep a vault awake for the duration of a storage operation"""
+    while True:
+        if not _hold_awake(vault_name):
+            raise Exception(f"Vault {vault_name} is still being hibernated, please try again")
+        wake_vault(vault_name)
+        with _lock:
+            # Re-check: it may have been stopped (or its lease let go) since
+            if vault_name in _running and vault_name in _awake:
+                _active[vault_name] = _active.get(vault_name, 0) + 1
+                break
+    try:
+        yield
+    finally:
+        with _lock:
+            remaining = _active.pop(vault_name) - 1
+            if remaining:
+                _active[vault_name] = remaining
+
+def hibernate_vault(vault_name, idle_since):
+    """Stop a vault unless it's in use or had user activity after ``idle_since``
+
+    Here or in any other app process: the stop needs the vault's awake
+    lease exclusively. Returns True if it was stopped.
+    """
+    from app import job_leases
+    from app.storage import get_storage
+
+    with _lock:
+        if vault_name not in _running or vault_name in _transitions:
+            return False
+    if not _drop_awake(vault_name, idle_since):
+        return False
+    if not job_leases.acquire_exclusive(_awake_lease(vault_name)):
+        return False  # Another process is using it
+    try:
+        with _lock:
+            if (vault_name not in _running or vault_name in _transitions
+                    or _active.get(vault_name) or _last_used.get(vault_name, 0) > idle_since):
+                return False
+            _running.discard(vault_name)
+            transition = _transitions[vault_name] = _Transition("stop")
+
+        get_storage().release(vault_name)
+        try:
+            _stop_container(vault_name)
+            log.info(f"💤 Hibernated idle vault {vault_name}")
+            stopped = True
+        except Exception as e:
+            log.warning(f"⚠️ Failed to hibernate {vault_name}: {e}")
+            stopped = False
+        with _lock:
+            del _transitions[vault_name]
+            if not stopped:
+                _running.add(vault_name)
+        transition.done.set()
+        return stopped
+    finally:
+        job_leases.release(_awake_lease(vault_name))
+
+def release_idle_vaults():
+    """Let go of the vaults this process hasn't used for IDLE_MINUTES (scheduler job, every process)"""
+    if IDLE_MINUTES <= 0:
+        return
+    idle_since = time.monotonic() - IDLE_MINUTES * 60
+    with _lock:
+        held = sorted(_awake)
+    for vault_name in held:
+        _drop_awake(vault_name, idle_since)
+
+def hibernate_idle_vaults():
+    """Stop vaults whose owners have been idle for IDLE_MINUTES (scheduler job, one process)"""
+    from app.podman_manager import list_vault_containers
+    from app.storage import get_storage
+
+    if IDLE_MINUTES <= 0 or not get_storage().requires_container:
+        return
+    try:
+        running = set(list_vault_containers())
+    except Exception as e:
+        log.error(f"❌ Failed to list vaults for hibernation: {e}")
+        return
+
+    now = time.monotonic()
+    with _lock:
+        # Vaults first seen now (e.g. after an app restart) start their idle clock here
+        for vault_name in running:
+            _running.add(vault_name)
+            _last_used.setdefault(vault_name, now)
+        # Forget vaults stopped behind our back; the next access starts them again
+        for vault_name in _running - running:
+            if vault_name not in _transitions and not _active.get(vault_name):
+                _running.discard(vault_name)
+
+    idle_since = now - IDLE_MINUTES * 60
+    hibernated = sum(hibernate_vault(vault_name, idle_since) for vault_name in sorted(running))
+    if hibernated:
+        log.info(f"💤 Hibernated {hibernated} idle vaults ({len(running) - hibernated} still running)")
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+# How long rotation waits for a vault (or file) to be free before deferring it
+ROTATION_LOCK_TIMEOUT = float(os.environ.get("PODVAULT_ROTATION_LOCK_TIMEOUT", "60"))
+
+
+class VaultBusy(Exception):
+    """The vault is already being rotated, or a lock didn't free up in time"""
+
+
+class VaultLock:
+    """Readers/writer lock (in-process), preferring writers
+
+    Once a writer is waiting, new readers queue behind it so a steady
+    stream of transfers can't starve it. Not reentrant: don't take a
+    shared lock twice on one thread.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_shared(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self, timeout=None):
+        with self._cond:
+            self._writers_waiting += 1
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                while self._writer or self._readers:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise VaultBusy(f"Still in use after {timeout:g}s")
+                    self._cond.wait(remaining)
+            finally:
+                self._writers_waiting -= 1
+                self._cond.notify_all()
+            self._writer = True
+
+    def release_exclusive(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def shared(self):
+        self.acquire_shared()
+        try:
+            yield
+        finally:
+            self.release_shared()
+
+    @contextmanager
+    def exclusive(self, timeout=None):
+        self.acquire_exclusive(timeout)
+        try:
+            yield
+        finally:
+            self.release_exclusive()
+
+
+_locks = {}
+_file_locks = weakref.WeakValueDictionary()
+_rotating = set()
+_locks_lock = threading.Lock()
+
+def vault_lock(vault_name):
+    """Lock guarding a vault's keys
+
+    Held shared while a key is loaded and used to write a file (uploads),
+    exclusively while rotation switches keys.
+    """
+    with _locks_lock:
+        lock = _locks.get(vault_name)
+        if lock is None:
+            lock = _locks[vault_name] = VaultLock()
+        return lock
+
+def file_lock(vault_name, filename):
+    """Lock guarding one stored file: shared to read it, exclusive to replace or rewrap it"""
+    with _locks_lock:
+        lock = _file_locks.get((vault_name, filename))
+        if lock is None:
+            lock = _file_locks[(vault_name, filename)] = VaultLock()
+        return lock
+
+@contextmanager
+def rotation_slot(vault_name):
+    """Claim the right to rotate a vault; VaultBusy if it's already rotating"""
+    with _locks_lock:
+        if vault_name in _rotating:
+            raise VaultBusy("Vault is already being rotated")
+        _rotating.add(vault_name)
+    try:
+        yield
+    finally:
+        with _locks_lock:
+            _rotating.discard(vault_name)
@@ -0,0 +1,109 @@
+"""Pool of pre-created vault containers
+
+Creating a vault means two volumes, a container start and a key upload -
+seconds of work that used to sit inside the registration request. The pool
+does that ahead of time under throwaway names (``vault-pool-<id>``, which
+don't match ``vault_`` so rotation and listings ignore them); registration
+renames a ready one to ``vault_<username>`` and a background refill tops the
+pool back up. Volumes keep their pool names; storage finds them through the
+container's mounts.
+"""
+import logging
+import os
+import secrets
+import subprocess
+import threading
+
+from app.podman_api import get_podman_client
+from app.podman_manager import create_vault_container, rename_vault
+from app.storage import SHARD_COUNT, get_storage
+
+log = logging.getLogger(__name__)
+
+POOL_PREFIX = "vault-pool-"
+POOL_SIZE = int(os.environ.get("PODVAULT_POOL_SIZE", "2"))
+POOL_REFILL_SECONDS = int(os.environ.get("PODVAULT_POOL_REFILL_SECONDS", "60"))
+
+_refill_lock = threading.Lock()
+_claim_lock = threading.Lock()
+
+
+def _enabled():
+    # Sharded vaults live in a few long-lived containers; nothing to pre-warm
+    return POOL_SIZE > 0 and not SHARD_COUNT and get_storage().requires_container
+
+def list_pool_vaults():
+    """Names of pooled containers (in any state)"""
+    client = get_podman_client()
+    if client:
+        containers = client.list_containers(f"^{POOL_PREFIX}", all=True)
+        names = [c["Names"][0] for c in containers]
+    else:
+        result = subprocess.run([
+            "podman", "ps", "-a", "--filter", f"name=^{POOL_PREFIX}", "--format", "{{.Names}}"
+        ], capture_output=True, text=True, check=True)
+        names = result.stdout.split()
+    return sorted(name for name in names if name.startswith(POOL_PREFIX))
+
+def claim_pool_vault(vault_name):
+    """Turn a pooled container into vault_name; False if none could be claimed"""
+    if not _enabled():
+        return False
+    claimed = None
+    # One claim at a time, so concurrent registrations don't race for the same container
+    with _claim_lock:
+        try:
+            candidates = list_pool_vaults()
+        except Exception as e:
+            log.warning(f"⚠️ Failed to list vault pool: {e}")
+            candidates = []
+        for pool_name in candidates:
+            try:
+                rename_vault(pool_name, vault_name)
+            except Exception as e:
+                log.warning(f"⚠️ Could not claim {pool_name}: {e}")
+                continue
+            claimed = pool_name
+            break
+    refill_pool_async()
+    if claimed is None:
+        return False
+
+    # Pooled containers may have been stopped (host restart) since they were made
+    try:
+        client = get_podman_client()
+        if client:
+            client.start_container(vault_name)
+        else:
+            subprocess.run(["podman", "start", vault_name], stderr=subprocess.DEVNULL, check=False)
+    except Exception as e:
+        log.warning(f"⚠️ Failed to start claimed vault {vault_name}: {e}")
+    log.info(f"✅ Claimed pre-warmed {claimed} as {vault_name}")
+    return True
+
+def refill_pool():
+    """Create containers until POOL_SIZE are waiting (scheduler job)"""
+    if not _enabled():
+        return
+    if not _refill_lock.acquire(blocking=False):
+        return  # Another refill is already running
+    try:
+        try:
+            missing = POOL_SIZE - len(list_pool_vaults())
+        except Exception as e:
+            log.error(f"❌ Failed to list vault pool: {e}")
+            return
+        for _ in range(missing):
+            pool_name = f"{POOL_PREFIX}{secrets.token_hex(6)}"
+            try:
+                create_vault_container(pool_name)
+            except Exception as e:
+                log.error(f"❌ Failed to pre-warm vault {pool_name}: {e}")
+                return
+    finally:
+        _refill_lock.release()
+
+def refill_pool_async():
+    """Start a refill in the background (no-op if one is running)"""
+    if _enabled():
+        threading.Thread(target=refill_pool, name="vault-pool-refill", daemon=True).start()
@@ -0,0 +1,84 @@
+"""Compare two benchmark result files, e.g. from two commits
+
+    python -m benchmarks.compare before.json after.json
+    python -m benchmarks.compare before.json after.json --threshold 0.05
+
+Cases are matched by name and parameters. A case regressed when its median
+time grew by more than --threshold (a fraction) or its peak RSS by more
+than --memory-threshold and at least 1 MiB. Exits 1 if anything regressed
+or failed, so it can gate a CI job.
+"""
+import argparse
+import json
+import sys
+
+_MIN_MEMORY_GROWTH = 1024 * 1024
+
+
+def _key(result):
+    return result["case"], json.dumps(result["params"], sort_keys=True)
+
+def _load(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report["meta"], {_key(result): result for result in report["results"]}
+
+def _label(key):
+    case, params = key
+    return f"{case} " + " ".join(f"{name}={value}" for name, value in json.loads(params).items())
+
+def compare(before, after, threshold=0.1, memory_threshold=0.2):
+    """[(label, before seconds, after seconds, change, problems)] for cases in both"""
+    rows = []
+    for key, new in after.items():
+        old = before.get(key)
+        if old is None:
+            continue
+        problems = []
+        if "error" in new:
+            rows.append((_label(key), old.get("seconds"), None, None, [f"failed: {new['error']}"]))
+            continue
+        if "error" in old:
+            rows.append((_label(key), None, new["seconds"], None, []))
+            continue
+        change = new["seconds"] / old["seconds"] - 1 if old["seconds"] else 0.0
+        if change > threshold:
+            problems.append("slower")
+        growth = new["peak_rss"] - old["peak_rss"]
+        if growth > max(old["peak_rss"] * memory_threshold, _MIN_MEMORY_GROWTH):
+            problems.append(f"+{growth / 1024 ** 2:.0f} MiB peak memory")
+        rows.append((_label(key), old["seconds"], new["seconds"], change, problems))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.compare", description=__doc__.split("\n")[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Allowed time growth (fraction)")
+    parser.add_argument("--memory-threshold", type=float, default=0.2, help="Allowed peak RSS growth (fraction)")
+    args = parser.parse_args(argv)
+
+    before_meta, before = _load(args.before)
+    after_meta, after = _load(args.after)
+    print(f"{(before_meta.get('commit') or '?')[:10]} -> {(after_meta.get('commit') or '?')[:10]}"
+          + (" (uncommitted changes)" if after_meta.get("dirty") else ""))
+    for meta_key in ("runtime", "paced", "cpu_count", "python"):
+        if before_meta.get(meta_key) != after_meta.get(meta_key):
+            print(f"⚠️ {meta_key} differs: {before_meta.get(meta_key)} vs {after_meta.get(meta_key)}")
+
+    regressions = 0
+    for label, old, new, change, problems in compare(before, after, args.threshold, args.memory_threshold):
+        timing = (f"{old * 1000:>10.2f} ms -> {new * 1000:>10.2f} ms {change:>+7.1%}"
+                  if change is not None else f"{'-':>36}")
+        marker = "❌" if problems else "✅"
+        print(f"{marker} {label:<44} {timing}  {', '.join(problems)}".rstrip())
+        regressions += bool(problems)
+    missing = sorted(set(before) - set(after))
+    for key in missing:
+        print(f"➖ {_label(key)} not in {args.after}")
+    print(f"📊 {regressions} regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
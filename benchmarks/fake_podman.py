@@ -0,0 +1,99 @@
+"""Stand-in `podman` command for the agent benchmark runtime
+
+A container is a directory $FAKE_PODMAN_ROOT/<name> that plays its /vault
+tree. Covers what the exec storage backend, vault creation and the vault
+lifecycle call:
+
+    exec [-i] <name> <command...>   runs the command (the vault agent) against
+                                    the directory, after $FAKE_PODMAN_EXEC_LATENCY
+    run -d --name <name> ...        creates the directory, taking as long
+    volume create <name>            nothing - volumes are the container's directory
+    start / stop <name>             flips a .stopped marker
+    ps [-a] [--filter name=<re>]    lists containers named vault_*
+
+``install`` puts the command first on PATH for this process and its children.
+"""
+import os
+import re
+import sys
+import time
+
+
+def install(root, exec_latency=0.0):
+    """Make `podman` run this script for containers under root"""
+    bin_dir = os.path.join(root, ".bin")
+    os.makedirs(bin_dir, exist_ok=True)
+    shim = os.path.join(bin_dir, "podman")
+    with open(shim, "w") as f:
+        f.write(f"#!/bin/sh\nexec '{sys.executable}' '{os.path.abspath(__file__)}' \"$@\"\n")
+    os.chmod(shim, 0o755)
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+    os.environ["FAKE_PODMAN_ROOT"] = root
+    os.environ["FAKE_PODMAN_EXEC_LATENCY"] = str(exec_latency)
+
+def _container(root, name):
+    path = os.path.join(root, name)
+    if not os.path.isdir(path):
+        sys.stderr.write(f"Error: no container with name or ID \"{name}\" found\n")
+        sys.exit(125)
+    return path
+
+def _wait():
+    latency = float(os.environ.get("FAKE_PODMAN_EXEC_LATENCY", "0"))
+    if latency:
+        time.sleep(latency)
+
+def _option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+def main(args):
+    root = os.environ["FAKE_PODMAN_ROOT"]
+    command, args = args[0], args[1:]
+
+    if command == "exec":
+        args = [arg for arg in args if arg != "-i"]
+        path = _container(root, args[0])
+        _wait()
+        argv = [arg.replace("/vault", path) for arg in args[1:]]
+        os.execvp(argv[0], argv)
+
+    if command == "run":
+        path = os.path.join(root, _option(args, "--name"))
+        try:
+            os.makedirs(path)
+        except FileExistsError:
+            sys.stderr.write(f"Error: container name \"{os.path.basename(path)}\" is already in use\n")
+            return 125
+        for top in ("data", "keys"):
+            os.makedirs(os.path.join(path, top))
+        _wait()
+        print(os.urandom(32).hex())
+        return 0
+
+    if command == "volume":
+        return 0
+
+    if command in ("start", "stop"):
+        marker = os.path.join(_container(root, args[0]), ".stopped")
+        if command == "stop":
+            open(marker, "w").close()
+        elif os.path.exists(marker):
+            os.remove(marker)
+        print(args[0])
+        return 0
+
+    if command == "ps":
+        show_all = "-a" in args
+        pattern = _option(args, "--filter", "name=").partition("=")[2]
+        for name in sorted(os.listdir(root)):
+            stopped = os.path.exists(os.path.join(root, name, ".stopped"))
+            if name.startswith("vault_") and re.search(pattern, name) and (show_all or not stopped):
+                print(name)
+        return 0
+
+    sys.stderr.write(f"Error: fake podman does not support `{command}`\n")
+    return 125
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
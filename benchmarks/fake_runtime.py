@@ -0,0 +1,89 @@
+"""Fake container runtimes the benchmarks run against - no Podman needed
+
+    simulated  Vaults are directories (the local backend). Every storage
+               call waits exec_latency, like a podman exec round trip, and
+               file data moves at cp_bandwidth bytes/sec, like podman cp.
+    agent      The real exec backend: vault agents run under a stand-in
+               `podman` command (fake_podman.py) against directories, each
+               agent starting exec_latency after it was asked for.
+
+Either way a vault is the directory <root>/<vault name> holding data/ and
+keys/, so vaults are seeded through the plain local backend and only the
+operation being measured pays the runtime's costs.
+
+The app reads its environment at import time, so run.py sets it up for
+the runtime before this module (or anything from ``app``) is imported.
+"""
+import time
+
+from app.storage import ExecStorage, LocalStorage
+from app.vault_agent import AGENT_CHANNELS
+
+
+class SimulatedStorage(LocalStorage):
+    """The local backend, plus an exec round trip per call and cp-like bandwidth"""
+
+    # Same stream limit as the agent backend, so rotation sizes its workers alike
+    max_streams = AGENT_CHANNELS
+
+    def __init__(self, root, exec_latency=0.0, cp_bandwidth=0):
+        super().__init__(root)
+        self.exec_latency = exec_latency
+        self.cp_bandwidth = cp_bandwidth
+
+    def _exec(self):
+        if self.exec_latency:
+            time.sleep(self.exec_latency)
+
+    def _transfer(self, chunks):
+        for chunk in chunks:
+            if self.cp_bandwidth:
+                time.sleep(len(chunk) / self.cp_bandwidth)
+            yield chunk
+
+    def list_vaults(self):
+        self._exec()
+        return super().list_vaults()
+
+    def list(self, vault_name, path):
+        self._exec()
+        return super().list(vault_name, path)
+
+    def stat(self, vault_name, path):
+        self._exec()
+        return super().stat(vault_name, path)
+
+    def iter_read(self, vault_name, path, offset=0, length=None):
+        self._exec()
+        yield from self._transfer(super().iter_read(vault_name, path, offset, length))
+
+    def write(self, vault_name, path, chunks):
+        self._exec()
+        return super().write(vault_name, path, self._transfer(chunks))
+
+    def patch(self, vault_name, path, offset, data):
+        self._exec()
+        super().patch(vault_name, path, offset, data)
+
+    def rename(self, vault_name, src, dst):
+        self._exec()
+        super().rename(vault_name, src, dst)
+
+    def remove(self, vault_name, path):
+        self._exec()
+        super().remove(vault_name, path)
+
+    def remove_tree(self, vault_name, path):
+        self._exec()
+        super().remove_tree(vault_name, path)
+
+
+def make_storage(runtime, root, exec_latency=0.0, cp_bandwidth=0):
+    """The storage backend the measured operations go through"""
+    if runtime == "agent":
+        return ExecStorage()
+    return SimulatedStorage(root, exec_latency, cp_bandwidth)
+
+def seed_storage(root):
+    """Cost-free storage over the same directories, for setting vaults up"""
+    return LocalStorage(root)
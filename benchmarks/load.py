@@ -0,0 +1,401 @@
+"""Concurrent load generator for the web app, with latency percentiles per route
+
+    python -m benchmarks.load                                  # 20 users for 60s
+    python -m benchmarks.load --users 50 --duration 120 --rotate-every 15
+    python -m benchmarks.load --mix upload=5,download=5,list=1 --upload-sizes 1M,16M
+    python -m benchmarks.load --url http://localhost:8080      # an app already running
+
+Unless --url is given, the app is started in this process on a fresh
+database and fake runtime (the ones benchmarks.run uses), scheduler
+included. Every simulated user registers and logs in, then picks actions
+from the mix until the time is up:
+
+    register   sign up as a new user and carry on as them
+    login      log in again
+    upload     POST /upload of a file of one of --upload-sizes
+    download   GET /decrypt/<file> of one of the user's files, read to the end
+    list       GET /home (file list and activity log)
+    dashboard  GET /dashboard
+
+A request's latency runs until its whole response has been read. It counts
+as an error on a connection failure, a 5xx, a redirect somewhere other than
+where success leads, or a ❌ message flashed in reply. --rotate-every runs
+rotate_all_vaults on that interval while the traffic flows. Results go to
+JSON, with throughput, p50/p95/p99 latency and error rate per route.
+"""
+import argparse
+import atexit
+import base64
+import http.client
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from http.cookies import SimpleCookie
+from urllib.parse import quote, urlparse
+
+from benchmarks.run import describe_run, parse_size, prepare_environment
+
+ROUTES = ("register", "login", "upload", "download", "list", "dashboard")
+DEFAULT_MIX = "register=1,login=1,upload=3,download=4,list=4,dashboard=1"
+_SAMPLE_ERRORS = 5
+
+
+class _Results:
+    """Latencies and outcomes per route, shared by all users"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {route: [] for route in ROUTES}
+        self.errors = {route: 0 for route in ROUTES}
+        self.statuses = {route: {} for route in ROUTES}
+        self.bytes = {route: 0 for route in ROUTES}
+        self.samples = {route: [] for route in ROUTES}
+
+    def add(self, route, seconds, status, error=None, nbytes=0):
+        with self._lock:
+            self.latencies[route].append(seconds)
+            self.statuses[route][str(status)] = self.statuses[route].get(str(status), 0) + 1
+            self.bytes[route] += nbytes
+            if error:
+                self.errors[route] += 1
+                if len(self.samples[route]) < _SAMPLE_ERRORS:
+                    self.samples[route].append(error)
+
+
+def _flashed_errors(session_cookie):
+    """❌ messages waiting in a Flask session cookie (read, not verified)"""
+    if not session_cookie:
+        return []
+    compressed = session_cookie.startswith(".")
+    payload = session_cookie.lstrip(".").split(".")[0]
+    try:
+        data = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        session = json.loads(zlib.decompress(data) if compressed else data)
+    except Exception:
+        return []
+    found = []
+    def walk(value):
+        if isinstance(value, str) and value.startswith("❌"):
+            found.append(value)
+        elif isinstance(value, dict):
+            for item in value.values():
+                walk(item)
+        elif isinstance(value, list):
+            for item in value:
+                walk(item)
+    walk(session.get("_flashes"))
+    return found
+
+
+class _Client:
+    """One user's keep-alive connection and cookies"""
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self._connection_class = (http.client.HTTPSConnection if parsed.scheme == "https"
+                                  else http.client.HTTPConnection)
+        self._netloc = parsed.netloc
+        self._prefix = parsed.path.rstrip("/")
+        self._connection = None
+        self.cookies = {}
+
+    def _send(self, method, path, body, headers):
+        if self._connection is None:
+            self._connection = self._connection_class(self._netloc, timeout=300)
+        self._connection.request(method, self._prefix + path, body=body, headers=headers)
+        response = self._connection.getresponse()
+        nbytes = 0
+        while chunk := response.read(256 * 1024):
+            nbytes += len(chunk)
+        return response, nbytes
+
+    def request(self, method, path, body=None, headers=None):
+        """(status, Location header, response bytes); cookies are kept"""
+        headers = dict(headers or {})
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        try:
+            response, nbytes = self._send(method, path, body, headers)
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            # The server closed our idle keep-alive connection - once more on a new one
+            self.close()
+            response, nbytes = self._send(method, path, body, headers)
+        for header in response.headers.get_all("Set-Cookie") or []:
+            for name, morsel in SimpleCookie(header).items():
+                if morsel.value and morsel["expires"] != "Thu, 01 Jan 1970 00:00:00 GMT":
+                    self.cookies[name] = morsel.value
+                else:
+                    self.cookies.pop(name, None)
+        if response.getheader("Connection", "").lower() == "close":
+            self.close()
+        return response.status, response.getheader("Location") or "", nbytes
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class _User:
+    """A simulated user: an account, the files it uploaded, and its actions"""
+
+    _ids = itertools.count()
+
+    def __init__(self, url, run_id, payloads, results, rng):
+        self.client = _Client(url)
+        self.run_id = run_id
+        self.payloads = payloads
+        self.results = results
+        self.rng = rng
+        self.username = None
+        self.files = []
+        self._uploads = itertools.count()
+
+    def _timed(self, route, method, path, body=None, headers=None, expect=None):
+        """Make a request and record it; True if it succeeded"""
+        flashed = len(_flashed_errors(self.client.cookies.get("session")))
+        started = time.perf_counter()
+        try:
+            status, location, nbytes = self.client.request(method, path, body, headers)
+        except Exception as e:
+            self.client.close()
+            self.results.add(route, time.perf_counter() - started, 0, f"{type(e).__name__}: {e}")
+            return False
+        seconds = time.perf_counter() - started
+        error = None
+        messages = _flashed_errors(self.client.cookies.get("session"))
+        if status >= 500:
+            error = f"HTTP {status}"
+        elif len(messages) > flashed:
+            error = messages[-1]
+        elif expect and (status, urlparse(location).path) != expect:
+            error = f"HTTP {status} -> {location or 'no redirect'}"
+        self.results.add(route, seconds, status, error, nbytes)
+        return error is None
+
+    def _form(self, route, path, fields, expect):
+        body = "&".join(f"{name}={quote(value)}" for name, value in fields.items()).encode()
+        return self._timed(route, "POST", path, body,
+                           {"Content-Type": "application/x-www-form-urlencoded"}, expect)
+
+    def register(self):
+        username = f"load{self.run_id}u{next(self._ids)}"
+        if self._form("register", "/register", {"username": username, "password": "load-test"},
+                      (302, "/login")):
+            self.username, self.files = username, []
+            self.login()
+
+    def login(self):
+        if self.username:
+            self._form("login", "/login", {"username": self.username, "password": "load-test"},
+                       (302, "/home"))
+
+    def upload(self):
+        filename = f"file{next(self._uploads)}.bin"
+        data = self.rng.choice(self.payloads)
+        boundary = f"load{self.rng.getrandbits(64):016x}"
+        body = b"".join([
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n".encode(),
+            os.urandom(16), data,
+            f"\r\n--{boundary}--\r\n".encode(),
+        ])
+        if self._timed("upload", "POST", "/upload", body,
+                       {"Content-Type": f"multipart/form-data; boundary={boundary}"}, (302, "/home")):
+            self.files.append(filename + ".enc")
+
+    def download(self):
+        if not self.files:
+            return self.upload()
+        # A failed download redirects home with a flash
+        self._timed("download", "GET", f"/decrypt/{quote(self.rng.choice(self.files))}", expect=(200, ""))
+
+    def list(self):
+        self._timed("list", "GET", "/home", expect=(200, ""))
+
+    def dashboard(self):
+        self._timed("dashboard", "GET", "/dashboard", expect=(200, ""))
+
+    def run(self, mix, deadline):
+        self.register()
+        routes, weights = zip(*mix.items())
+        try:
+            while time.monotonic() < deadline:
+                getattr(self, self.rng.choices(routes, weights)[0])()
+        finally:
+            self.client.close()
+
+
+def _percentile(ordered, p):
+    """Nearest-rank percentile of sorted values"""
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+def summarize(results, elapsed):
+    routes = {}
+    total = errors = 0
+    for route in ROUTES:
+        latencies = sorted(results.latencies[route])
+        if not latencies:
+            continue
+        count = len(latencies)
+        total += count
+        errors += results.errors[route]
+        routes[route] = {
+            "requests": count,
+            "errors": results.errors[route],
+            "error_rate": round(results.errors[route] / count, 4),
+            "throughput_rps": round(count / elapsed, 3),
+            "p50_ms": round(_percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(_percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(_percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2),
+            "mean_ms": round(sum(latencies) / count * 1000, 2),
+            "response_bytes": results.bytes[route],
+            "statuses": results.statuses[route],
+            "sample_errors": results.samples[route],
+        }
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throughput_rps": round(total / elapsed, 3),
+    }, routes
+
+
+def _parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        route, _, weight = part.partition("=")
+        if route.strip() not in ROUTES:
+            raise argparse.ArgumentTypeError(f"unknown route {route!r} (routes: {', '.join(ROUTES)})")
+        mix[route.strip()] = float(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs a route with a weight above 0")
+    return mix
+
+def _start_app(args, runtime):
+    """Serve a fresh app on a fake runtime from this process; returns its URL"""
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="podvault-load-", dir=args.workdir)
+    # Registered before the app's own exit handlers, so it runs after them
+    atexit.register(shutil.rmtree, workdir, True)
+    prepare_environment(workdir, runtime, args.paced)
+    os.environ["PODVAULT_DATABASE_URI"] = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    os.environ.setdefault("PODVAULT_LOG_LEVEL", "WARNING")
+
+    from werkzeug.serving import make_server
+    from app import create_app
+    from app.storage import set_storage
+    from benchmarks import fake_runtime
+
+    set_storage(fake_runtime.make_storage(runtime["name"], workdir, runtime["exec_latency"],
+                                          runtime["cp_bandwidth"]))
+    app = create_app()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="load-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+def _rotate_periodically(every, deep, stop, started, log):
+    from app.key_rotation import rotate_all_vaults
+
+    while not stop.wait(every):
+        at = time.monotonic() - started
+        report = rotate_all_vaults(deep=deep)
+        outcomes = {}
+        for outcome in report["vaults"].values():
+            outcomes[outcome["status"]] = outcomes.get(outcome["status"], 0) + 1
+        log.append({"at_seconds": round(at, 3), "wall_seconds": report["wall_time"], "vaults": outcomes})
+        print(f"🔄 Rotation at {at:.0f}s: {len(report['vaults'])} vaults in {report['wall_time']}s "
+              f"({', '.join(f'{count} {status}' for status, count in outcomes.items()) or 'none'})",
+              file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load", description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=20, help="Concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of traffic")
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix(DEFAULT_MIX),
+                        help=f"Route weights (default: {DEFAULT_MIX})")
+    parser.add_argument("--upload-sizes", default="4K,256K,4M", help="Sizes uploads are drawn from")
+    parser.add_argument("--rotate-every", type=float, default=0,
+                        help="Rotate all vaults every N seconds during the test (0: never)")
+    parser.add_argument("--deep", action="store_true", help="Make those rotations deep (full re-encryption)")
+    parser.add_argument("--url", help="Load an app that is already running instead of starting one")
+    parser.add_argument("--port", type=int, default=0, help="Port for the app started here (default: any)")
+    parser.add_argument("--runtime", choices=("simulated", "agent"), default="simulated")
+    parser.add_argument("--exec-latency", type=float, default=0.002,
+                        help="Seconds per podman exec round trip (simulated) or agent start (agent)")
+    parser.add_argument("--cp-bandwidth", type=parse_size, default=0,
+                        help="Bytes/sec moved in and out of a vault (simulated; 0: unlimited)")
+    parser.add_argument("--paced", action="store_true", help="Keep the configured re-encryption pacing")
+    parser.add_argument("--workdir", help="Where the fake vaults and database go (default: the temp directory)")
+    parser.add_argument("--seed", type=int, help="Random seed for the users' choices")
+    parser.add_argument("--output", default="load-results.json", help="JSON results file")
+    args = parser.parse_args(argv)
+    if args.url and args.rotate_every:
+        parser.error("--rotate-every needs the app started here (no --url)")
+
+    runtime = {"name": args.runtime, "exec_latency": args.exec_latency, "cp_bandwidth": args.cp_bandwidth}
+    url = args.url or _start_app(args, runtime)
+    rng = random.Random(args.seed)
+    payloads = [os.urandom(parse_size(size)) for size in args.upload_sizes.split(",")]
+    results = _Results()
+    run_id = f"{rng.getrandbits(24):06x}"
+    print(f"🚦 {args.users} users for {args.duration:.0f}s against {url}", file=sys.stderr)
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    stop = threading.Event()
+    rotations = []
+    threads = [threading.Thread(target=_User(url, run_id, payloads, results, random.Random(rng.random())).run,
+                                args=(args.mix, deadline), name=f"load-user-{n}", daemon=True)
+               for n in range(args.users)]
+    if args.rotate_every:
+        threads.append(threading.Thread(target=_rotate_periodically, name="load-rotation", daemon=True,
+                                        args=(args.rotate_every, args.deep, stop, started, rotations)))
+    for thread in threads:
+        thread.start()
+    for thread in threads[:args.users]:
+        thread.join()
+    elapsed = time.monotonic() - started
+    stop.set()
+    threads[-1].join()
+
+    totals, routes = summarize(results, elapsed)
+    report = {
+        "meta": describe_run(url=args.url, users=args.users, duration=args.duration, mix=args.mix,
+                             upload_sizes=args.upload_sizes, rotate_every=args.rotate_every, deep=args.deep,
+                             runtime=None if args.url else runtime, paced=args.paced, seed=args.seed),
+        "elapsed_seconds": round(elapsed, 3),
+        "totals": totals,
+        "routes": routes,
+        "rotations": rotations,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'route':<10} {'requests':>9} {'req/s':>8} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'max ms':>9}", file=sys.stderr)
+    for route, row in routes.items():
+        print(f"{route:<10} {row['requests']:>9} {row['throughput_rps']:>8.1f} {row['error_rate']:>7.1%} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {row['max_ms']:>9.1f}",
+              file=sys.stderr)
+        for sample in row["sample_errors"]:
+            print(f"   ❌ {sample}", file=sys.stderr)
+    print(f"📊 {totals['requests']} requests in {elapsed:.1f}s ({totals['throughput_rps']:.1f}/s), "
+          f"{totals['error_rate']:.1%} errors -> {args.output}", file=sys.stderr)
+    return 1 if totals["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+"""Benchmarks for vault crypto, vault I/O and key rotation, without Podman
+
+    python -m benchmarks.run                                  # quick suite
+    python -m benchmarks.run --preset full --output before.json
+    python -m benchmarks.run --runtime agent --exec-latency 0.02
+    python -m benchmarks.run --only encrypt,download --sizes 1K,1G,4G --repeat 1
+
+Cases:
+
+    encrypt     encrypt_file_for_vault, by file size
+    download    a whole file streamed through VaultDownload (as /decrypt serves it), by size
+    list        list_user_files, by files in the vault
+    rotate      rotate_vault_key (rewrap and deep), by files and file size
+    rotate_all  rotate_all_vaults, by vaults
+
+Every case runs in a fresh Python process on a fresh fake runtime
+(benchmarks/fake_runtime.py), so the peak RSS it reports is its own. The
+measured call repeats --repeat times; seconds is the median. Results go to
+JSON with the commit they were taken at; compare two runs with
+``python -m benchmarks.compare``.
+
+Re-encryption pacing (PODVAULT_DEEP_REENCRYPT_RATE, PODVAULT_ROTATION_IO_RATE)
+is off unless --paced is given, so rotation numbers show what the code can
+do rather than the configured limit.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+_BLOCK = 1024 * 1024
+
+PRESETS = {
+    "quick": {
+        "encrypt": {"size": ["1K", "1M", "64M"]},
+        "download": {"size": ["1K", "1M", "64M"]},
+        "list": {"files": [10, 1000]},
+        "rotate": {"files": [100], "size": ["64K"], "deep": [False, True]},
+        "rotate_all": {"vaults": [1, 8], "files": [20], "size": ["64K"]},
+    },
+    "full": {
+        "encrypt": {"size": ["1K", "1M", "64M", "1G", "4G"]},
+        "download": {"size": ["1K", "1M", "64M", "1G", "4G"]},
+        "list": {"files": [10, 1000, 10000]},
+        "rotate": {"files": [100, 1000], "size": ["64K", "4M"], "deep": [False, True]},
+        "rotate_all": {"vaults": [1, 8, 32], "files": [50], "size": ["64K"]},
+    },
+}
+
+
+def parse_size(text):
+    """"64K" / "1G" / "100" -> bytes"""
+    text = str(text).strip().upper().removesuffix("B")
+    unit = text[-1] if text[-1:] in ("K", "M", "G") else ""
+    return int(float(text[:len(text) - len(unit)]) * _UNITS[unit])
+
+def _peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# ---- cases (run in the child process) ----
+
+class _Source:
+    """File-like: size bytes made of one random block repeated (AES doesn't care)"""
+
+    def __init__(self, size):
+        self.block = os.urandom(min(size, _BLOCK))
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining
+        data = self.block[:min(size, self.remaining)]
+        self.remaining -= len(data)
+        return data
+
+def _write_source(path, size):
+    source = _Source(size)
+    with open(path, "wb") as f:
+        while data := source.read(_BLOCK):
+            f.write(data)
+
+def _seed_vault(index, files=0, size=0):
+    """Create vault_bench<index> holding files of size bytes; returns its name"""
+    from app.key_rotation import store_streams_in_vault
+    from app.podman_manager import create_user_vault
+
+    vault_name = create_user_vault(f"bench{index}")
+    entries = ((f"f{n:06d}.bin", _Source(size)) for n in range(files))
+    for _ in store_streams_in_vault(entries, vault_name):
+        pass
+    return vault_name
+
+def _measure(fn, repeat):
+    runs, cpu = [], []
+    for _ in range(repeat):
+        started, started_cpu = time.perf_counter(), time.process_time()
+        fn()
+        runs.append(time.perf_counter() - started)
+        cpu.append(time.process_time() - started_cpu)
+    return {"seconds": statistics.median(runs), "min_seconds": min(runs),
+            "cpu_seconds": statistics.median(cpu), "runs": [round(run, 6) for run in runs]}
+
+def bench_encrypt(root, use_runtime, repeat, size):
+    from app.key_rotation import encrypt_file_for_vault
+
+    size = parse_size(size)
+    vault_name = _seed_vault(0)
+    source = os.path.join(root, "source.bin")
+    _write_source(source, size)
+    use_runtime()
+    result = _measure(lambda: encrypt_file_for_vault(source, vault_name), repeat)
+    return dict(result, bytes=size)
+
+def bench_download(root, use_runtime, repeat, size):
+    from app.key_rotation import VaultDownload
+
+    size = parse_size(size)
+    vault_name = _seed_vault(0, files=1, size=size)
+    use_runtime()
+
+    def download():
+        stream = VaultDownload("f000000.bin.enc", vault_name)
+        try:
+            received = sum(len(data) for data in stream.iter_range())
+        finally:
+            stream.close()
+        if received != size:
+            raise Exception(f"Downloaded {received} of {size} bytes")
+    result = _measure(download, repeat)
+    return dict(result, bytes=size)
+
+def bench_list(root, use_runtime, repeat, files):
+    from app.podman_manager import list_user_files
+
+    vault_name = _seed_vault(0, files=files, size=1024)
+    use_runtime()
+    listed = []
+    result = _measure(lambda: listed.append(len(list_user_files(vault_name))), repeat)
+    if listed[-1] != files:
+        raise Exception(f"Listed {listed[-1]} of {files} files")
+    return dict(result, files=files)
+
+def bench_rotate(root, use_runtime, repeat, files, size, deep):
+    from app.key_rotation import rotate_vault_key
+
+    size = parse_size(size)
+    vault_name = _seed_vault(0, files=files, size=size)
+    use_runtime()
+
+    def rotate():
+        if rotate_vault_key(vault_name, deep=deep) is not True:
+            raise Exception(f"Rotation of {vault_name} did not complete")
+    result = _measure(rotate, repeat)
+    return dict(result, files=files, bytes=files * size)
+
+def bench_rotate_all(root, use_runtime, repeat, vaults, files, size):
+    from app.key_rotation import rotate_all_vaults
+
+    size = parse_size(size)
+    for index in range(vaults):
+        _seed_vault(index, files=files, size=size)
+    use_runtime()
+
+    def rotate():
+        report = rotate_all_vaults()
+        failed = [name for name, outcome in report["vaults"].items() if outcome["status"] != "ok"]
+        if len(report["vaults"]) != vaults or failed:
+            raise Exception(f"Rotated {len(report['vaults']) - len(failed)} of {vaults} vaults")
+    result = _measure(rotate, repeat)
+    return dict(result, vaults=vaults, files=vaults * files, bytes=vaults * files * size)
+
+CASES = {
+    "encrypt": bench_encrypt,
+    "download": bench_download,
+    "list": bench_list,
+    "rotate": bench_rotate,
+    "rotate_all": bench_rotate_all,
+}
+
+
+def prepare_environment(root, runtime, paced=False):
+    """Set the app's environment for a fake runtime (before anything imports app)"""
+    os.environ["PODVAULT_LOCAL_ROOT"] = root
+    os.environ["PODVAULT_POOL_SIZE"] = "0"
+    if not paced:
+        os.environ["PODVAULT_DEEP_REENCRYPT_RATE"] = "0"
+        os.environ["PODVAULT_ROTATION_IO_RATE"] = "0"
+    if runtime["name"] != "agent":
+        os.environ["PODVAULT_STORAGE"] = "local"
+        return
+    from benchmarks import fake_podman
+    fake_podman.install(root, runtime["exec_latency"])
+    # No libpod socket: lifecycle calls go to the fake CLI
+    os.environ["PODMAN_SOCKET"] = os.path.join(root, ".no-podman.sock")
+    os.environ["PODVAULT_STORAGE"] = "exec"
+
+def run_case(spec):
+    """Child process side: set up, measure, report"""
+    if spec.get("workdir"):
+        os.makedirs(spec["workdir"], exist_ok=True)
+    root = tempfile.mkdtemp(prefix="podvault-bench-", dir=spec.get("workdir"))
+    try:
+        prepare_environment(root, spec["runtime"], spec["paced"])
+        from app.storage import set_storage
+        from benchmarks import fake_runtime
+
+        runtime = spec["runtime"]
+        set_storage(fake_runtime.seed_storage(root))
+        rss = {}
+
+        def use_runtime():
+            rss["setup"] = _peak_rss()
+            set_storage(fake_runtime.make_storage(runtime["name"], root, runtime["exec_latency"],
+                                                  runtime["cp_bandwidth"]))
+        result = CASES[spec["case"]](root, use_runtime, spec["repeat"], **spec["params"])
+        result["setup_peak_rss"] = rss.get("setup")
+        result["peak_rss"] = _peak_rss()
+        return result
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+# ---- driver (parent process) ----
+
+def _expand(preset, only, overrides):
+    specs = []
+    for case, grid in PRESETS[preset].items():
+        if only and case not in only:
+            continue
+        grid = dict(grid, **{name: values for name, values in overrides.items() if name in grid})
+        names = list(grid)
+        for values in itertools.product(*(grid[name] for name in names)):
+            specs.append({"case": case, "params": dict(zip(names, values))})
+    return specs
+
+def _spawn(spec, timeout):
+    started = time.monotonic()
+    process = subprocess.run([sys.executable, "-m", "benchmarks.run", "--case", json.dumps(spec)],
+                             cwd=ROOT_DIR, capture_output=True, text=True, timeout=timeout)
+    outcome = {"case": spec["case"], "params": spec["params"]}
+    lines = process.stdout.strip().splitlines()
+    if process.returncode != 0 or not lines:
+        error = (process.stderr.strip().splitlines() or ["no output"])[-1]
+        return dict(outcome, error=error, wall_seconds=round(time.monotonic() - started, 3))
+    result = json.loads(lines[-1])
+    if "error" in result:
+        return dict(outcome, error=result["error"])
+    seconds = result["seconds"]
+    if result.get("bytes") and seconds:
+        result["mib_per_s"] = round(result["bytes"] / seconds / 1024 ** 2, 3)
+    if result.get("files") and seconds:
+        result["files_per_s"] = round(result["files"] / seconds, 3)
+    return dict(outcome, **result)
+
+def _describe(result):
+    params = " ".join(f"{name}={value}" for name, value in result["params"].items())
+    if "error" in result:
+        return f"❌ {result['case']:<10} {params:<32} {result['error']}"
+    rates = ""
+    if "mib_per_s" in result:
+        rates += f"{result['mib_per_s']:>10.1f} MiB/s"
+    if "files_per_s" in result:
+        rates += f"{result['files_per_s']:>10.0f} files/s"
+    return (f"⏱️ {result['case']:<10} {params:<32} {result['seconds'] * 1000:>10.2f} ms{rates:<36}"
+            f" peak {result['peak_rss'] / 1024 ** 2:.0f} MiB")
+
+def _git(*args):
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+def describe_run(**settings):
+    """The "meta" block of a results file: commit, machine, settings"""
+    return {
+        "commit": _git("rev-parse", "HEAD"),
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        **settings,
+        "environment": {name: value for name, value in sorted(os.environ.items())
+                        if name.startswith("PODVAULT_")},
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run", description=__doc__.split("\n")[0])
+    parser.add_argument("--preset", choices=sorted(PRESETS), default="quick")
+    parser.add_argument("--only", help="Comma-separated cases to run (default: all)")
+    parser.add_argument("--sizes", help="File sizes for encrypt/download, e.g. 1K,1M,1G")
+    parser.add_argument("--file-counts", help="Files per vault for list/rotate, e.g. 10,1000")
+    parser.add_argument("--vault-counts", help="Vaults for rotate_all, e.g. 1,8,32")
+    parser.add_argument("--repeat", type=int, default=3, help="Measured runs per case (median is reported)")
+    parser.add_argument("--runtime", choices=("simulated", "agent"), default="simulated")
+    parser.add_argument("--exec-latency", type=float, default=0.002,
+                        help="Seconds per podman exec round trip (simulated) or agent start (agent)")
+    parser.add_argument("--cp-bandwidth", type=parse_size, default=0,
+                        help="Bytes/sec moved in and out of a vault, e.g. 500M (simulated; 0: unlimited)")
+    parser.add_argument("--paced", action="store_true", help="Keep the configured re-encryption pacing")
+    parser.add_argument("--workdir", help="Where fake vaults are created (default: the temp directory)")
+    parser.add_argument("--timeout", type=float, default=3600, help="Seconds one case may take")
+    parser.add_argument("--output", default="benchmark-results.json", help="JSON results file")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        try:
+            result = run_case(json.loads(args.case))
+        except Exception as e:
+            result = {"error": f"{type(e).__name__}: {e}"}
+        print(json.dumps(result))
+        return 0
+
+    overrides = {}
+    if args.sizes:
+        overrides["size"] = args.sizes.split(",")
+    if args.file_counts:
+        overrides["files"] = [int(count) for count in args.file_counts.split(",")]
+    if args.vault_counts:
+        overrides["vaults"] = [int(count) for count in args.vault_counts.split(",")]
+    only = set(args.only.split(",")) if args.only else None
+    if only and only - set(CASES):
+        parser.error(f"unknown cases: {', '.join(sorted(only - set(CASES)))}")
+    runtime = {"name": args.runtime, "exec_latency": args.exec_latency, "cp_bandwidth": args.cp_bandwidth}
+
+    report = {
+        "meta": describe_run(preset=args.preset, repeat=args.repeat, runtime=runtime, paced=args.paced),
+        "results": [],
+    }
+    for spec in _expand(args.preset, only, overrides):
+        spec.update(runtime=runtime, repeat=args.repeat, paced=args.paced, workdir=args.workdir)
+        try:
+            result = _spawn(spec, args.timeout)
+        except subprocess.TimeoutExpired:
+            result = {"case": spec["case"], "params": spec["params"], "error": f"timed out after {args.timeout}s"}
+        report["results"].append(result)
+        print(_describe(result), file=sys.stderr)
+        # Rewritten after every case, so a long run that dies keeps what it measured
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    failed = sum("error" in result for result in report["results"])
+    print(f"📊 {len(report['results']) - failed} cases measured, {failed} failed -> {args.output}",
+          file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,9 @@
 from app import create_app
 
-app = create_app()
+# Crypto worker processes import this module again as __mp_main__; only
+# the real process should build the app (and start its scheduler)
+if __name__ != "__mp_main__":
+    app = create_app()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080, debug=True)
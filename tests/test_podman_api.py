@@ -0,0 +1,101 @@
+"""AsyncPodmanClient against the fake libpod server (app/podman_fake.py)
+
+    python -m pytest tests    (or: python -m unittest discover tests)
+"""
+import asyncio
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from app.podman_api import AsyncPodmanClient, PodmanAPIError, tar_single_file
+from app.podman_fake import FakePodmanServer
+
+
+class AsyncClientTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.server = FakePodmanServer().start()
+        self.client = AsyncPodmanClient(socket_path=self.server.socket_path, pool_size=1)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        self.server.stop()
+
+    async def call(self, awaitable):
+        # A client waiting for a body that never comes would hang here
+        return await asyncio.wait_for(awaitable, timeout=5)
+
+    def connection(self):
+        self.assertEqual(len(self.client._idle), 1)
+        return self.client._idle[0]
+
+    async def test_no_body_replies_keep_the_connection(self):
+        await self.call(self.client.create_container("vault_a", "alpine", ["sleep", "inf"]))
+        connection = self.connection()
+        await self.call(self.client.start_container("vault_a"))  # 204
+        await self.call(self.client.start_container("vault_a"))  # 304
+        self.assertTrue(await self.call(self.client.container_exists("vault_a")))
+        await self.call(self.client.rename_container("vault_a", "vault_b"))
+        await self.call(self.client.stop_container("vault_b"))
+        containers = await self.call(self.client.list_containers())
+        self.assertEqual([c["Names"] for c in containers], [["vault_b"]])
+        self.assertIs(self.connection(), connection)
+
+    async def test_head_reply_has_no_body(self):
+        await self.call(self.client.create_container("vault_a", "alpine", ["sleep", "inf"]))
+        # The reply carries the JSON's Content-Length, but no JSON
+        await self.call(self.client._call("HEAD", "/containers/vault_a/json", parse=None))
+        info = await self.call(self.client.inspect_container("vault_a"))
+        self.assertEqual(info["Name"], "vault_a")
+
+    async def test_archive_round_trip_streams_into_a_file(self):
+        await self.call(self.client.create_container("vault_a", "alpine", ["sleep", "inf"],
+                                                     volumes=[("vault_a_keys", "/vault/keys")]))
+        key = os.urandom(300_000)
+        await self.call(self.client.put_archive("vault_a", "/vault/keys", tar_single_file("master.key", key)))
+        with tempfile.TemporaryFile() as sink:
+            self.assertIsNone(await self.call(self.client.get_archive("vault_a", "/vault/keys", sink)))
+            sink.seek(0)
+            with tarfile.open(fileobj=sink) as tar:
+                self.assertEqual(tar.extractfile("keys/master.key").read(), key)
+        await self.call(self.client.start_container("vault_a"))
+
+    async def test_errors_are_raised_not_streamed(self):
+        await self.call(self.client.create_container("vault_a", "alpine", ["sleep", "inf"]))
+        sink = io.BytesIO()
+        with self.assertRaises(PodmanAPIError) as error:
+            await self.call(self.client.get_archive("vault_a", "/vault/missing", sink))
+        self.assertEqual(error.exception.status, 404)
+        self.assertEqual(sink.getvalue(), b"")
+        self.assertTrue(await self.call(self.client.container_exists("vault_a")))
+
+
+class InterimReplyTest(unittest.IsolatedAsyncioTestCase):
+    """Replies the fake server doesn't send: 100 Continue, a body ended by closing"""
+
+    async def test_continue_then_body_until_close(self):
+        async def handle(reader, writer):
+            while (await reader.readline()).strip():
+                pass
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n"
+                         b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n{\"Id\": \"abc\"}")
+            await writer.drain()
+            writer.close()
+
+        path = os.path.join(tempfile.mkdtemp(), "podman.sock")
+        server = await asyncio.start_unix_server(handle, path)
+        client = AsyncPodmanClient(socket_path=path)
+        try:
+            info = await asyncio.wait_for(client.inspect_container("vault_a"), timeout=5)
+            self.assertEqual(info, {"Id": "abc"})
+            self.assertEqual(client._idle, [])
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+
+if __name__ == "__main__":
+    unittest.main()